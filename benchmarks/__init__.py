@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the CRUD hot paths of the services on large synthetic datasets."""
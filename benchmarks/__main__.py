@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Command line:
+
+    python -m benchmarks run --services payment,delivery --scale 0.01
+    python -m benchmarks compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from benchmarks import cases
+from benchmarks.runner import REPOSITORY_DIR
+
+RESULTS_DIR = os.path.join(REPOSITORY_DIR, "benchmarks", "results")
+# Statistic compared between two runs, and the slowdown reported as a regression
+COMPARED_STATISTIC = "p50"
+DEFAULT_THRESHOLD = 0.10
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_service(service, args):
+    """Run the benchmarks of the service in a child process and return its results."""
+    command = [
+        sys.executable, "-m", "benchmarks.runner", service,
+        "--scale", str(args.scale),
+        "--iterations", str(args.iterations),
+        "--warmup", str(args.warmup),
+        "--seed", str(args.seed),
+    ]
+    if args.data_dir:
+        command += ["--data-dir", args.data_dir]
+    if args.regenerate:
+        command.append("--regenerate")
+    completed = subprocess.run(command, cwd=REPOSITORY_DIR, stdout=subprocess.PIPE, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"The benchmarks of {service} failed (exit code {completed.returncode})")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    git_commit = get_git_commit()
+    report = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "git_commit": git_commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "iterations": args.iterations,
+        "services": {},
+    }
+    for service in args.services:
+        print(f"Benchmarking {service}...", file=sys.stderr)
+        report["services"][service] = run_service(service, args)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{datetime.utcnow():%Y%m%d-%H%M%S}-{git_commit or 'nogit'}.json")
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    for service, service_report in report["services"].items():
+        for case_name, summary in service_report["cases"].items():
+            print(f"{service + '.' + case_name:<40} p50 {summary['p50'] * 1000:8.3f} ms  "
+                  f"p99 {summary['p99'] * 1000:8.3f} ms  {summary['ops_per_second'] or 0:10.1f} ops/s")
+    print(f"Results saved in {output}")
+
+
+def compare(args):
+    """Print the change of every case between two result files; exit code 1 if any regressed."""
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(args.current) as current_file:
+        current = json.load(current_file)
+    if baseline.get("scale") != current.get("scale"):
+        print(f"Warning: comparing different scales ({baseline.get('scale')} and {current.get('scale')})")
+    regressions = 0
+    for service, service_report in current["services"].items():
+        baseline_cases = baseline["services"].get(service, {}).get("cases", {})
+        for case_name, summary in service_report["cases"].items():
+            if case_name not in baseline_cases:
+                print(f"{service + '.' + case_name:<40} new")
+                continue
+            old_value = baseline_cases[case_name][COMPARED_STATISTIC]
+            new_value = summary[COMPARED_STATISTIC]
+            change = (new_value - old_value) / old_value if old_value else 0
+            regressed = change > args.threshold
+            regressions += regressed
+            print(f"{service + '.' + case_name:<40} {COMPARED_STATISTIC} {old_value * 1000:8.3f} -> "
+                  f"{new_value * 1000:8.3f} ms  {change:+7.1%}{'  REGRESSION' if regressed else ''}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks", description="Benchmarks of the CRUD hot paths.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and save the results as JSON")
+    run_parser.add_argument("--services", type=lambda value: value.split(","), default=sorted(cases.SERVICES),
+                            help="Comma separated services (default: all)")
+    run_parser.add_argument("--scale", type=float, default=1,
+                            help="Dataset size factor; 1 means millions of payments and tens of millions of logs")
+    run_parser.add_argument("--iterations", type=int, default=1000)
+    run_parser.add_argument("--warmup", type=int, default=50)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--data-dir", help="Where the datasets are kept (default: benchmarks/data)")
+    run_parser.add_argument("--regenerate", action="store_true", help="Generate the datasets again")
+    run_parser.add_argument("--output", help="Result file (default: benchmarks/results/<date>-<commit>.json)")
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                                help="Relative slowdown of the p50 reported as a regression")
+    args = parser.parse_args()
+    if args.command == "run":
+        unknown_services = set(args.services) - set(cases.SERVICES)
+        if unknown_services:
+            parser.error(f"Unknown services: {', '.join(sorted(unknown_services))}")
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Dataset generation and benchmark cases of each service.
+
+The functions get the sql modules (database, models, crud) of the service being measured; every
+operation opens its own session, as the routers and consumers do.
+"""
+import random
+from types import SimpleNamespace
+from benchmarks import datagen
+
+
+# Payment ##########################################################################################
+async def generate_payment(sql, sizes, rng):
+    await datagen.bulk_insert(sql.database.engine, sql.models.ClientBalance.__table__, datagen.client_balance_rows(rng, sizes))
+    await datagen.bulk_insert(sql.database.engine, sql.models.Payment.__table__, datagen.payment_rows(rng, sizes))
+
+
+def get_payment_cases(sql, sizes, rng):
+    order_ids = iter(range(sizes["payment"] + 1, 2 ** 62))
+
+    async def create_payment():
+        async with sql.database.SessionLocal() as db:
+            payment = {"id_client": rng.randint(1, sizes["client_balance"]), "id_order": next(order_ids), "movement": -1}
+            await sql.crud.create_payment(db, payment)
+
+    return {"create_payment": create_payment}
+
+
+# Delivery #########################################################################################
+async def generate_delivery(sql, sizes, rng):
+    await datagen.bulk_insert(sql.database.engine, sql.models.Client.__table__, datagen.delivery_client_rows(rng, sizes))
+    await datagen.bulk_insert(sql.database.engine, sql.models.Delivery.__table__, datagen.delivery_rows(rng, sizes))
+
+
+def get_delivery_cases(sql, sizes, rng):
+
+    async def get_delivery_by_order():
+        async with sql.database.SessionLocal() as db:
+            await sql.crud.get_delivery_by_order(db, rng.randint(1, sizes["delivery"]))
+
+    async def get_delivery_by_order_missing():
+        async with sql.database.SessionLocal() as db:
+            await sql.crud.get_delivery_by_order(db, sizes["delivery"] + rng.randint(1, sizes["delivery"]))
+
+    return {
+        "get_delivery_by_order": get_delivery_by_order,
+        "get_delivery_by_order_missing": get_delivery_by_order_missing,
+    }
+
+
+# Client ###########################################################################################
+async def generate_client(sql, sizes, rng):
+    from routers import password_hashing  # pylint: disable=import-outside-toplevel
+    password_hash = await password_hashing.hash_password(datagen.CLIENT_PASSWORD)
+    await datagen.bulk_insert(sql.database.engine, sql.models.Client.__table__, datagen.client_rows(rng, sizes, password_hash))
+
+
+def get_client_cases(sql, sizes, rng):
+    # The username and password lookup of get_client_by_username_and_pass is now split in
+    # get_client_by_username (the query) and authenticate_client (query and password check)
+
+    async def get_client_by_username():
+        async with sql.database.SessionLocal() as db:
+            await sql.crud.get_client_by_username(db, datagen.get_username(rng.randint(1, sizes["clients"])))
+
+    async def authenticate_client():
+        async with sql.database.SessionLocal() as db:
+            username = datagen.get_username(rng.randint(1, sizes["clients"]))
+            if await sql.crud.authenticate_client(db, username, datagen.CLIENT_PASSWORD) is None:
+                raise AssertionError(f"Could not authenticate {username}")
+
+    return {
+        "get_client_by_username": get_client_by_username,
+        "authenticate_client": authenticate_client,
+    }
+
+
+# Logs #############################################################################################
+async def generate_logs(sql, sizes, rng):
+    from sql import log_parser  # pylint: disable=import-outside-toplevel
+    # With the structured columns the ingest path stores, parsed the same way
+    rows = (
+        dict(row, **log_parser.parse_log(row["exchange"], row["routing_key"], row["data"]))
+        for row in datagen.log_rows(rng, sizes)
+    )
+    await datagen.bulk_insert(sql.database.engine, sql.models.Log.__table__, rows)
+
+
+def get_logs_cases(sql, sizes, rng):
+
+    async def get_logs():
+        async with sql.database.SessionLocal() as db:
+            await sql.crud.get_logs(db, 100)
+
+    async def create_log():
+        async with sql.database.SessionLocal() as db:
+            log = SimpleNamespace(exchange="logs", routing_key="payment.benchmark.info", data='{"message": "INFO - Benchmark"}')
+            await sql.crud.create_log(db, log)
+
+    return {
+        "get_logs": get_logs,
+        "create_log": create_log,
+    }
+
+
+# service -> (dataset generator, cases); the read cases first, the cases that write run last
+SERVICES = {
+    "payment": (generate_payment, get_payment_cases),
+    "delivery": (generate_delivery, get_delivery_cases),
+    "client": (generate_client, get_client_cases),
+    "logs": (generate_logs, get_logs_cases),
+}
+
+
+def get_random(seed=0):
+    return random.Random(seed)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""Synthetic datasets for the benchmarks, inserted in chunks with executemany.
+
+The rows are generated from a seeded random.Random, so the same scale always gives the same data.
+"""
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+INSERT_CHUNK_SIZE = 50000
+
+# Rows of each dataset at scale 1
+DATASET_SIZES = {
+    "payment": {"payment": 2000000, "client_balance": 100000},
+    "delivery": {"delivery": 200000, "clients": 200000},
+    "client": {"clients": 200000},
+    "logs": {"log": 20000000},
+}
+
+# Postal codes of the provinces where the deliveries are accepted and of some others
+POSTAL_CODES = [1001, 1010, 20001, 20500, 48001, 48950, 28001, 8001, 31001]
+LOG_SERVICES = ["client", "payment", "delivery", "machine", "order"]
+LOG_EVENTS = ["order.created", "payment.checked", "delivery.checked", "piece.produced", "order.delivered"]
+# The password of every synthetic client (hashed once, see client_rows)
+CLIENT_PASSWORD = "benchmark"
+
+
+def get_dataset_sizes(service, scale):
+    return {table: max(1, int(rows * scale)) for table, rows in DATASET_SIZES[service].items()}
+
+
+def get_username(client_id):
+    return f"client{client_id}"
+
+
+def payment_rows(rng, sizes):
+    number_of_clients = sizes["client_balance"]
+    for payment_id in range(1, sizes["payment"] + 1):
+        yield {
+            "id_payment": payment_id,
+            "id_client": rng.randint(1, number_of_clients),
+            "id_order": payment_id,
+            "movement": -round(rng.uniform(1, 100), 2),
+        }
+
+
+def client_balance_rows(rng, sizes):
+    # Enough balance for the create_payment benchmark never to run out
+    for client_id in range(1, sizes["client_balance"] + 1):
+        yield {"id_client": client_id, "balance": 1e9}
+
+
+def delivery_rows(rng, sizes):
+    statuses = ["Created", "Canceled", "Delivering", "Delivered"]
+    for delivery_id in range(1, sizes["delivery"] + 1):
+        yield {
+            "id_delivery": delivery_id,
+            "id_order": delivery_id,
+            "address": f"Street {delivery_id}",
+            "postal_code": rng.choice(POSTAL_CODES),
+            "status_delivery": rng.choice(statuses),
+        }
+
+
+def delivery_client_rows(rng, sizes):
+    for client_id in range(1, sizes["clients"] + 1):
+        yield {"id_client": client_id, "address": f"Street {client_id}", "postal_code": rng.choice(POSTAL_CODES)}
+
+
+def client_rows(rng, sizes, password_hash):
+    # Hashing each password would take hours: all the clients share one hash
+    for client_id in range(1, sizes["clients"] + 1):
+        yield {
+            "id_client": client_id,
+            "email": f"client{client_id}@example.com",
+            "username": get_username(client_id),
+            "password": password_hash,
+            "address": f"Street {client_id}",
+            "postal_code": rng.choice(POSTAL_CODES),
+            "role": 0,
+        }
+
+
+def log_rows(rng, sizes):
+    for log_id in range(1, sizes["log"] + 1):
+        if rng.random() < 0.5:
+            level = "info" if rng.random() < 0.9 else "error"
+            routing_key = f"{rng.choice(LOG_SERVICES)}.main_router_operation{rng.randint(1, 20)}.{level}"
+            exchange = "logs"
+            data = {"message": f"{level.upper()} - Operation {log_id}"}
+        else:
+            routing_key = rng.choice(LOG_EVENTS)
+            exchange = "events"
+            data = {"id_order": rng.randint(1, 1000000), "id_client": rng.randint(1, 100000)}
+        yield {"id_log": log_id, "exchange": exchange, "routing_key": routing_key, "data": json.dumps(data)}
+
+
+def chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def bulk_insert(engine, table, rows, chunk_size=INSERT_CHUNK_SIZE):
+    """Insert the rows in chunks, one transaction each. Returns the number of rows."""
+    inserted = 0
+    start_time = time.perf_counter()
+    for chunk in chunks(rows, chunk_size):
+        async with engine.begin() as connection:
+            await connection.execute(table.insert(), chunk)
+        inserted += len(chunk)
+    logger.info("Inserted %i rows in %s in %.1fs", inserted, table.name, time.perf_counter() - start_time)
+    return inserted
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Timing of the benchmark cases."""
+import time
+
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(sorted_values, p):
+    """Percentile p (0-100) of sorted values, interpolating between the closest ranks."""
+    rank = (len(sorted_values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(durations):
+    """Mean, percentiles, max and operations per second of durations in seconds."""
+    durations = sorted(durations)
+    total = sum(durations)
+    summary = {
+        "count": len(durations),
+        "mean": total / len(durations),
+    }
+    for p in PERCENTILES:
+        summary[f"p{p}"] = percentile(durations, p)
+    summary["max"] = durations[-1]
+    summary["ops_per_second"] = len(durations) / total if total > 0 else None
+    return summary
+
+
+async def time_case(case, iterations, warmup):
+    """Run the case warmup times untimed, then iterations times, timing each call.
+
+    case() returns the awaitable of one operation.
+    """
+    for _ in range(warmup):
+        await case()
+    durations = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        await case()
+        durations.append(time.perf_counter() - start_time)
+    return summarize(durations)
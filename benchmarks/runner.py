@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of one service, run in its own process (every service has its own sql package).
+
+python -m benchmarks.runner payment --scale 0.01 prints the results as JSON on the last line.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+from benchmarks import cases, datagen, harness
+
+logger = logging.getLogger(__name__)
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_database_path(data_dir, service, scale):
+    return os.path.join(data_dir, f"{service}-{scale:g}.db")
+
+
+def remove_database(database_path):
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database_path + suffix):
+            os.remove(database_path + suffix)
+
+
+def import_service(service, database_path):
+    """Import the sql package of the service, bound to the benchmark database."""
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite+aiosqlite:///{database_path}"
+    sys.path.insert(0, os.path.join(REPOSITORY_DIR, service, "app"))
+    return SimpleNamespace(
+        database=importlib.import_module("sql.database"),
+        models=importlib.import_module("sql.models"),
+        crud=importlib.import_module("sql.crud"),
+        migrations=importlib.import_module("sql.migrations"),
+    )
+
+
+async def run_service(service, scale, iterations, warmup, data_dir, regenerate=False, seed=0):
+    """Create (or reuse) the dataset of the service and time its cases."""
+    os.makedirs(data_dir, exist_ok=True)
+    database_path = os.path.abspath(get_database_path(data_dir, service, scale))
+    if regenerate:
+        remove_database(database_path)
+    # The write cases add a few rows per run, negligible next to the dataset, so it is reused
+    new_database = not os.path.exists(database_path)
+    sql = import_service(service, database_path)
+    await sql.migrations.run_migrations()
+    generate, get_cases = cases.SERVICES[service]
+    sizes = datagen.get_dataset_sizes(service, scale)
+    generate_seconds = None
+    if new_database:
+        start_time = time.perf_counter()
+        await generate(sql, sizes, cases.get_random(seed))
+        generate_seconds = time.perf_counter() - start_time
+    results = {}
+    for case_name, case in get_cases(sql, sizes, cases.get_random(seed + 1)).items():
+        logger.info("Running %s.%s", service, case_name)
+        results[case_name] = await harness.time_case(case, iterations, warmup)
+    await sql.database.engine.dispose()
+    return {
+        "dataset": sizes,
+        "database": database_path,
+        "generate_seconds": generate_seconds,
+        "cases": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks.runner")
+    parser.add_argument("service", choices=sorted(cases.SERVICES))
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--data-dir", default=os.path.join(REPOSITORY_DIR, "benchmarks", "data"))
+    parser.add_argument("--regenerate", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    # The services log at DEBUG/INFO on every query and message: only the benchmark logs
+    for logger_name in ("sql", "routers", "sqlalchemy"):
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+    result = asyncio.run(run_service(
+        args.service, args.scale, args.iterations, args.warmup, args.data_dir, args.regenerate, args.seed
+    ))
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
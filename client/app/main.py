@@ -4,9 +4,9 @@ import logging
 import os
 import json
 from fastapi import FastAPI
-from routers import main_router, rabbitmq, security, rabbitmq_publish_logs
-from sql import models, database
-from consulService.BLConsul import register_consul_service
+from routers import main_router, rabbitmq, security, rabbitmq_publish_logs, rabbitmq_connection, metrics, password_hashing, key_manager
+from sql import models, database, migrations
+from consulService.BLConsul import register_consul_service, start_service_refresh, stop_service_refresh
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -41,6 +41,9 @@ app = FastAPI(
 )
 
 app.include_router(main_router.router)
+# Latency of every request, scraped from GET /client/metrics
+app.middleware("http")(metrics.metrics_middleware)
+metrics.instrument_database(database)
 
 
 @app.on_event("startup")
@@ -48,19 +51,20 @@ async def startup_event():
     """Configuration to be executed when FastAPI server starts."""
     try:
         logger.info("Creating database tables")
-        async with database.engine.begin() as conn:
-            await conn.run_sync(models.Base.metadata.create_all)
-        ## GENERAR CLAVES
-        security.generar_claves()
+        await migrations.run_migrations()
+        ## CARGAR CLAVES (se generan solo la primera vez)
+        key_created = key_manager.load_keys()
         await rabbitmq.subscribe_channel()
         await rabbitmq_publish_logs.subscribe_channel()
-        register_consul_service()
-        data = {
-            "message": "public key creado!!"
-        }
-        message_body = json.dumps(data)
-        routing_key = "client.key_created"
-        await rabbitmq.publish_event(message_body, routing_key)
+        await register_consul_service()
+        start_service_refresh()
+        if key_created:
+            data = {
+                "message": "public key creado!!"
+            }
+            message_body = json.dumps(data)
+            routing_key = "client.key_created"
+            await rabbitmq.publish_event(message_body, routing_key)
         data2 = {
             "message": "INFO - Servicio Delivery inicializado correctamente"
         }
@@ -76,6 +80,15 @@ async def startup_event():
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources when FastAPI server stops."""
+    await stop_service_refresh()
+    await rabbitmq_publish_logs.close_log_publisher()
+    await rabbitmq_connection.close()
+    password_hashing.hash_executor.shutdown(wait=False)
+
+
 # Main #############################################################################################
 # If application is run as script, execute uvicorn on port 8000
 if __name__ == "__main__":
@@ -0,0 +1,188 @@
+import base64
+import json
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from os import environ
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+logger = logging.getLogger(__name__)
+
+# JWT signing keys: persisted in JWT_KEYS_DIR so the tokens survive a restart. After a rotation the
+# old key keeps being published (JWKS) for JWT_KEY_OVERLAP seconds, so its tokens stay valid.
+JWT_KEYS_DIR = environ.get("JWT_KEYS_DIR", "keys")
+JWT_KEY_OVERLAP = float(environ.get("JWT_KEY_OVERLAP", str(3 * 3600)))
+KEYS_INDEX_FILE = "keys.json"
+# Key generated by the versions without key manager, adopted as the first key
+LEGACY_PRIVATE_KEY_FILE = "private_key.pem"
+
+# (kid, private key) swapped together on rotation
+signing_key = (None, None)
+# kid -> public key / public key PEM of every published key, the signing key first
+public_keys = {}
+public_key_pems = {}
+jwks = {"keys": []}
+
+
+def generate_private_key():
+    return rsa.generate_private_key(
+        public_exponent=65537,
+        key_size=2048,
+    )
+
+
+def get_key_path(kid):
+    return os.path.join(JWT_KEYS_DIR, f"{kid}.pem")
+
+
+def read_index():
+    index_path = os.path.join(JWT_KEYS_DIR, KEYS_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return {"active": None, "keys": {}}
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+
+def write_index(index):
+    # Write and rename so a crash never leaves a half written index
+    index_path = os.path.join(JWT_KEYS_DIR, KEYS_INDEX_FILE)
+    with open(index_path + ".tmp", 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def store_private_key(private_key):
+    """Persist a new private key and return its kid."""
+    kid = uuid.uuid4().hex
+    # Serializar la clave privada en formato PKCS #8
+    private_key_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+    key_path = get_key_path(kid)
+    with open(key_path, 'wb') as private_key_file:
+        private_key_file.write(private_key_pem)
+    os.chmod(key_path, 0o600)
+    return kid
+
+
+def load_private_key(kid):
+    with open(get_key_path(kid), 'rb') as private_key_file:
+        return serialization.load_pem_private_key(private_key_file.read(), password=None)
+
+
+def int_to_base64url(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def get_jwk(kid, public_key):
+    numbers = public_key.public_numbers()
+    return {
+        "kty": "RSA",
+        "use": "sig",
+        "alg": "RS256",
+        "kid": kid,
+        "n": int_to_base64url(numbers.n),
+        "e": int_to_base64url(numbers.e),
+    }
+
+
+def purge_retired_keys(index):
+    """Forget the keys retired more than JWT_KEY_OVERLAP seconds ago."""
+    limit = datetime.utcnow() - timedelta(seconds=JWT_KEY_OVERLAP)
+    for kid, key_info in list(index["keys"].items()):
+        if key_info["retired"] is not None and datetime.fromisoformat(key_info["retired"]) < limit:
+            del index["keys"][kid]
+            if os.path.exists(get_key_path(kid)):
+                os.remove(get_key_path(kid))
+            logger.info("Removed signing key %s", kid)
+
+
+def apply_index(index):
+    """Load the keys of the index in memory: the active one signs, all of them are published."""
+    global signing_key, public_keys, public_key_pems, jwks
+    active_kid = index["active"]
+    private_keys = {kid: load_private_key(kid) for kid in index["keys"]}
+    # The signing key first, so a verifier without kid support uses it
+    kids = [active_kid] + [kid for kid in index["keys"] if kid != active_kid]
+    new_public_keys = {kid: private_keys[kid].public_key() for kid in kids}
+    new_public_key_pems = {
+        kid: public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.PKCS1
+        )
+        for kid, public_key in new_public_keys.items()
+    }
+    signing_key = (active_kid, private_keys[active_kid])
+    public_keys, public_key_pems = new_public_keys, new_public_key_pems
+    jwks = {"keys": [get_jwk(kid, public_key) for kid, public_key in new_public_keys.items()]}
+
+
+def add_active_key(index, private_key):
+    """Store the key, make it the signing key and retire the previous one."""
+    kid = store_private_key(private_key)
+    now = datetime.utcnow().isoformat()
+    if index["active"] is not None:
+        index["keys"][index["active"]]["retired"] = now
+    index["keys"][kid] = {"created": now, "retired": None}
+    index["active"] = kid
+    return kid
+
+
+def load_keys():
+    """Load the persisted keys, creating the first one if there is none. Returns True if it was created."""
+    os.makedirs(JWT_KEYS_DIR, exist_ok=True)
+    index = read_index()
+    created = False
+    if index["active"] is None:
+        if os.path.exists(LEGACY_PRIVATE_KEY_FILE):
+            with open(LEGACY_PRIVATE_KEY_FILE, 'rb') as private_key_file:
+                private_key = serialization.load_pem_private_key(private_key_file.read(), password=None)
+            logger.info("Adopting %s as the first signing key", LEGACY_PRIVATE_KEY_FILE)
+        else:
+            private_key = generate_private_key()
+            created = True
+        add_active_key(index, private_key)
+    purge_retired_keys(index)
+    write_index(index)
+    apply_index(index)
+    logger.info("Loaded %i signing keys, active %s", len(index["keys"]), index["active"])
+    return created
+
+
+def rotate_key():
+    """Sign with a new key; the previous one is still published during the overlap. Returns the new kid."""
+    index = read_index()
+    kid = add_active_key(index, generate_private_key())
+    purge_retired_keys(index)
+    write_index(index)
+    apply_index(index)
+    logger.info("Rotated the signing key, active %s", kid)
+    return kid
+
+
+def sign_token(payload:dict):
+    """Sign the payload with the active key, with its kid in the header."""
+    kid, private_key = signing_key
+    return jwt.encode(payload, private_key, algorithm='RS256', headers={"kid": kid})
+
+
+def get_public_key(kid=None):
+    """Public key object to verify a token with the given kid (the signing key if there is no kid)."""
+    if kid is None:
+        kid = signing_key[0]
+    return public_keys.get(kid)
+
+
+def get_public_key_pem():
+    """PEM of the public key of the signing key."""
+    return public_key_pems.get(signing_key[0], b"")
+
+
+def get_jwks():
+    return jwks
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 """FastAPI router definitions."""
+import asyncio
 import logging
 from typing import List
-from fastapi import APIRouter, Depends, status, Header, Query
+from fastapi import APIRouter, Depends, status, Header, Query, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from dependencies import get_db
-from routers import security
+from routers import security, metrics, password_hashing, key_manager, rabbitmq
 from sql import crud, schemas
 from routers.router_utils import raise_and_log_error
 from routers import rabbitmq_publish_logs
@@ -20,6 +21,10 @@ from datetime import datetime, timedelta
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Client list page size
+CLIENT_LIST_DEFAULT_LIMIT = 50
+CLIENT_LIST_MAX_LIMIT = 500
+
 
 @router.get(
     "/client/health",
@@ -32,6 +37,17 @@ async def health_check():
     return {"detail": "Service Healthy."}
 
 
+@router.get(
+    "/client/metrics",
+    summary="Metrics in Prometheus text format",
+    response_class=Response,
+)
+async def get_metrics():
+    """Endpoint scraped by Prometheus: request latency, consumers, publishes and database."""
+    logger.debug("GET '/client/metrics' endpoint called.")
+    return metrics.get_metrics_response()
+
+
 @router.post(
     "/client",
     response_model=schemas.Client,
@@ -40,55 +56,28 @@ async def health_check():
     tags=["Client"]
 )
 async def create_client(
+        request: Request,
         client_schema: schemas.ClientPost,
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        token: str = Header(None, description="JWT Token in the Header")
 ):
     """Create single client endpoint."""
     logger.debug("POST '/client' endpoint called.")
+    # Permitir acceso para crear un administrador, en caso de que borremos DB:
+    if (client_schema.username == "joxemai" and client_schema.password == "joxemai"):
+        client_schema.role = 1
+    else:
+        # Solo un administrador puede crear clientes (security.ROUTE_POLICIES)
+        await security.authorize(request, token)
     try:
-        # Permitir acceso para crear un administrador, en caso de que borremos DB:
-        if (client_schema.username == "joxemai" and client_schema.password == "joxemai"):
-            client_schema.role = 1
-            db_client = await crud.create_client(db, client_schema)
-            data = {
-                "message": "INFO - Client created"
-            }
-            message_body = json.dumps(data)
-            routing_key = "client.main_router_create_client.info"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            return db_client
-        # Decodificar el token
-        payload = security.decode_token(token)
-        # Validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-            data = {
-                "message": "ERROR - The token is expired, log in again"
-            }
-            message_body = json.dumps(data)
-            routing_key = "client.main_router_create_client.error"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-        else:
-            es_admin = security.validar_es_admin(payload)
-            if(es_admin):
-                db_client = await crud.create_client(db, client_schema)
-                data = {
-                    "message": "INFO - Client created"
-                }
-                message_body = json.dumps(data)
-                routing_key = "client.main_router_create_client.info"
-                await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                return db_client 
-            else:
-                data = {
-                    "message": "ERROR - You don't have permissions"
-                }
-                message_body = json.dumps(data)
-                routing_key = "client.main_router_create_client.error"
-                await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
+        db_client = await crud.create_client(db, client_schema)
+        data = {
+            "message": "INFO - Client created"
+        }
+        message_body = json.dumps(data)
+        routing_key = "client.main_router_create_client.info"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        return db_client
     except Exception as exc:  # @ToDo: To broad exception
         data = {
             "message": "ERROR - Error creating client"
@@ -110,42 +99,20 @@ async def update_client(
         client_schema: schemas.ClientUpdatePost,
         client_id: int = Query(..., description="Client ID"),
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        principal: dict = Depends(security.get_principal)
 ):
     """Update single client endpoint."""
     logger.debug("POST '/client/update' endpoint called.")
+    await security.require_owner_or_admin(principal, client_id)
     try:
-        # Decodificar el token
-        payload = security.decode_token(token)
-        # Validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-            data = {
-                "message": "ERROR - The token is expired, log in again"
-            }
-            message_body = json.dumps(data)
-            routing_key = "client.main_router_update_client.error"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-        else:
-            es_admin = security.validar_es_admin(payload)
-            client_id_token = payload["id_client"]
-            if(es_admin==False and client_id!=client_id_token):
-                data = {
-                    "message": "ERROR - You don't have permissions"
-                }
-                message_body = json.dumps(data)
-                routing_key = "client.main_router_update_client.error"
-                await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
-            db_client = await crud.update_client(db, client_id, client_schema)
-            data = {
-                "message": "INFO - Client updated"
-            }
-            message_body = json.dumps(data)
-            routing_key = "client.main_router_update_client.info"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            return db_client
+        db_client = await crud.update_client(db, client_id, client_schema)
+        data = {
+            "message": "INFO - Client updated"
+        }
+        message_body = json.dumps(data)
+        routing_key = "client.main_router_update_client.info"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        return db_client
     except Exception as exc:  # @ToDo: To broad exception
         data = {
             "message": "ERROR - Error updating client"
@@ -192,35 +159,24 @@ async def update_client(
     tags=['Client']
 )
 async def get_single_client(
+        response: Response,
         client_id: int = Query(None, description="Client ID"),
+        after_id: int = Query(None, description="List: return the clients after this ID (cursor)"),
+        limit: int = Query(CLIENT_LIST_DEFAULT_LIMIT, ge=1, le=CLIENT_LIST_MAX_LIMIT, description="List: page size"),
+        postal_code: int = Query(None, description="List: filter by postal code"),
+        role: int = Query(None, description="List: filter by role"),
+        fields: str = Query(None, description="List: comma separated columns to return"),
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        principal: dict = Depends(security.get_principal)
 ):
-    """Retrieve single client by id"""
+    """Retrieve single client by id, or a page of the client list (admin only).
+
+    The list is ordered by id; when there are more clients the X-Next-Cursor header holds the
+    after_id of the next page.
+    """
     logger.debug("GET '/client/%i' endpoint called.", client_id)
 
     if client_id is not None:
-        payload = security.decode_token(token)
-        # validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-            data = {
-                "message": "ERROR - The token is expired, log in again"
-            }
-            message_body = json.dumps(data)
-            routing_key = "client.main_router_get_single_client.error"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-        else:
-            es_admin = security.validar_es_admin(payload)
-            if(es_admin==False):
-                data = {
-                    "message": "ERROR - You don't have permissions"
-                }
-                message_body = json.dumps(data)
-                routing_key = "client.main_router_get_single_client.error"
-                await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
         client = await crud.get_client(db, client_id)
         if not client:
             data = {
@@ -238,7 +194,15 @@ async def get_single_client(
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
         return client
     else:
-        client_list = await crud.get_client_list(db)
+        field_list = None
+        if fields is not None:
+            field_list = [field.strip() for field in fields.split(",") if field.strip()]
+            unknown_fields = set(field_list) - set(crud.CLIENT_LIST_FIELDS)
+            if unknown_fields:
+                raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+        client_list = await crud.get_client_page(db, after_id, limit, postal_code, role, field_list)
+        if len(client_list) == limit:
+            response.headers["X-Next-Cursor"] = str(client_list[-1]["id_client"])
         data = {
             "message": "INFO - Client list obtained"
         }
@@ -263,8 +227,8 @@ async def get_token(
     try:
         username = request_data.username
         password = request_data.password
-        # Realiza la autenticación aquí (sustituye esto con tu lógica real)
-        client = await crud.get_client_by_username_and_pass(db, username, password)
+        # La contraseña se verifica en el pool de hashing (password_hashing)
+        client = await crud.authenticate_client(db, username, password)
         if not client:
             authenticated = False
             data = {
@@ -284,12 +248,10 @@ async def get_token(
             authenticated = True
         if authenticated:
             # Aquí puedes generar un token JWT si la autenticación es exitosa
-            with open('private_key.pem', 'rb') as private_key_file:
-                private_key_pem = private_key_file.read()
             expiration_time = datetime.utcnow() + timedelta(hours=3)
             expiration_time_serializable = expiration_time.isoformat()
             payload = {'username': client.username, 'id_client':client.id_client, 'email':client.email, 'role': client.role, 'fecha_expiracion': expiration_time_serializable}
-            token = jwt.encode(payload, private_key_pem, algorithm='RS256')
+            token = key_manager.sign_token(payload)
             data = {
                 "message": "INFO - Token generated"
             }
@@ -304,7 +266,15 @@ async def get_token(
             message_body = json.dumps(data)
             routing_key = "client.main_router_get_token.error"
             await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            return {"message": "Credenciales incorrectas"}, 401    
+            return {"message": "Credenciales incorrectas"}, 401
+    except password_hashing.LoginOverloadedError as exc:
+        data = {
+            "message": "ERROR - Too many concurrent logins"
+        }
+        message_body = json.dumps(data)
+        routing_key = "client.main_router_get_token.error"
+        await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+        raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, f"{exc}")
     except Exception as exc:
         data = {
             "message": "ERROR - Error generating the token"
@@ -330,11 +300,44 @@ async def get_token(
     tags=['Client']
 )
 async def get_public_key():
-    """Retrieve public key"""
+    """Retrieve the public key of the signing key"""
     logger.debug("GET '/client/key' endpoint called.")
     return security.get_public_key()
 
 
+@router.get(
+    "/client/jwks",
+    summary="Retrieve the public keys as a JWKS",
+    tags=['Client']
+)
+async def get_jwks():
+    """Retrieve every published public key, by kid. The first one is the signing key."""
+    logger.debug("GET '/client/jwks' endpoint called.")
+    return key_manager.get_jwks()
+
+
+@router.post(
+    "/client/keys/rotate",
+    summary="Rotate the token signing key",
+    response_model=schemas.Message,
+    tags=['Client']
+)
+async def rotate_signing_key(
+        principal: dict = Depends(security.get_principal)
+):
+    """Sign the new tokens with a new key (admin only). The previous key stays published during the overlap."""
+    logger.debug("POST '/client/keys/rotate' endpoint called.")
+    # Generating the RSA key is CPU bound, out of the event loop
+    kid = await asyncio.to_thread(key_manager.rotate_key)
+    data = {
+        "message": "public key creado!!"
+    }
+    message_body = json.dumps(data)
+    routing_key = "client.key_created"
+    await rabbitmq.publish_event(message_body, routing_key)
+    return {"detail": f"Signing key rotated, new kid {kid}."}
+
+
 # Función para autenticar al usuario (solo como ejemplo)
 def authenticate(username, password):
     # Aquí puedes agregar lógica de autenticación, como verificar en una base de datos
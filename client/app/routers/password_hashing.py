@@ -0,0 +1,95 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+logger = logging.getLogger(__name__)
+
+# Password hashing: scrypt runs in a small dedicated thread pool so it never blocks the event loop,
+# and at most AUTH_MAX_CONCURRENT_LOGINS logins wait for it; the rest are rejected after
+# AUTH_ADMISSION_TIMEOUT seconds instead of queueing without bound.
+AUTH_HASH_WORKERS = int(environ.get("AUTH_HASH_WORKERS", '2'))
+AUTH_MAX_CONCURRENT_LOGINS = int(environ.get("AUTH_MAX_CONCURRENT_LOGINS", '16'))
+AUTH_ADMISSION_TIMEOUT = float(environ.get("AUTH_ADMISSION_TIMEOUT", '1'))
+SCRYPT_N = int(environ.get("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(environ.get("SCRYPT_R", '8'))
+SCRYPT_P = int(environ.get("SCRYPT_P", '1'))
+SCRYPT_SALT_SIZE = 16
+SCRYPT_KEY_SIZE = 32
+HASH_PREFIX = "scrypt"
+
+# Checked when the username does not exist, so the login takes as long (and is admitted the same
+# way) as with a wrong password. Well-formed, with the current parameters; no password matches it.
+DUMMY_PASSWORD_HASH = "$".join([
+    HASH_PREFIX, str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P),
+    base64.b64encode(bytes(SCRYPT_SALT_SIZE)).decode(), base64.b64encode(bytes(SCRYPT_KEY_SIZE)).decode()
+])
+
+hash_executor = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="password_hashing")
+login_semaphore = asyncio.Semaphore(AUTH_MAX_CONCURRENT_LOGINS)
+
+
+class LoginOverloadedError(Exception):
+    """Too many logins are waiting for the password hashing pool."""
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode()
+
+
+def scrypt(password, salt, n, r, p):
+    # maxmem must fit the 128 * n * r bytes scrypt needs
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=SCRYPT_KEY_SIZE
+    )
+
+
+def hash_password_sync(password):
+    """Hash the password as scrypt$n$r$p$salt$key (salt and key in base64)."""
+    salt = os.urandom(SCRYPT_SALT_SIZE)
+    key = scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"{HASH_PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${b64encode(salt)}${b64encode(key)}"
+
+
+def is_hashed(stored_password):
+    return stored_password is not None and stored_password.startswith(HASH_PREFIX + "$")
+
+
+def verify_password_sync(password, stored_password):
+    """Check the password against the stored one. Returns (is valid, needs rehash).
+
+    Passwords stored before hashing existed are compared as plaintext and need a rehash.
+    """
+    if not is_hashed(stored_password):
+        return hmac.compare_digest(password.encode(), (stored_password or "").encode()), True
+    _, n, r, p, salt, key = stored_password.split("$")
+    n, r, p = int(n), int(r), int(p)
+    new_key = scrypt(password, base64.b64decode(salt), n, r, p)
+    is_valid = hmac.compare_digest(new_key, base64.b64decode(key))
+    return is_valid, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+async def hash_password(password):
+    """Hash the password in the hashing pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hash_executor, hash_password_sync, password)
+
+
+async def verify_password(password, stored_password):
+    """Verify the password in the hashing pool, if there is room for one more login.
+
+    Raises LoginOverloadedError when the admission limit is not available in AUTH_ADMISSION_TIMEOUT.
+    """
+    try:
+        await asyncio.wait_for(login_semaphore.acquire(), AUTH_ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise LoginOverloadedError("Too many concurrent logins, try again later")
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(hash_executor, verify_password_sync, password, stored_password)
+    finally:
+        login_semaphore.release()
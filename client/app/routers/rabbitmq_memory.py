@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-in for RabbitMQ, used when RABBITMQ_BACKEND=memory.
+
+It implements the part of the aio_pika API the service uses (topic exchanges, queues, bindings,
+prefetch, ack/nack/reject and dead-lettering) on asyncio primitives, so the consumers and publishers
+run unchanged, without a broker, in tests and throughput benchmarks. Nothing is persisted.
+"""
+import asyncio
+import itertools
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+broker = None
+
+
+class ChannelClosedError(Exception):
+    """Raised when a message is published to an exchange that was not declared."""
+
+
+def match_words(binding_words, routing_words):
+    if not binding_words:
+        return not routing_words
+    word = binding_words[0]
+    if word == "#":
+        # Zero or more words
+        return any(match_words(binding_words[1:], routing_words[i:]) for i in range(len(routing_words) + 1))
+    if not routing_words:
+        return False
+    return (word == "*" or word == routing_words[0]) and match_words(binding_words[1:], routing_words[1:])
+
+
+@lru_cache(maxsize=4096)
+def topic_matches(binding_key, routing_key):
+    """AMQP topic matching: * matches exactly one word, # matches zero or more words."""
+    return match_words(tuple(binding_key.split(".")), tuple(routing_key.split(".")))
+
+
+class MemoryBroker:
+    """Exchanges and queues shared by every connection of the process."""
+
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.delivery_tags = itertools.count(1)
+
+    def declare_exchange(self, name, type='topic'):
+        if name not in self.exchanges:
+            self.exchanges[name] = MemoryExchange(self, name, type)
+        return self.exchanges[name]
+
+    def declare_queue(self, name, arguments=None):
+        if name not in self.queues:
+            self.queues[name] = MemoryQueue(self, name, arguments or {})
+        return self.queues[name]
+
+    def route(self, exchange_name, body, routing_key, message_id=None, content_type=None):
+        """Copy the message to every queue bound with a matching key. Unroutable messages are dropped."""
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            raise ChannelClosedError(f"NOT_FOUND - no exchange '{exchange_name}'")
+        routed_queues = {
+            queue.name: queue for binding_key, queue in exchange.bindings
+            if topic_matches(binding_key, routing_key)
+        }
+        for queue in routed_queues.values():
+            queue.put(MemoryMessageData(body, routing_key, exchange_name, message_id, content_type))
+        return len(routed_queues)
+
+
+class MemoryMessageData:
+    __slots__ = ("body", "routing_key", "exchange", "message_id", "content_type", "redelivered")
+
+    def __init__(self, body, routing_key, exchange, message_id=None, content_type=None):
+        self.body = body
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.message_id = message_id
+        self.content_type = content_type
+        self.redelivered = False
+
+
+class MemoryExchange:
+
+    def __init__(self, broker, name, type):
+        self.broker = broker
+        self.name = name
+        self.type = type
+        # (binding key, queue)
+        self.bindings = []
+
+    def bind(self, queue, routing_key):
+        if (routing_key, queue) not in self.bindings:
+            self.bindings.append((routing_key, queue))
+
+
+class MemoryQueue:
+
+    def __init__(self, broker, name, arguments):
+        self.broker = broker
+        self.name = name
+        self.arguments = arguments
+        self.messages = deque()
+        # Futures of the consumers waiting for a message, served in order
+        self.waiters = deque()
+
+    def put(self, message_data, first=False):
+        # Hand the message straight to a waiting consumer if there is one
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(message_data)
+                return
+        if first:
+            self.messages.appendleft(message_data)
+        else:
+            self.messages.append(message_data)
+
+    async def get_message(self):
+        if self.messages:
+            return self.messages.popleft()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Cancelled after the message was handed over: give it to the next consumer
+            if waiter.done() and not waiter.cancelled():
+                self.put(waiter.result(), first=True)
+            raise
+
+    def dead_letter(self, message_data):
+        """Route a rejected message to the dead letter exchange of the queue, if it has one."""
+        exchange_name = self.arguments.get("x-dead-letter-exchange")
+        if exchange_name is None or exchange_name not in self.broker.exchanges:
+            return
+        routing_key = self.arguments.get("x-dead-letter-routing-key", message_data.routing_key)
+        self.broker.route(
+            exchange_name, message_data.body, routing_key,
+            message_id=message_data.message_id, content_type=message_data.content_type
+        )
+
+
+class MemoryQueueProxy:
+    """Queue as seen from one channel: the prefetch of the channel applies to its consumers."""
+
+    def __init__(self, channel, queue):
+        self.channel = channel
+        self.queue = queue
+        self.name = queue.name
+
+    async def bind(self, exchange, routing_key):
+        exchange_name = exchange if isinstance(exchange, str) else exchange.name
+        self.channel.broker.exchanges[exchange_name].bind(self.queue, routing_key)
+
+    def iterator(self):
+        return MemoryQueueIterator(self.channel, self.queue)
+
+
+class MemoryQueueIterator:
+
+    def __init__(self, channel, queue):
+        self.channel = channel
+        self.queue = queue
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.channel.is_closed:
+            raise StopAsyncIteration
+        await self.channel.wait_for_prefetch()
+        message_data = await self.queue.get_message()
+        return self.channel.deliver(self.queue, message_data)
+
+
+class MemoryIncomingMessage:
+    """Delivered message with the aio_pika.IncomingMessage interface used by the handlers."""
+
+    def __init__(self, channel, queue, message_data, delivery_tag):
+        self.channel = channel
+        self.queue = queue
+        self.message_data = message_data
+        self.delivery_tag = delivery_tag
+        self.processed = False
+
+    body = property(lambda self: self.message_data.body)
+    routing_key = property(lambda self: self.message_data.routing_key)
+    exchange = property(lambda self: self.message_data.exchange)
+    message_id = property(lambda self: self.message_data.message_id)
+    content_type = property(lambda self: self.message_data.content_type)
+    redelivered = property(lambda self: self.message_data.redelivered)
+
+    def settle(self):
+        if self.processed:
+            raise RuntimeError("Message already processed")
+        self.processed = True
+        self.channel.release()
+
+    async def ack(self, multiple=False):
+        self.settle()
+
+    async def nack(self, multiple=False, requeue=True):
+        self.settle()
+        if requeue:
+            self.message_data.redelivered = True
+            self.queue.put(self.message_data, first=True)
+        else:
+            self.queue.dead_letter(self.message_data)
+
+    async def reject(self, requeue=False):
+        await self.nack(requeue=requeue)
+
+    @asynccontextmanager
+    async def process(self, requeue=False, reject_on_redelivered=False, ignore_processed=False):
+        """Ack when the block ends, reject if it raises (same as aio_pika)."""
+        try:
+            yield self
+        except BaseException:
+            if not self.processed:
+                await self.reject(requeue=requeue)
+            raise
+        if not (ignore_processed and self.processed):
+            await self.ack()
+
+
+class MemoryChannel:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self.unacked = 0
+        # Futures of the consumers waiting for the unacked messages to go below the prefetch
+        self.prefetch_waiters = deque()
+        self.is_closed = False
+
+    async def set_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    async def declare_exchange(self, name, type='topic', durable=False, **kwargs):
+        self.broker.declare_exchange(name, type)
+        return MemoryExchangeProxy(self.broker, name)
+
+    async def get_exchange(self, name, ensure=True):
+        if ensure and name not in self.broker.exchanges:
+            raise ChannelClosedError(f"NOT_FOUND - no exchange '{name}'")
+        return MemoryExchangeProxy(self.broker, name)
+
+    async def declare_queue(self, name, durable=False, exclusive=False, arguments=None, **kwargs):
+        return MemoryQueueProxy(self, self.broker.declare_queue(name, arguments))
+
+    async def wait_for_prefetch(self):
+        while self.prefetch_count and self.unacked >= self.prefetch_count:
+            waiter = asyncio.get_running_loop().create_future()
+            self.prefetch_waiters.append(waiter)
+            await waiter
+
+    def deliver(self, queue, message_data):
+        self.unacked += 1
+        return MemoryIncomingMessage(self, queue, message_data, next(self.broker.delivery_tags))
+
+    def release(self):
+        self.unacked -= 1
+        while self.prefetch_waiters:
+            waiter = self.prefetch_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def close(self):
+        self.is_closed = True
+
+
+class MemoryExchangeProxy:
+    """Exchange looked up by name on publish, like aio_pika.Exchange with ensure=False."""
+
+    def __init__(self, broker, name):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key, **kwargs):
+        self.broker.route(
+            self.name, message.body, routing_key,
+            message_id=message.message_id, content_type=message.content_type
+        )
+
+
+class MemoryConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+
+    async def channel(self, publisher_confirms=True, **kwargs):
+        return MemoryChannel(self)
+
+    async def close(self):
+        self.is_closed = True
+
+
+def get_broker():
+    """Broker of the process, shared by all its connections."""
+    global broker
+    if broker is None:
+        broker = MemoryBroker()
+    return broker
+
+
+async def connect(**kwargs):
+    """Same role as aio_pika.connect_robust; the connection parameters are ignored."""
+    return MemoryConnection(get_broker())
+
+
+def reset():
+    """Forget every exchange, queue and message (between benchmark or test runs)."""
+    global broker
+    broker = None
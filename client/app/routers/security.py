@@ -1,5 +1,6 @@
 import cryptography
-from fastapi import APIRouter, Depends, status, Header
+from fastapi import APIRouter, Depends, status, Header, HTTPException, Request
+import json
 import logging
 import jwt
 from datetime import datetime, timedelta
@@ -7,54 +8,65 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from routers.router_utils import raise_and_log_error
-import json
+from routers import rabbitmq_publish_logs, key_manager
+from collections import OrderedDict
+from os import environ
+import time
 
 logger = logging.getLogger(__name__)
 
+# Token cache: decoded payloads are kept until the token expires (at most TOKEN_CACHE_TTL seconds)
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", '1024'))
+TOKEN_CACHE_TTL = float(environ.get("TOKEN_CACHE_TTL", '300'))
+token_cache = OrderedDict()
 
-def generar_claves():
-    private_key = rsa.generate_private_key(
-        public_exponent=65537,
-        key_size=2048,
-    )
-
-    # Serializar la clave privada en formato PKCS #8
-    private_key_pem = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-
-    # Almacenar la clave privada en un archivo
-    with open('private_key.pem', 'wb') as private_key_file:
-        private_key_file.write(private_key_pem)
-
-    # Generar la clave pública correspondiente
-    public_key = private_key.public_key()
 
-    # Serializar la clave pública en formato PKCS #8
-    public_key_pem = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.PKCS1
-    )
+def get_verification_key(token:str):
+    """Public key of the kid of the token; tokens without kid were signed by the signing key."""
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+    except jwt.PyJWTError:
+        kid = None
+    return key_manager.get_public_key(kid) or key_manager.get_public_key()
 
-    # Almacenar la clave pública en un archivo
-    with open('public_key.pem', 'wb') as public_key_file:
-        public_key_file.write(public_key_pem)
+def get_cached_payload(token:str):
+    entry = token_cache.get(token)
+    if entry is None:
+        return None
+    payload, expires_at = entry
+    if expires_at <= time.monotonic():
+        token_cache.pop(token, None)
+        return None
+    token_cache.move_to_end(token)
+    return payload
 
-def decode_token(token:str):
+def cache_payload(token:str, payload:dict):
+    # Nunca se guarda un token más allá de su fecha de expiración
     try:
-        with open('public_key.pem', 'rb') as public_key_file:
-                public_key_client_pem = public_key_file.read()
+        exp_datetime = datetime.fromisoformat(payload["fecha_expiracion"])
+    except (KeyError, TypeError, ValueError):
+        return
+    ttl = min(TOKEN_CACHE_TTL, (exp_datetime - datetime.utcnow()).total_seconds())
+    if ttl <= 0:
+        return
+    token_cache[token] = (payload, time.monotonic() + ttl)
+    token_cache.move_to_end(token)
+    while len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
 
-        payload = json.loads(json.dumps(jwt.decode(token, public_key_client_pem, ['RS256'])))
+def decode_token(token:str):
+    payload = get_cached_payload(token)
+    if payload is not None:
         return payload
+    try:
+        payload = jwt.decode(token, get_verification_key(token), ['RS256'])
     except Exception as exc:  # @ToDo: To broad exception
-        raise_and_log_error(logger, status.HTTP_403_CONFLICT, f"Error decoding the token: {exc}")
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error decoding the token: {exc}")
+    cache_payload(token, payload)
+    return payload
 
 def get_public_key():
-    with open('public_key.pem', 'rb') as public_key_file:
-        return public_key_file.read()
+    return key_manager.get_public_key_pem()
 
 def validar_fecha_expiracion(payload:dict):
     # Obtiene la fecha de expiración del token
@@ -78,3 +90,80 @@ def validar_es_admin(payload:dict):
         return True
     else:
         return False
+
+# Authorization ####################################################################################
+# Roles required by each route (method, path). Routes not in the table need any valid token;
+# ownership (a client can only access its own data) is checked by the endpoint.
+ROLE_CLIENT = "client"
+ROLE_ADMIN = "admin"
+ROUTE_POLICIES = {
+    ("POST", "/client"): ROLE_ADMIN,
+    ("GET", "/client"): ROLE_ADMIN,
+    ("POST", "/client/keys/rotate"): ROLE_ADMIN,
+}
+route_policy_cache = {}
+
+def get_route_policy(request: Request):
+    """Role required by the route of the request, looked up once per endpoint."""
+    cache_key = (request.method, request.scope.get("endpoint"))
+    policy = route_policy_cache.get(cache_key)
+    if policy is None:
+        policy = ROLE_CLIENT
+        for route in request.app.router.routes:
+            if getattr(route, "endpoint", None) is cache_key[1] and request.method in getattr(route, "methods", ()):
+                policy = ROUTE_POLICIES.get((request.method, route.path), ROLE_CLIENT)
+                break
+        route_policy_cache[cache_key] = policy
+    return policy
+
+async def reject_request(status_code:int, message:str):
+    data = {
+        "message": f"ERROR - {message}"
+    }
+    message_body = json.dumps(data)
+    routing_key = "client.security_authorize.error"
+    await rabbitmq_publish_logs.publish_log(message_body, routing_key)
+    logger.warning(message)
+    headers = {"WWW-Authenticate": "Bearer"} if status_code == status.HTTP_401_UNAUTHORIZED else None
+    raise HTTPException(status_code, message, headers=headers)
+
+async def authorize(request: Request, token:str):
+    """Decode and validate the token once per request and check the role of the route.
+
+    The payload (principal) is cached on request.state; a cached token was already validated and
+    is not expired, so it skips the signature and expiration checks.
+    """
+    principal = getattr(request.state, "principal", None)
+    if principal is not None:
+        return principal
+    if not token:
+        await reject_request(status.HTTP_401_UNAUTHORIZED, "Missing token")
+    principal = get_cached_payload(token)
+    if principal is None:
+        try:
+            principal = jwt.decode(token, get_verification_key(token), ['RS256'])
+        except jwt.PyJWTError as exc:
+            await reject_request(status.HTTP_401_UNAUTHORIZED, f"Invalid token: {exc}")
+        try:
+            is_expirated = validar_fecha_expiracion(principal)
+        except (TypeError, ValueError):
+            is_expirated = True
+        if is_expirated:
+            await reject_request(status.HTTP_401_UNAUTHORIZED, "The token is expired, please log in again")
+        cache_payload(token, principal)
+    if get_route_policy(request) == ROLE_ADMIN and not validar_es_admin(principal):
+        await reject_request(status.HTTP_403_FORBIDDEN, "You don't have permissions")
+    request.state.principal = principal
+    return principal
+
+async def get_principal(request: Request, token:str = Header(None, description="JWT Token in the Header")):
+    """FastAPI dependency: the validated token payload of the request."""
+    return await authorize(request, token)
+
+async def require_admin(principal:dict):
+    if not validar_es_admin(principal):
+        await reject_request(status.HTTP_403_FORBIDDEN, "You don't have permissions")
+
+async def require_owner_or_admin(principal:dict, client_id):
+    if not validar_es_admin(principal) and principal.get("id_client") != client_id:
+        await reject_request(status.HTTP_403_FORBIDDEN, "You don't have permissions")
@@ -7,6 +7,7 @@ from sqlalchemy.future import select
 from . import models
 import json
 from routers.rabbitmq import publish_event
+from routers import password_hashing
 
 logger = logging.getLogger(__name__)
 
@@ -41,12 +42,11 @@ async def get_element_by_id(db: AsyncSession, model, element_id):
     element = await db.get(model, element_id)
     return element
 
-async def get_element_by_username_and_pass(db: AsyncSession, model, username, password):
-    """Retrieve any DB element by id."""
+async def get_element_by_username(db: AsyncSession, model, username):
+    """Retrieve any DB element by username."""
     if username is None:
         return None
-    """Obtener un cliente por nombre de usuario y contraseña."""
-    stmt = select(model).filter(model.username == username, model.password == password)
+    stmt = select(model).filter(model.username == username)
     element = await get_element_statement_result(db, stmt)
     return element
 
@@ -61,6 +61,10 @@ async def delete_element_by_id(db: AsyncSession, model, element_id):
 
 
 # Client functions ##################################################################################
+# Columns that can be requested in the client list (never the password)
+CLIENT_LIST_FIELDS = ("id_client", "username", "email", "address", "postal_code", "role", "creation_date", "update_date")
+
+
 async def get_client_list(db: AsyncSession):
     """Load all the clients from the database."""
     stmt = select(models.Client)
@@ -68,13 +72,55 @@ async def get_client_list(db: AsyncSession):
     return clients
 
 
+async def get_client_page(db: AsyncSession, after_id=None, limit=50, postal_code=None, role=None, fields=None):
+    """Load a page of clients ordered by id, starting after the given id (keyset pagination).
+
+    Only the requested columns are loaded (id_client is always included, it is the cursor).
+    """
+    if fields is None:
+        fields = CLIENT_LIST_FIELDS
+    columns = [models.Client.id_client] + [
+        getattr(models.Client, field) for field in fields if field != "id_client"
+    ]
+    stmt = select(*columns).order_by(models.Client.id_client).limit(limit)
+    if after_id is not None:
+        stmt = stmt.where(models.Client.id_client > after_id)
+    if postal_code is not None:
+        stmt = stmt.where(models.Client.postal_code == postal_code)
+    if role is not None:
+        stmt = stmt.where(models.Client.role == role)
+    result = await db.execute(stmt)
+    return [dict(row._mapping) for row in result]
+
+
 async def get_client(db: AsyncSession, client_id):
     """Load a client from the database."""
     return await get_element_by_id(db, models.Client, client_id)
 
-async def get_client_by_username_and_pass(db: AsyncSession, username, password):
+async def get_client_by_username(db: AsyncSession, username):
     """Load a client from the database."""
-    return await get_element_by_username_and_pass(db, models.Client, username, password)
+    return await get_element_by_username(db, models.Client, username)
+
+
+async def authenticate_client(db: AsyncSession, username, password):
+    """Load the client if the password is valid, None otherwise.
+
+    A password stored in plaintext (or with old scrypt parameters) is rehashed on a successful login.
+    """
+    db_client = await get_client_by_username(db, username)
+    if db_client is None:
+        # Same scrypt work as a wrong password, so the response time does not tell which usernames exist
+        await password_hashing.verify_password(password, password_hashing.DUMMY_PASSWORD_HASH)
+        return None
+    is_valid, needs_rehash = await password_hashing.verify_password(password, db_client.password)
+    if not is_valid:
+        return None
+    if needs_rehash:
+        db_client.password = await password_hashing.hash_password(password)
+        await db.commit()
+        await db.refresh(db_client)
+        logger.info("Rehashed the password of client %i", db_client.id_client)
+    return db_client
 
 
 async def create_client(db: AsyncSession, client):
@@ -82,7 +128,7 @@ async def create_client(db: AsyncSession, client):
     db_client = models.Client(
         username=client.username,
         email=client.email,
-        password=client.password,
+        password=await password_hashing.hash_password(client.password),
         address=client.address,
         postal_code=client.postal_code,
         role = client.role
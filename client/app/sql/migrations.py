@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Database migrations: create the tables and the indexes of the hot queries."""
+import asyncio
+import logging
+from sqlalchemy import inspect, text
+from .database import Base, engine
+from . import models  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+# Hot queries checked with EXPLAIN QUERY PLAN: (name, query, index it must use)
+HOT_QUERIES = [
+    ("get_client_by_username", "SELECT * FROM clients WHERE username = 'a'", "ix_clients_username"),
+    ("get_client_page", "SELECT id_client FROM clients WHERE postal_code = 20000 AND id_client > 0 ORDER BY id_client LIMIT 50", "ix_clients_postal_code_id_client"),
+]
+
+
+def create_missing_indexes(connection):
+    """Create the indexes declared in the models that do not exist yet in the database."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique and has_duplicates(connection, index):
+                logger.warning("Can not create unique index %s: the table has duplicated values", index.name)
+                continue
+            index.create(connection)
+            logger.info("Created index %s", index.name)
+
+
+def has_duplicates(connection, index):
+    """Check if the columns of the index have duplicated values."""
+    columns = ", ".join(column.name for column in index.columns)
+    stmt = text(
+        f"SELECT {columns} FROM {index.table.name} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 1"
+    )
+    return connection.execute(stmt).first() is not None
+
+
+def explain_hot_queries(connection):
+    """Check that the hot queries use their index. Returns {query name: uses index}."""
+    if connection.dialect.name != "sqlite":
+        return {}
+    results = {}
+    for name, query, index_name in HOT_QUERIES:
+        plan = connection.execute(text(f"EXPLAIN QUERY PLAN {query}")).fetchall()
+        plan_details = " | ".join(str(row[-1]) for row in plan)
+        results[name] = index_name in plan_details
+        if results[name]:
+            logger.info("Query %s uses index %s", name, index_name)
+        else:
+            logger.warning("Query %s does not use index %s: %s", name, index_name, plan_details)
+    return results
+
+
+def migrate(connection):
+    """Create the missing tables and indexes and check the query plans."""
+    Base.metadata.create_all(connection)
+    create_missing_indexes(connection)
+    explain_hot_queries(connection)
+
+
+async def run_migrations():
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate)
+
+
+# Main #############################################################################################
+# Run the migrations from the app directory with: python -m sql.migrations
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_migrations())
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey
+from sqlalchemy import Column, DateTime, Index, Integer, String, TEXT, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -42,8 +42,12 @@ class Client(BaseModel):
     __tablename__ = "clients"
     id_client = Column(Integer, primary_key=True)
     email = Column(TEXT, nullable=False)
-    username = Column(TEXT, nullable=False)
+    username = Column(TEXT, nullable=False, unique=True, index=True)
     password = Column(TEXT, nullable=False)
     address = Column(TEXT, nullable=False)
     postal_code = Column(Integer, nullable=False)
     role = Column(Integer, nullable=False, default=0) # 0 = CLIENT    1 = ADMIN
+
+    __table_args__ = (
+        Index("ix_clients_postal_code_id_client", "postal_code", "id_client"),
+    )
@@ -2,9 +2,9 @@
 """FastAPI router definitions."""
 from fastapi import APIRouter, status, HTTPException
 from consulService.config import Config
-import requests
+import httpx
 import logging
-from consulService.BLConsul import get_consul_service, get_consul_service_replicas, get_consul_key_value_item, get_consul_service_catalog
+from consulService.BLConsul import get_consul_service_async, get_consul_service_replicas, get_consul_key_value_item, get_consul_service_catalog
     
 
 logger = logging.getLogger(__name__)
@@ -18,16 +18,16 @@ router = APIRouter(prefix='/{}/consul'.format(config.SERVICE_NAME))
 @router.get('/call/{external_service_name}')
 async def external_service_response(external_service_name: str):
     logger.info(f"GET external service response from {external_service_name}")
-    service = get_consul_service(external_service_name)
+    service = await get_consul_service_async(external_service_name)
     service['Name'] = external_service_name
 
-    if service is None:
+    if service['Address'] is None:
         raise HTTPException(
             status.HTTP_404_NOT_FOUND,
             "The service does not exist or there is no healthy replica"
         )
 
-    ret_message, status_code = call_external_service(service)
+    ret_message, status_code = await call_external_service(service)
 
     return {
         "message": ret_message,
@@ -47,7 +47,7 @@ async def external_service_response(external_service_name: str):
 )
 async def key_values(key: str):
     logger.info(f"GET {key} from value store")
-    key, value = get_consul_key_value_item(key)
+    key, value = await get_consul_key_value_item(key)
     if value is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, "Item not found")
     return {key: value}
@@ -56,18 +56,18 @@ async def key_values(key: str):
 @router.get('/catalog')
 async def get_catalog():
     logger.info(f"GET consul catalog")
-    catalog = get_consul_service_catalog()
+    catalog = await get_consul_service_catalog()
     return catalog
 
 
 @router.get('/services')
 async def get_services_replicas():
     logger.info(f"GET consul services")
-    replicas = get_consul_service_replicas()
+    replicas = await get_consul_service_replicas()
     return replicas
 
 
-def call_external_service(service):
+async def call_external_service(service):
     logger.debug(f"Calling external service: {service['Name']}")
     url = "http://{host}:{port}/{path}".format(
         host=service['Address'],
@@ -75,11 +75,12 @@ def call_external_service(service):
         path=service['Name']
     )
     try:
-        response = requests.get(url)
-    except requests.exceptions.ConnectionError:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url)
+    except httpx.HTTPError:
         response = None
 
-    if response:
+    if response is not None and response.is_success:
         ret_message = {
             "caller": config.SERVICE_NAME,
             "callerURL": "{}:{}".format(config.IP, config.PORT),
@@ -4,10 +4,10 @@ import logging
 import os
 import json
 from fastapi import FastAPI
-from routers import main_router, rabbitmq, security, rabbitmq_publish_logs
-from sql import models, database
+from routers import main_router, rabbitmq, security, rabbitmq_publish_logs, rabbitmq_connection, delivery_scheduler, metrics, idempotency
+from sql import models, database, migrations
 import asyncio
-from consulService.BLConsul import register_consul_service
+from consulService.BLConsul import register_consul_service, start_service_refresh, stop_service_refresh
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -42,6 +42,9 @@ app = FastAPI(
 )
 
 app.include_router(main_router.router)
+# Latency of every request, scraped from GET /delivery/metrics
+app.middleware("http")(metrics.metrics_middleware)
+metrics.instrument_database(database)
 
 
 @app.on_event("startup")
@@ -49,18 +52,20 @@ async def startup_event():
     try:
         """Configuration to be executed when FastAPI server starts."""
         logger.info("Creating database tables")
-        async with database.engine.begin() as conn:
-            await conn.run_sync(models.Base.metadata.create_all)
+        await migrations.run_migrations()
         await rabbitmq.subscribe_channel()
         await rabbitmq_publish_logs.subscribe_channel()
         asyncio.create_task(rabbitmq.subscribe_key_created())
         await security.get_public_key()
-        register_consul_service()
+        await register_consul_service()
+        start_service_refresh()
         asyncio.create_task(rabbitmq.subscribe_client_created())
         asyncio.create_task(rabbitmq.subscribe_client_updated())
         asyncio.create_task(rabbitmq.subscribe_delivery_check())
         asyncio.create_task(rabbitmq.subscribe_delivery_cancel())
         asyncio.create_task(rabbitmq.subscribe_produced())
+        await delivery_scheduler.start_delivery_scheduler()
+        idempotency.start_purge_task()
         data = {
             "message": "INFO - Servicio Delivery inicializado correctamente"
         }
@@ -76,6 +81,16 @@ async def startup_event():
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources when FastAPI server stops."""
+    await stop_service_refresh()
+    await idempotency.stop_purge_task()
+    await delivery_scheduler.stop_delivery_scheduler()
+    await rabbitmq_publish_logs.close_log_publisher()
+    await rabbitmq_connection.close()
+    await security.close_http_client()
+
 
 # Main #############################################################################################
 # If application is run as script, execute uvicorn on port 8000
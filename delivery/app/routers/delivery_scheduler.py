@@ -0,0 +1,139 @@
+import asyncio
+import heapq
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from os import environ
+from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
+from sql import crud
+from routers import rabbitmq_connection, rabbitmq_topology
+
+logger = logging.getLogger(__name__)
+
+# Delivery scheduler: the due_date column of the database is the source of truth, the heap only
+# says when to wake up. Each tick advances all the due deliveries with one UPDATE.
+DELIVERY_TIME = float(environ.get("DELIVERY_TIME", '10'))
+DELIVERY_SCHEDULER_BATCH_SIZE = int(environ.get("DELIVERY_SCHEDULER_BATCH_SIZE", '500'))
+# Max time between ticks, so deliveries whose publish failed are retried
+DELIVERY_SCHEDULER_INTERVAL = float(environ.get("DELIVERY_SCHEDULER_INTERVAL", '5'))
+# Seconds after which the claim of a replica that did not publish (e.g. it stopped) is retried
+DELIVERY_CLAIM_TIMEOUT = float(environ.get("DELIVERY_CLAIM_TIMEOUT", '60'))
+
+exchange_events_name = 'events'
+due_heap = []
+wakeup = asyncio.Event()
+scheduler_task = None
+
+
+def get_due_date():
+    """Due date of a delivery that starts now."""
+    return datetime.utcnow() + timedelta(seconds=DELIVERY_TIME)
+
+
+def schedule_delivery(delivery_id, due_date):
+    """Wake up the scheduler at due_date. A delivery without due_date is due now."""
+    heapq.heappush(due_heap, (due_date or datetime.min, delivery_id))
+    if due_heap[0][1] == delivery_id:
+        wakeup.set()
+
+
+def get_sleep_time():
+    """Seconds until the next due delivery, at most DELIVERY_SCHEDULER_INTERVAL."""
+    if not due_heap:
+        return DELIVERY_SCHEDULER_INTERVAL
+    sleep_time = (due_heap[0][0] - datetime.utcnow()).total_seconds()
+    return min(max(sleep_time, 0), DELIVERY_SCHEDULER_INTERVAL)
+
+
+async def advance_due_deliveries():
+    """Publish order.delivered for the due deliveries and mark them Delivered, in batches.
+
+    The replicas share the database: each batch is claimed with one UPDATE and only the
+    deliveries of the claim are published. They are marked Delivered once their event is
+    published, so a replica that stops in between leaves them Delivering with a claim that is
+    released on its restart or retried by any replica once it is stale (at least once delivery).
+    """
+    now = datetime.utcnow()
+    while due_heap and due_heap[0][0] <= now:
+        heapq.heappop(due_heap)
+    claim_token = f"{rabbitmq_topology.SERVICE_ID}:{uuid.uuid4().hex}"
+    stale_before = now - timedelta(seconds=DELIVERY_CLAIM_TIMEOUT)
+    delivered = 0
+    db = SessionLocal()
+    try:
+        while True:
+            claimed = await crud.claim_due_deliveries(db, claim_token, now, stale_before, DELIVERY_SCHEDULER_BATCH_SIZE)
+            if not claimed:
+                break
+            claimed_deliveries = await crud.get_claimed_deliveries(db, claim_token)
+            messages = [
+                (json.dumps({"id_order": id_order}), "order.delivered")
+                for _, id_order in claimed_deliveries
+            ]
+            try:
+                results = await rabbitmq_connection.publish_batch(exchange_events_name, messages)
+            except Exception:
+                await crud.release_claimed_deliveries(db, claim_token, [id_delivery for id_delivery, _ in claimed_deliveries])
+                raise
+            # Only the published deliveries change status, the rest are retried in the next tick
+            published_ids = []
+            failed_ids = []
+            for (id_delivery, _), result in zip(claimed_deliveries, results):
+                (published_ids if result is None else failed_ids).append(id_delivery)
+            delivered += await crud.mark_deliveries_delivered(db, claim_token, published_ids)
+            await crud.release_claimed_deliveries(db, claim_token, failed_ids)
+            if failed_ids:
+                logger.warning("Could not publish %i order.delivered events", len(failed_ids))
+                break
+            if claimed < DELIVERY_SCHEDULER_BATCH_SIZE:
+                break
+    finally:
+        await db.close()
+    return delivered
+
+
+async def run_delivery_scheduler():
+    """Sleep until the next due delivery (or a new earlier one) and advance the due deliveries."""
+    while True:
+        wakeup.clear()
+        try:
+            await asyncio.wait_for(wakeup.wait(), get_sleep_time())
+            continue
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await advance_due_deliveries()
+        except Exception as exc: # pylint: disable=broad-except
+            logger.error("Error advancing the due deliveries: %s", exc)
+
+
+async def start_delivery_scheduler():
+    """Reschedule the deliveries that were Delivering before the restart and start the scheduler."""
+    global scheduler_task
+    db = SessionLocal()
+    try:
+        # Deliveries this replica claimed but did not publish before stopping are published again
+        released = await crud.release_replica_claims(db, rabbitmq_topology.SERVICE_ID)
+        if released:
+            logger.info("Released %i deliveries claimed before the restart", released)
+        pending_deliveries = await crud.get_pending_deliveries(db)
+    finally:
+        await db.close()
+    for delivery_id, due_date in pending_deliveries:
+        schedule_delivery(delivery_id, due_date)
+    logger.info("Resumed %i pending deliveries", len(pending_deliveries))
+    if scheduler_task is None:
+        scheduler_task = asyncio.create_task(run_delivery_scheduler())
+
+
+async def stop_delivery_scheduler():
+    """Stop the scheduler. The pending deliveries stay in the database."""
+    global scheduler_task
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+        try:
+            await scheduler_task
+        except asyncio.CancelledError:
+            pass
+        scheduler_task = None
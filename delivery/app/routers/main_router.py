@@ -3,13 +3,12 @@
 import asyncio
 import logging
 from typing import List
-from fastapi import APIRouter, Depends, status, Header, Query
+from fastapi import APIRouter, Depends, status, Header, Query, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from dependencies import get_db
 from sql import crud, schemas, models
 from routers.router_utils import raise_and_log_error
-from routers import security
-from routers.rabbitmq import send_product
+from routers import security, metrics
 from routers import rabbitmq_publish_logs
 import json
 
@@ -31,6 +30,17 @@ async def health_check():
         raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable.")
 
 
+@router.get(
+    "/delivery/metrics",
+    summary="Metrics in Prometheus text format",
+    response_class=Response,
+)
+async def get_metrics():
+    """Endpoint scraped by Prometheus: request latency, consumers, publishes and database."""
+    logger.debug("GET '/delivery/metrics' endpoint called.")
+    return metrics.get_metrics_response()
+
+
 @router.get(
     "/delivery",
     summary="Retrieve single delivery by order id",
@@ -48,23 +58,12 @@ async def health_check():
 async def get_single_delivery(
         order_id: int = Query(None, description="Order ID"),
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        principal: dict = Depends(security.get_principal)
 ):
     """Retrieve single delivery by id"""
     logger.debug("GET '/delivery/%i' endpoint called.", order_id)
-    payload = security.decode_token(token)
 
     if order_id is not None:
-        # validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-            data = {
-                "message": "ERROR - Token expired, log in again"
-            }
-            message_body = json.dumps(data)
-            routing_key = "delivery.main_router_get_single_delivery.error"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
         delivery = await crud.get_delivery_by_order(db, order_id)
         
         if not delivery:
@@ -83,26 +82,7 @@ async def get_single_delivery(
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
         return delivery
     else:
-        # validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-            data = {
-                "message": "ERROR - Token expirated, log in again"
-            }
-            message_body = json.dumps(data)
-            routing_key = "delivery.main_router_get_list_delivery.error"
-            await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-        else:
-            es_admin = security.validar_es_admin(payload)
-            if(es_admin==False):
-                data = {
-                    "message": "ERROR - You don't have permissions"
-                }
-                message_body = json.dumps(data)
-                routing_key = "delivery.main_router_get_list_delivery.error"
-                await rabbitmq_publish_logs.publish_log(message_body, routing_key)
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
+        await security.require_admin(principal)
         delivery_list = await crud.get_delivery_list(db)
         if not delivery_list:
             data = {
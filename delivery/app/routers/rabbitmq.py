@@ -1,38 +1,29 @@
 import asyncio
-import aio_pika
 import json
+import logging
 from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from sql import crud, models
-from routers import security
+from routers import security, rabbitmq_topology, rabbitmq_connection, metrics, delivery_scheduler, idempotency
 from os import environ
 
+logger = logging.getLogger(__name__)
+
+
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
+    # All the channels of the service share the connection of rabbitmq_connection
+    await rabbitmq_connection.get_connection()
     # Declare the exchange
     global exchange_events_name
     exchange_events_name = 'events'
-    global exchange_events
-    exchange_events = await channel.declare_exchange(name=exchange_events_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_events_name)
     
     global exchange_commands_name
     exchange_commands_name = 'commands'
-    global exchange_commands
-    exchange_commands = await channel.declare_exchange(name=exchange_commands_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_commands_name)
     
     global exchange_responses_name
     exchange_responses_name = 'responses'
-    global exchange_responses
-    exchange_responses = await channel.declare_exchange(name=exchange_responses_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_responses_name)
 
 
 async def on_client_created_message(message):
@@ -51,14 +42,16 @@ async def on_client_created_message(message):
 async def subscribe_client_created():
     # Create a queue
     queue_name = "client.created"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "client.created"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_events_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_client_created_message(message)
+            async with metrics.track_message(queue_name):
+                await on_client_created_message(message)
 
 
 async def on_client_updated_message(message):
@@ -77,14 +70,16 @@ async def on_client_updated_message(message):
 async def subscribe_client_updated():
     # Create a queue
     queue_name = "client.updated"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "client.updated"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_events_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_client_updated_message(message)
+            async with metrics.track_message(queue_name):
+                await on_client_updated_message(message)
 
 
 
@@ -93,78 +88,113 @@ async def on_produced_message(message):
         order = json.loads(message.body)
         db = SessionLocal()
         db_delivery = await crud.get_delivery_by_order(db, order['id_order'])
-        db_delivery = await crud.change_delivery_status(db, db_delivery.id_delivery, models.Delivery.STATUS_DELIVERING)
+        if db_delivery is None:
+            await db.close()
+            logger.warning("Delivery of order %s not found, it can not be delivered", order['id_order'])
+            return
+        db_delivery = await crud.start_delivering(db, db_delivery.id_delivery, delivery_scheduler.get_due_date())
         await db.close()
-        asyncio.create_task(send_product(db_delivery))
+        await send_product(db_delivery)
 
 
 async def subscribe_produced():
     # Create queue
     queue_name = "order.produced"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "order.produced"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_events_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_produced_message(message)
+            async with metrics.track_message(queue_name):
+                await on_produced_message(message)
 
 
 async def send_product(delivery):
+    # The delivery_scheduler marks it Delivered and publishes order.delivered at its due_date
     data = {
         "id_order": delivery.id_order
     }
     message_body = json.dumps(data)
     routing_key = "order.delivering"
     await publish_event(message_body, routing_key)
-    await asyncio.sleep(10)
-    db = SessionLocal()
-    db_delivery = await crud.get_delivery(db, delivery.id_delivery)
-    db_delivery = await crud.change_delivery_status(db, db_delivery.id_delivery, models.Delivery.STATUS_DELIVERED)
-    await db.close()
-    routing_key = "order.delivered"
-    await publish_event(message_body, routing_key)
+    delivery_scheduler.schedule_delivery(delivery.id_delivery, delivery.due_date)
 
 
 async def on_message_delivery_check(message):
     async with message.process():
         order = json.loads(message.body)
+        message_key = idempotency.get_message_key(message)
         db = SessionLocal()
-        db_client = await crud.get_client(db, order['id_client'])
-        address_check = await crud.check_address(db, db_client)
-        data = {
-            "id_order": order['id_order'],
-            "status": address_check
-        }
-        if address_check:
-            status_delivery_address_check = models.Delivery.STATUS_CREATED
-        else:
-            status_delivery_address_check = models.Delivery.STATUS_CANCELED
-        db_delivery = models.Delivery(
+        try:
+            # A redelivered check is answered with the original response
+            message_body = await idempotency.get_processed_response(db, message_key)
+            if message_body is None:
+                message_body, stored = await check_delivery(db, order, message_key)
+                if stored:
+                    idempotency.remember_response(message_key, message_body)
+        finally:
+            await db.close()
+        routing_key = "delivery.checked"
+        await publish_response(message_body, routing_key)
+
+
+async def check_delivery(db, order, message_key):
+    """Create the delivery of the order and store the response in the same transaction.
+
+    Returns the response and whether it is stored (see idempotency.should_store_response).
+    """
+    db_client = await crud.get_client(db, order['id_client'])
+    address_check = await crud.check_address(db, db_client)
+    data = {
+        "id_order": order['id_order'],
+        "status": address_check
+    }
+    if address_check:
+        status_delivery_address_check = models.Delivery.STATUS_CREATED
+    else:
+        status_delivery_address_check = models.Delivery.STATUS_CANCELED
+    message_body = json.dumps(data)
+    # id_order is unique: a check of the same order reuses the delivery it already created
+    db_delivery = await crud.get_delivery_by_order(db, order['id_order'])
+    if db_delivery is None:
+        db.add(models.Delivery(
             id_order=order['id_order'],
             status_delivery=status_delivery_address_check,
             address=db_client.address,
             postal_code=db_client.postal_code
-        )
-        await crud.create_delivery(db, db_delivery)
-        await db.close()
-        message_body = json.dumps(data)
-        routing_key = "delivery.checked"
-        await publish_response(message_body, routing_key)
+        ))
+    stored = idempotency.should_store_response(message_key, address_check)
+    if stored:
+        crud.add_processed_message(db, message_key, message_body)
+    try:
+        await db.commit()
+    except Exception as exc:  # @ToDo: To broad exception
+        # Processed concurrently (e.g. redelivered to another worker): use its response
+        await db.rollback()
+        stored_body = await idempotency.get_processed_response(db, message_key)
+        if stored_body is None:
+            raise
+        message_body = stored_body
+        stored = True
+    return message_body, stored
 
 
 async def subscribe_delivery_check():
     # Create queue
     queue_name = "delivery.check"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "delivery.check"
-    await queue.bind(exchange=exchange_commands_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_commands_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_message_delivery_check(message)
+            async with metrics.track_message(queue_name):
+                await on_message_delivery_check(message)
 
 
 async def on_message_delivery_cancel(message):
@@ -172,7 +202,11 @@ async def on_message_delivery_cancel(message):
         order = json.loads(message.body)
         db = SessionLocal()
         delivery = await crud.get_delivery_by_order(db, order['id_order'])
-        delivery = await crud.change_delivery_status(db, delivery.id_delivery, models.Delivery.STATUS_CANCELED)
+        if delivery is None:
+            # Nothing to cancel: the order is answered as canceled all the same
+            logger.warning("Delivery of order %s not found, nothing to cancel", order['id_order'])
+        else:
+            await crud.change_delivery_status(db, delivery.id_delivery, models.Delivery.STATUS_CANCELED)
         await db.close()
         data = {
             "id_order": order['id_order']
@@ -185,47 +219,41 @@ async def on_message_delivery_cancel(message):
 async def subscribe_delivery_cancel():
     # Create queue
     queue_name = "delivery.cancel"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "delivery.cancel"
-    await queue.bind(exchange=exchange_commands_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_commands_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_message_delivery_cancel(message)
+            async with metrics.track_message(queue_name):
+                await on_message_delivery_cancel(message)
 
 
 async def publish_event(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_events.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await rabbitmq_connection.publish(exchange_events_name, message_body, routing_key)
 
 
 async def publish_response(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_responses.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await rabbitmq_connection.publish(exchange_responses_name, message_body, routing_key)
 
 
 async def subscribe_key_created():
     # Create a queue
     queue_name = "client.key_created_delivery"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "client.key_created"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the queue of this replica and bind it to the exchange
+    queue = await rabbitmq_topology.declare_broadcast_queue(consumer_channel, queue_name, exchange_events_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_delivered_message_key_created(message)
+            async with metrics.track_message(queue_name):
+                await on_delivered_message_key_created(message)
 
 
 async def on_delivered_message_key_created(message):
@@ -234,4 +262,4 @@ async def on_delivered_message_key_created(message):
         # db = SessionLocal()
         # db_order = await crud.change_order_status(db, delivery['id_order'], models.Order.STATUS_DELIVERED)
         # await db.close()
-        await security.get_public_key()
+        await security.get_public_key(refresh=True)
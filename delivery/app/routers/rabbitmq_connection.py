@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Single RabbitMQ connection per process, with a channel per consumer and a pool of publisher channels."""
+import asyncio
+import logging
+import time
+import aio_pika
+from aio_pika.pool import Pool
+from os import environ
+from routers import metrics, rabbitmq_memory
+
+logger = logging.getLogger(__name__)
+
+# Channels used to publish; each one waits for its own publisher confirms
+RABBITMQ_PUBLISHER_CHANNELS = int(environ.get("RABBITMQ_PUBLISHER_CHANNELS", '4'))
+# "amqp" connects to RABBITMQ_IP; "memory" uses the in-process broker of rabbitmq_memory (tests, benchmarks)
+RABBITMQ_BACKEND = environ.get("RABBITMQ_BACKEND", "amqp")
+
+connection = None
+connection_lock = asyncio.Lock()
+publisher_channel_pool = None
+consumer_channels = []
+
+
+async def get_connection():
+    """Return the connection of the service, opening it the first time."""
+    global connection
+    async with connection_lock:
+        if connection is None and RABBITMQ_BACKEND == "memory":
+            connection = await rabbitmq_memory.connect()
+        elif connection is None:
+            # Define your RabbitMQ server connection parameters directly as keyword arguments
+            connection = await aio_pika.connect_robust(
+                host=environ.get("RABBITMQ_IP"),
+                port=5672,
+                virtualhost='/',
+                login='user',
+                password='user'
+            )
+    return connection
+
+
+async def get_consumer_channel(prefetch_count):
+    """Open a dedicated channel for one consumer, so flow control on it does not block the others."""
+    channel = await (await get_connection()).channel()
+    await channel.set_qos(prefetch_count=prefetch_count)
+    consumer_channels.append(channel)
+    return channel
+
+
+async def create_publisher_channel():
+    return await (await get_connection()).channel(publisher_confirms=True)
+
+
+def get_publisher_channel_pool():
+    global publisher_channel_pool
+    if publisher_channel_pool is None:
+        publisher_channel_pool = Pool(create_publisher_channel, max_size=RABBITMQ_PUBLISHER_CHANNELS)
+    return publisher_channel_pool
+
+
+async def declare_exchange(exchange_name):
+    """Declare a durable topic exchange."""
+    async with get_publisher_channel_pool().acquire() as channel:
+        await channel.declare_exchange(name=exchange_name, type='topic', durable=True)
+
+
+async def publish(exchange_name, message_body, routing_key):
+    """Publish a message and wait for its confirm. Raises if it could not be published."""
+    results = await publish_batch(exchange_name, [(message_body, routing_key)])
+    if isinstance(results[0], Exception):
+        raise results[0]
+
+
+async def publish_batch(exchange_name, messages):
+    """Publish (message_body, routing_key) pairs on one pooled channel, waiting for all the confirms at once.
+
+    Returns one result per message: None if it was confirmed, the exception otherwise.
+    """
+    start_time = time.perf_counter()
+    async with get_publisher_channel_pool().acquire() as channel:
+        exchange = await channel.get_exchange(exchange_name, ensure=False)
+        results = await asyncio.gather(
+            *[
+                exchange.publish(
+                    aio_pika.Message(
+                        body=message_body.encode(),
+                        content_type="text/plain"
+                    ),
+                    routing_key=routing_key)
+                for message_body, routing_key in messages
+            ],
+            return_exceptions=True
+        )
+    results = [result if isinstance(result, Exception) else None for result in results]
+    metrics.observe_publish(exchange_name, start_time, results)
+    return results
+
+
+async def close():
+    """Close the channels and the connection."""
+    global connection, publisher_channel_pool
+    if publisher_channel_pool is not None:
+        await publisher_channel_pool.close()
+        publisher_channel_pool = None
+    for channel in consumer_channels:
+        await channel.close()
+    consumer_channels.clear()
+    if connection is not None:
+        await connection.close()
+        connection = None
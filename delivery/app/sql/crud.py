@@ -3,6 +3,7 @@
 import logging
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, delete, or_, update
 from sqlalchemy.future import select
 from . import models
 
@@ -71,8 +72,7 @@ async def get_client(db: AsyncSession, client_id):
 async def get_delivery_by_order(db: AsyncSession, order_id):
     """Load a delivery from the database."""
     stmt = select(models.Delivery).where(models.Delivery.id_order == order_id)
-    delivery = await get_list_statement_result(db, stmt)
-    return delivery[0]
+    return await get_element_statement_result(db, stmt)
 
 
 async def store_client(db: AsyncSession, client):
@@ -125,11 +125,130 @@ async def change_delivery_status(db: AsyncSession, delivery_id, status):
     return db_delivery
 
 
+async def start_delivering(db: AsyncSession, delivery_id, due_date):
+    """Mark the delivery as Delivering until due_date."""
+    db_delivery = await get_delivery(db, delivery_id)
+    db_delivery.status_delivery = models.Delivery.STATUS_DELIVERING
+    db_delivery.due_date = due_date
+    await db.commit()
+    await db.refresh(db_delivery)
+    return db_delivery
+
+
+async def get_pending_deliveries(db: AsyncSession):
+    """Load (id_delivery, due_date) of the deliveries that are still Delivering."""
+    stmt = select(models.Delivery.id_delivery, models.Delivery.due_date).where(
+        models.Delivery.status_delivery == models.Delivery.STATUS_DELIVERING
+    )
+    result = await db.execute(stmt)
+    return result.all()
+
+
+def get_due_condition(now, stale_before):
+    """Delivering deliveries whose due_date has passed and that are not claimed (or whose claim is stale).
+
+    Deliveries without due_date were started before the scheduler existed: they are due.
+    """
+    return and_(
+        models.Delivery.status_delivery == models.Delivery.STATUS_DELIVERING,
+        or_(models.Delivery.due_date <= now, models.Delivery.due_date.is_(None)),
+        or_(models.Delivery.claimed_by.is_(None), models.Delivery.claimed_at < stale_before)
+    )
+
+
+async def claim_due_deliveries(db: AsyncSession, claim_token, now, stale_before, limit):
+    """Claim up to limit due deliveries for claim_token with a single UPDATE. Returns how many.
+
+    The replicas share the database: each due delivery is claimed by one of them, and stays
+    Delivering until its order.delivered is published (see mark_deliveries_delivered).
+    """
+    due_ids = select(models.Delivery.id_delivery).where(
+        get_due_condition(now, stale_before)
+    ).order_by(models.Delivery.due_date).limit(limit)
+    stmt = update(models.Delivery).where(
+        models.Delivery.id_delivery.in_(due_ids),
+        get_due_condition(now, stale_before)
+    ).values(claimed_by=claim_token, claimed_at=now).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
+
+
+async def get_claimed_deliveries(db: AsyncSession, claim_token):
+    """Load (id_delivery, id_order) of the deliveries claimed by claim_token."""
+    stmt = select(models.Delivery.id_delivery, models.Delivery.id_order).where(
+        models.Delivery.claimed_by == claim_token
+    )
+    result = await db.execute(stmt)
+    return result.all()
+
+
+async def mark_deliveries_delivered(db: AsyncSession, claim_token, delivery_ids):
+    """Change the claimed deliveries whose order.delivered was published to Delivered."""
+    return await update_claimed_deliveries(
+        db, claim_token, delivery_ids,
+        status_delivery=models.Delivery.STATUS_DELIVERED, claimed_by=None, claimed_at=None
+    )
+
+
+async def release_claimed_deliveries(db: AsyncSession, claim_token, delivery_ids):
+    """Release the claim of deliveries whose order.delivered could not be published, to retry them."""
+    return await update_claimed_deliveries(db, claim_token, delivery_ids, claimed_by=None, claimed_at=None)
+
+
+async def update_claimed_deliveries(db: AsyncSession, claim_token, delivery_ids, **values):
+    if not delivery_ids:
+        return 0
+    stmt = update(models.Delivery).where(
+        models.Delivery.id_delivery.in_(delivery_ids),
+        models.Delivery.claimed_by == claim_token
+    ).values(**values).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
+
+
+async def release_replica_claims(db: AsyncSession, replica_id):
+    """Release the claims of a replica that restarted, so its pending deliveries are published again."""
+    stmt = update(models.Delivery).where(
+        models.Delivery.status_delivery == models.Delivery.STATUS_DELIVERING,
+        models.Delivery.claimed_by.like(f"{replica_id}:%")
+    ).values(claimed_by=None, claimed_at=None).execution_options(synchronize_session=False)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
+
+
 async def add_delivery_info(db: AsyncSession, delivery):
     """Change order status in the database."""
     db_delivery = await get_delivery_by_order(db, delivery.id_order)
+    if db_delivery is None:
+        return None
     db_delivery.name = delivery.name
     db_delivery.address = delivery.address
     await db.commit()
     await db.refresh(db_delivery)
     return db_delivery
+
+
+# Processed message functions #######################################################################
+async def get_processed_messages(db: AsyncSession, message_keys):
+    """Load the stored responses of the given keys: {message key: response}."""
+    stmt = select(models.ProcessedMessage.message_key, models.ProcessedMessage.response).where(
+        models.ProcessedMessage.message_key.in_(message_keys)
+    )
+    result = await db.execute(stmt)
+    return {row.message_key: row.response for row in result}
+
+
+def add_processed_message(db: AsyncSession, message_key, response):
+    """Store the response of a command, committed together with the changes of the command."""
+    db.add(models.ProcessedMessage(message_key=message_key, response=response))
+
+
+async def purge_processed_messages(db: AsyncSession, before):
+    """Delete the processed messages stored before the given date."""
+    stmt = delete(models.ProcessedMessage).where(models.ProcessedMessage.creation_date < before)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Database migrations: create the tables, the new columns and the indexes of the hot queries."""
+import asyncio
+import logging
+from sqlalchemy import inspect, text
+from .database import Base, engine
+from . import models  # pylint: disable=unused-import
+
+logger = logging.getLogger(__name__)
+
+# Hot queries checked with EXPLAIN QUERY PLAN: (name, query, index it must use)
+HOT_QUERIES = [
+    ("get_delivery_by_order", "SELECT * FROM delivery WHERE id_order = 1", "ix_delivery_id_order"),
+    (
+        "claim_due_deliveries",
+        "SELECT id_delivery FROM delivery WHERE status_delivery = 'Delivering' AND due_date <= '2000-01-01' "
+        "AND claimed_by IS NULL ORDER BY due_date LIMIT 500",
+        "ix_delivery_status_due_date"
+    ),
+]
+
+
+def ensure_columns(connection):
+    """Add the nullable columns declared in the models that do not exist yet in the database."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                logger.warning("Can not add column %s.%s: it is not nullable", table.name, column.name)
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info("Added column %s.%s", table.name, column.name)
+
+
+def create_missing_indexes(connection):
+    """Create the indexes declared in the models that do not exist yet in the database."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique and has_duplicates(connection, index):
+                logger.warning("Can not create unique index %s: the table has duplicated values", index.name)
+                continue
+            index.create(connection)
+            logger.info("Created index %s", index.name)
+
+
+def has_duplicates(connection, index):
+    """Check if the columns of the index have duplicated values."""
+    columns = ", ".join(column.name for column in index.columns)
+    stmt = text(
+        f"SELECT {columns} FROM {index.table.name} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 1"
+    )
+    return connection.execute(stmt).first() is not None
+
+
+def explain_hot_queries(connection):
+    """Check that the hot queries use their index. Returns {query name: uses index}."""
+    if connection.dialect.name != "sqlite":
+        return {}
+    results = {}
+    for name, query, index_name in HOT_QUERIES:
+        plan = connection.execute(text(f"EXPLAIN QUERY PLAN {query}")).fetchall()
+        plan_details = " | ".join(str(row[-1]) for row in plan)
+        results[name] = index_name in plan_details
+        if results[name]:
+            logger.info("Query %s uses index %s", name, index_name)
+        else:
+            logger.warning("Query %s does not use index %s: %s", name, index_name, plan_details)
+    return results
+
+
+def migrate(connection):
+    """Create the missing tables, columns and indexes and check the query plans."""
+    Base.metadata.create_all(connection)
+    ensure_columns(connection)
+    create_missing_indexes(connection)
+    explain_hot_queries(connection)
+
+
+async def run_migrations():
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate)
+
+
+# Main #############################################################################################
+# Run the migrations from the app directory with: python -m sql.migrations
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_migrations())
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Float
+from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Float, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -44,10 +44,19 @@ class Delivery(BaseModel):
 
     __tablename__ = "delivery"
     id_delivery = Column(Integer, primary_key=True)
-    id_order = Column(Integer, nullable=False)
+    id_order = Column(Integer, nullable=False, unique=True, index=True)
     address = Column(String(256), nullable=True)
     postal_code = Column(Integer, nullable=True)
     status_delivery = Column(String(256), nullable=False, default=STATUS_CREATED)
+    # When a Delivering delivery becomes Delivered (see routers/delivery_scheduler.py)
+    due_date = Column(DateTime(timezone=True), nullable=True)
+    # Replica (and tick) publishing its order.delivered, and since when; a stale claim is retried
+    claimed_by = Column(String(256), nullable=True)
+    claimed_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("ix_delivery_status_due_date", "status_delivery", "due_date"),
+    )
 
 
 class Client(BaseModel):
@@ -56,3 +65,12 @@ class Client(BaseModel):
     id_client = Column(Integer, primary_key=True)
     address = Column(TEXT, nullable=False)
     postal_code = Column(Integer, nullable=False)
+
+
+class ProcessedMessage(BaseModel):
+    """Commands already processed and their response, to answer redeliveries (routers/idempotency.py)."""
+    __tablename__ = "processed_message"
+    message_key = Column(String(64), primary_key=True)
+    response = Column(TEXT, nullable=False)
+    # Purged after IDEMPOTENCY_TTL
+    creation_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)
@@ -1,95 +1,192 @@
-import consul
-import dns.resolver
+import asyncio
+import base64
+import itertools
 import logging
+import time
+from os import environ
+import httpx
 from consulService.config import Config
 
 logger = logging.getLogger(__name__)
 
 config = Config.get_instance()
 
-# Consul instance
-consul_instance = consul.Consul(
-    host=config.CONSUL_HOST,
-    port=config.CONSUL_PORT
-)
-
-# DNS resolver
-consul_resolver = dns.resolver.Resolver(configure=False)
-consul_resolver.port = config.CONSUL_DNS_PORT
-consul_resolver.nameservers = [config.CONSUL_HOST]
-
-# Store a variable as an example
-consul_instance.kv.put("aas_example_variable", "aas_example_value")
-
-
-def register_consul_service(cons=consul_instance, conf=config):
+# Service discovery: the healthy replicas of each service are read from the Consul HTTP API and
+# cached for CONSUL_CACHE_TTL seconds. A background task refreshes the cached services every
+# CONSUL_REFRESH_INTERVAL seconds, so the callers rarely wait for Consul, and the requests are
+# spread across all the replicas (round-robin). Nothing is requested at import time.
+CONSUL_CACHE_TTL = float(environ.get("CONSUL_CACHE_TTL", '30'))
+CONSUL_REFRESH_INTERVAL = float(environ.get("CONSUL_REFRESH_INTERVAL", '10'))
+CONSUL_TIMEOUT = float(environ.get("CONSUL_TIMEOUT", '5'))
+
+http_client = None
+# service name -> (time it was resolved, list of replicas {"Address", "Port"})
+service_cache = {}
+# service name -> round-robin counter
+service_counters = {}
+# service name -> ongoing resolution, shared by the callers that miss the cache at the same time
+service_fetches = {}
+refresh_task = None
+
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            base_url=f"http://{config.CONSUL_HOST}:{config.CONSUL_PORT}/v1",
+            timeout=CONSUL_TIMEOUT
+        )
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+def get_service_name(service_name):
+    """Accept the DNS SRV form used before ("_client._tcp") as well as the plain service name."""
+    if service_name.endswith("._tcp"):
+        service_name = service_name[:-len("._tcp")]
+    return service_name.lstrip("_")
+
+
+async def register_consul_service(conf=config):
     """Register service in consul"""
+    if conf.IP is None:
+        await conf.get_ip()
     logger.debug(f"Registering {conf.SERVICE_NAME} service ({conf.SERVICE_ID})")
-    cons.agent.service.register(
-        name=conf.SERVICE_NAME,
-        service_id=conf.SERVICE_ID,
-        address=conf.IP,
-        port=conf.PORT,
-        tags=["python", "microservice", "aas"],
-        check={
-            "http": 'http://{host}:{port}/{service_name}/health'.format(
+    response = await get_http_client().put("/agent/service/register", json={
+        "Name": conf.SERVICE_NAME,
+        "ID": conf.SERVICE_ID,
+        "Address": conf.IP,
+        "Port": conf.PORT,
+        "Tags": ["python", "microservice", "aas"],
+        "Check": {
+            "HTTP": 'http://{host}:{port}/{service_name}/health'.format(
                 host=conf.IP,
                 port=conf.PORT,
                 service_name=conf.SERVICE_NAME
             ),
-            "interval": '10s'
+            "Interval": '10s'
         }
-    )
+    })
+    response.raise_for_status()
     logger.info(f"Registered {conf.SERVICE_NAME} service ({conf.SERVICE_ID})")
 
 
-def get_consul_service(service_name, consul_dns_resolver=consul_resolver):
-    """Get service from consul"""
+async def fetch_service_replicas(service_name):
+    """Ask Consul for the replicas of the service that pass their health checks."""
+    response = await get_http_client().get(f"/health/service/{service_name}", params={"passing": "true"})
+    response.raise_for_status()
+    replicas = []
+    for entry in response.json():
+        service = entry["Service"]
+        # The service address is optional in Consul, the node address is used then
+        address = service.get("Address") or entry["Node"]["Address"]
+        replicas.append({"Address": address, "Port": service["Port"]})
+    service_cache[service_name] = (time.monotonic(), replicas)
+    return replicas
+
+
+def clear_service_fetch(service_name, fetch):
+    if service_fetches.get(service_name) is fetch:
+        del service_fetches[service_name]
+
+
+async def resolve_service_replicas(service_name):
+    """Fetch the replicas once, even if several callers ask for them at the same time."""
+    fetch = service_fetches.get(service_name)
+    if fetch is None:
+        fetch = asyncio.ensure_future(fetch_service_replicas(service_name))
+        fetch.add_done_callback(lambda done: clear_service_fetch(service_name, done))
+        service_fetches[service_name] = fetch
+    return await asyncio.shield(fetch)
+
+
+async def get_service_replicas(service_name):
+    """Healthy replicas of the service, from the cache while it is fresh."""
+    service_name = get_service_name(service_name)
+    cached = service_cache.get(service_name)
+    if cached is not None and time.monotonic() - cached[0] < CONSUL_CACHE_TTL:
+        return cached[1]
+    try:
+        return await resolve_service_replicas(service_name)
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        logger.error("Could not get service replicas: {}".format(e))
+        # Better a replica that was healthy a while ago than none
+        return cached[1] if cached is not None else []
+
+
+async def get_consul_service_async(service_name):
+    """Get the next replica of the service (round-robin), without blocking the event loop"""
     ret = {
         "Address": None,
         "Port": None
     }
-    try:
-        #  srv_results = consul_dns_resolver.query("{}.service.consul".format(service_name), "srv")
-
-        srv_results = consul_dns_resolver.resolve(
-            "{}.service.consul".format(service_name),
-            "srv"
-        )  # SRV DNS query
-        srv_list = srv_results.response.answer  # PORT - target_name relation
-        a_list = srv_results.response.additional  # IP - target_name relation
-
-        # DNS returns a list of replicas, supposedly sorted using Round Robin. We always get the 1st element: [0]
-        srv_replica = srv_list[0][0]
-        port = srv_replica.port
-        target_name = srv_replica.target
-
-        # From all the IPs, get the one with the chosen target_name
-        for a in a_list:
-            if a.name == target_name:
-                ret['Address'] = a[0]
-                ret['Port'] = port
-                break
-
-    except dns.exception.DNSException as e:
-        logger.error("Could not get service url: {}".format(e))
+    service_name = get_service_name(service_name)
+    replicas = await get_service_replicas(service_name)
+    if replicas:
+        counter = service_counters.setdefault(service_name, itertools.count())
+        ret.update(replicas[next(counter) % len(replicas)])
     return ret
 
 
-def get_consul_key_value_item(key, cons=consul_instance):
+async def refresh_services():
+    """Resolve again every cached service, keeping the old replicas if Consul does not answer."""
+    for service_name in list(service_cache):
+        try:
+            await resolve_service_replicas(service_name)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning("Could not refresh the replicas of {}: {}".format(service_name, e))
+
+
+async def run_refresh_loop():
+    while True:
+        await asyncio.sleep(CONSUL_REFRESH_INTERVAL)
+        await refresh_services()
+
+
+def start_service_refresh():
+    global refresh_task
+    if refresh_task is None:
+        refresh_task = asyncio.create_task(run_refresh_loop())
+
+
+async def stop_service_refresh():
+    global refresh_task
+    if refresh_task is not None:
+        refresh_task.cancel()
+        try:
+            await refresh_task
+        except asyncio.CancelledError:
+            pass
+        refresh_task = None
+    await close_http_client()
+
+
+async def get_consul_key_value_item(key):
     """Get consul item value for the given key. It only works for string items!"""
-    index, data = cons.kv.get(key)
+    response = await get_http_client().get(f"/kv/{key}")
     value = None
-    if data and data['Value']:
-        value = data['Value'].decode('utf-8')
+    if response.status_code == 200:
+        data = response.json()
+        if data and data[0]['Value']:
+            value = base64.b64decode(data[0]['Value']).decode('utf-8')
     return key, value
 
 
-def get_consul_service_catalog(cons=consul_instance):
+async def get_consul_service_catalog():
     """List al consul services"""
-    return cons.catalog.services()
+    response = await get_http_client().get("/catalog/services")
+    response.raise_for_status()
+    return response.json()
 
 
-def get_consul_service_replicas(cons=consul_instance):
+async def get_consul_service_replicas():
     """Get all services including replicas"""
-    return cons.agent.services()
+    response = await get_http_client().get("/agent/services")
+    response.raise_for_status()
+    return response.json()
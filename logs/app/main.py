@@ -3,10 +3,10 @@
 import logging
 import os
 from fastapi import FastAPI
-from routers import main_router, rabbitmq, security
-from sql import models, database
+from routers import main_router, rabbitmq, security, log_writer, rabbitmq_connection, metrics
+from sql import models, database, migrations
 import asyncio
-from consulService.BLConsul import register_consul_service
+from consulService.BLConsul import register_consul_service, start_service_refresh, stop_service_refresh
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -41,24 +41,39 @@ app = FastAPI(
 )
 
 app.include_router(main_router.router)
+# Latency of every request, scraped from GET /logs/metrics
+app.middleware("http")(metrics.metrics_middleware)
+metrics.instrument_database(database)
 
 
 @app.on_event("startup")
 async def startup_event():
     """Configuration to be executed when FastAPI server starts."""
     logger.info("Creating database tables")
-    async with database.engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
+    await migrations.run_migrations()
+    # Parse the logs stored before the structured columns without delaying the startup
+    asyncio.create_task(migrations.backfill_log_fields())
     await rabbitmq.subscribe_channel()
-    register_consul_service()
+    await register_consul_service()
+    start_service_refresh()
     asyncio.create_task(rabbitmq.subscribe_key_created())
     await security.get_public_key()
+    log_writer.start_log_writer()
     asyncio.create_task(rabbitmq.subscribe_events_logs())
     asyncio.create_task(rabbitmq.subscribe_commands_logs())
     asyncio.create_task(rabbitmq.subscribe_responses_logs())
     asyncio.create_task(rabbitmq.subscribe_logs_logs())
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Store the buffered logs before the FastAPI server stops."""
+    await stop_service_refresh()
+    await log_writer.stop_log_writer()
+    await security.close_http_client()
+    await rabbitmq_connection.close()
+
+
 # Main #############################################################################################
 # If application is run as script, execute uvicorn on port 8000
 if __name__ == "__main__":
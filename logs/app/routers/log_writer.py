@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Write-behind buffer that stores the consumed messages as logs in batches."""
+import asyncio
+import logging
+from os import environ
+from sqlalchemy.exc import OperationalError
+from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
+from sql import crud, log_parser
+
+logger = logging.getLogger(__name__)
+
+# Flush when this many logs are buffered or when the oldest one waited this many seconds
+LOG_WRITER_BATCH_SIZE = int(environ.get("LOG_WRITER_BATCH_SIZE", '500'))
+LOG_WRITER_FLUSH_INTERVAL = float(environ.get("LOG_WRITER_FLUSH_INTERVAL", '0.5'))
+
+log_queue = asyncio.Queue()
+writer_task = None
+
+
+async def enqueue_log(message, exchange_name):
+    """Buffer the message as a log, with its parsed fields. It is acked once the log is stored."""
+    log = {
+        "exchange": exchange_name,
+        "routing_key": message.routing_key,
+        "data": message.body.decode(errors="replace")
+    }
+    log.update(log_parser.parse_log(log["exchange"], log["routing_key"], log["data"]))
+    await log_queue.put((message, log))
+
+
+async def flush_logs(batch):
+    """Store the batch with a single INSERT and ack its messages.
+
+    If the INSERT fails the logs are stored one by one, so a log that cannot be stored does not
+    block the rest of the batch: it is rejected (dead-lettered). When the database itself fails
+    (OperationalError: locked, unavailable) the messages are requeued.
+    """
+    db = SessionLocal()
+    try:
+        await crud.create_logs(db, [log for message, log in batch])
+    except Exception as exc:  # @ToDo: To broad exception
+        logger.error("Error storing %i logs, storing them one by one: %s", len(batch), exc)
+        await db.rollback()
+        await flush_logs_one_by_one(db, batch)
+        return
+    finally:
+        await db.close()
+    for message, log in batch:
+        await message.ack()
+
+
+async def flush_logs_one_by_one(db, batch):
+    """Store each log in its own INSERT; ack it, reject it or requeue it if the database fails."""
+    for index, (message, log) in enumerate(batch):
+        try:
+            await crud.create_logs(db, [log])
+        except OperationalError as exc:
+            logger.error("Error storing logs, requeueing %i: %s", len(batch) - index, exc)
+            await db.rollback()
+            for pending_message, _ in batch[index:]:
+                await pending_message.nack(requeue=True)
+            return
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Could not store log %s, rejecting it: %s", log["routing_key"], exc)
+            await db.rollback()
+            await message.reject(requeue=False)
+            continue
+        await message.ack()
+
+
+async def collect_batch():
+    """Wait for the first log and gather more until the size or time threshold is hit."""
+    loop = asyncio.get_running_loop()
+    batch = [await log_queue.get()]
+    deadline = loop.time() + LOG_WRITER_FLUSH_INTERVAL
+    try:
+        while len(batch) < LOG_WRITER_BATCH_SIZE:
+            if not log_queue.empty():
+                batch.append(log_queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(log_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+    except asyncio.CancelledError:
+        # Stopped while collecting: the logs go back to the queue for the shutdown flush
+        for item in batch:
+            log_queue.put_nowait(item)
+        raise
+    return batch
+
+
+async def run_log_writer():
+    while True:
+        batch = await collect_batch()
+        try:
+            await flush_logs(batch)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Error flushing logs: %s", exc)
+
+
+def start_log_writer():
+    global writer_task
+    writer_task = asyncio.create_task(run_log_writer())
+
+
+async def stop_log_writer():
+    """Stop the writer and store whatever is still buffered.
+
+    The writer is awaited first, so the shutdown flush never runs alongside one of its flushes.
+    """
+    global writer_task
+    if writer_task is not None:
+        writer_task.cancel()
+        try:
+            await writer_task
+        except asyncio.CancelledError:
+            pass
+        writer_task = None
+    batch = []
+    while not log_queue.empty():
+        batch.append(log_queue.get_nowait())
+    if batch:
+        await flush_logs(batch)
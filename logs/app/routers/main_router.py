@@ -1,17 +1,27 @@
 # -*- coding: utf-8 -*-
 """FastAPI router definitions."""
+import json
 import logging
+from datetime import datetime, timezone
 from typing import List
-from fastapi import APIRouter, Depends, status, Header, Query
+from fastapi import APIRouter, Depends, status, Header, Query, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from dependencies import get_db
 from sql import crud, schemas, models
-from routers import security
+from sql.database import SessionLocal
+from routers import security, metrics
 from routers.router_utils import raise_and_log_error
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Log query page size; NDJSON streams fetch LOGS_MAX_PAGE_SIZE logs per query up to LOGS_MAX_STREAM_SIZE
+LOGS_DEFAULT_PAGE_SIZE = 100
+LOGS_MAX_PAGE_SIZE = 1000
+LOGS_MAX_STREAM_SIZE = 100000
+
 
 @router.get(
     "/logs/health",
@@ -27,6 +37,17 @@ async def health_check():
         raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable.")
 
 
+@router.get(
+    "/logs/metrics",
+    summary="Metrics in Prometheus text format",
+    response_class=Response,
+)
+async def get_metrics():
+    """Endpoint scraped by Prometheus: request latency, consumers, publishes and database."""
+    logger.debug("GET '/logs/metrics' endpoint called.")
+    return metrics.get_metrics_response()
+
+
 @router.get(
     "/logs",
     summary="Retrieve certain number of logs",
@@ -42,13 +63,99 @@ async def health_check():
     tags=['Logs']
 )
 async def get_logs(
-        number_of_logs: int = Query(..., description="Number of logs to obtain"),
+        number_of_logs: int = Query(..., ge=1, le=LOGS_MAX_PAGE_SIZE, description="Number of logs to obtain"),
         db: AsyncSession = Depends(get_db),
         token: str = Header(..., description="JWT Token in the Header")
 ):
     """Retrieve logs"""
     logger.debug("GET '/logs/%i' endpoint called.", number_of_logs)
-    payload = security.decode_token(token)
+    await check_admin_token(token)
+    logs = await crud.get_logs(db, number_of_logs)
+    if not logs:
+        raise_and_log_error(logger, status.HTTP_404_NOT_FOUND)
+    return logs
+
+
+@router.get(
+    "/logs/query",
+    summary="Query the logs with filters, newest first",
+    response_model=List[schemas.LogBase],
+    tags=['Logs']
+)
+async def query_logs(
+        response: Response,
+        exchange: str = Query(None, description="Exchange of the message"),
+        routing_key: str = Query(None, description="Routing key, * matches any characters (payment.*.error)"),
+        service: str = Query(None, description="Service (first word of the routing key)"),
+        operation: str = Query(None, description="Function or event of the routing key"),
+        level: str = Query(None, description="Level: debug, info, warning, error or critical"),
+        since: datetime = Query(None, description="Logs stored at or after this date (UTC if no timezone)"),
+        until: datetime = Query(None, description="Logs stored before this date (UTC if no timezone)"),
+        id_order: int = Query(None, description="Order the message refers to"),
+        id_client: int = Query(None, description="Client the message refers to"),
+        before_id: int = Query(None, description="Return the logs older than this ID (cursor)"),
+        limit: int = Query(LOGS_DEFAULT_PAGE_SIZE, ge=1, le=LOGS_MAX_STREAM_SIZE,
+                           description=f"Page size, at most {LOGS_MAX_PAGE_SIZE} ({LOGS_MAX_STREAM_SIZE} with format=ndjson)"),
+        output_format: str = Query("json", alias="format", regex="^(json|ndjson)$",
+                                   description="json: one page; ndjson: stream one log per line"),
+        db: AsyncSession = Depends(get_db),
+        token: str = Header(..., description="JWT Token in the Header")
+):
+    """Query the logs (admin only), ordered by id_log descending.
+
+    With format=json a page of at most LOGS_MAX_PAGE_SIZE logs is returned; when there may be more,
+    the X-Next-Cursor header holds the before_id of the next page. With format=ndjson the logs
+    are streamed, fetched LOGS_MAX_PAGE_SIZE at a time, so they are never all in memory.
+    """
+    logger.debug("GET '/logs/query' endpoint called.")
+    await check_admin_token(token)
+    filters = {
+        "exchange": exchange,
+        "routing_key": routing_key,
+        "service": service,
+        "operation": operation,
+        "level": level.lower() if level is not None else None,
+        "since": to_utc(since),
+        "until": to_utc(until),
+        "id_order": id_order,
+        "id_client": id_client,
+    }
+    if output_format == "ndjson":
+        return StreamingResponse(stream_logs(filters, before_id, limit), media_type="application/x-ndjson")
+    if limit > LOGS_MAX_PAGE_SIZE:
+        raise_and_log_error(logger, status.HTTP_400_BAD_REQUEST, f"The page size is at most {LOGS_MAX_PAGE_SIZE}, use format=ndjson for more")
+    logs = await crud.get_log_page(db, before_id, limit, **filters)
+    if len(logs) == limit:
+        response.headers["X-Next-Cursor"] = str(logs[-1]["id_log"])
+    return logs
+
+
+async def stream_logs(filters, before_id, limit):
+    """Yield the logs as NDJSON lines, one keyset page per query."""
+    remaining = limit
+    while remaining > 0:
+        page_size = min(LOGS_MAX_PAGE_SIZE, remaining)
+        # A short session per page, so a slow reader does not keep a transaction open
+        async with SessionLocal() as db:
+            logs = await crud.get_log_page(db, before_id, page_size, **filters)
+        for log in logs:
+            yield json.dumps(jsonable_encoder(log)) + "\n"
+        if len(logs) < page_size:
+            break
+        before_id = logs[-1]["id_log"]
+        remaining -= len(logs)
+
+
+def to_utc(date):
+    """The creation dates are stored in UTC without timezone."""
+    if date is not None and date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+async def check_admin_token(token):
+    """Only an administrator with a valid token can read the logs."""
+    payload = await security.decode_token(token)
     # validar fecha expiración del token
     is_expirated = security.validar_fecha_expiracion(payload)
     if(is_expirated):
@@ -57,7 +164,3 @@ async def get_logs(
         es_admin = security.validar_es_admin(payload)
         if(es_admin==False):
             raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
-    logs = await crud.get_logs(db, number_of_logs)
-    if not logs:
-        raise_and_log_error(logger, status.HTTP_404_NOT_FOUND)
-    return logs
@@ -0,0 +1,129 @@
+import logging
+import time
+from contextlib import asynccontextmanager
+from fastapi import Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+# Metrics ##########################################################################################
+# Exposed in Prometheus text format by GET /<service>/metrics
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Duration of the HTTP requests", ["method", "route", "status"]
+)
+http_requests_in_progress = Gauge(
+    "http_requests_in_progress", "HTTP requests being handled", ["method", "route"]
+)
+messages_consumed = Counter(
+    "rabbitmq_messages_consumed_total", "Messages consumed from each queue", ["queue", "outcome"]
+)
+message_handler_duration = Histogram(
+    "rabbitmq_message_handler_duration_seconds", "Duration of the message handlers", ["queue"]
+)
+messages_in_progress = Gauge(
+    "rabbitmq_messages_in_progress", "Messages being handled", ["queue"]
+)
+publish_duration = Histogram(
+    "rabbitmq_publish_duration_seconds", "Time until the broker confirms a publish", ["exchange"]
+)
+messages_published = Counter(
+    "rabbitmq_messages_published_total", "Messages published to each exchange", ["exchange", "outcome"]
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds", "Duration of the database queries", ["operation"]
+)
+
+
+def get_route_path(request: Request):
+    """Path template of the route that handles the request, so the label has a bounded cardinality."""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+async def metrics_middleware(request: Request, call_next):
+    """Record the duration of each HTTP request by method, route and status code."""
+    route = get_route_path(request)
+    http_requests_in_progress.labels(request.method, route).inc()
+    start_time = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        http_request_duration.labels(request.method, route, str(status_code)).observe(
+            time.perf_counter() - start_time
+        )
+        http_requests_in_progress.labels(request.method, route).dec()
+
+
+@asynccontextmanager
+async def track_message(queue_name, number_of_messages=1):
+    """Record the duration and outcome of a message handler: async with track_message(queue): ..."""
+    messages_in_progress.labels(queue_name).inc()
+    start_time = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        message_handler_duration.labels(queue_name).observe(time.perf_counter() - start_time)
+        messages_consumed.labels(queue_name, outcome).inc(number_of_messages)
+        messages_in_progress.labels(queue_name).dec()
+
+
+def observe_publish(exchange_name, start_time, results):
+    """Record the confirm latency and the outcome of a batch of publishes."""
+    publish_duration.labels(exchange_name).observe(time.perf_counter() - start_time)
+    failed = sum(1 for result in results if result is not None)
+    if failed:
+        messages_published.labels(exchange_name, "error").inc(failed)
+    if len(results) > failed:
+        messages_published.labels(exchange_name, "ok").inc(len(results) - failed)
+
+
+class PoolCollector:
+    """Report the database connection pool status when the metrics are scraped."""
+
+    def __init__(self, get_pool_metrics):
+        self.get_pool_metrics = get_pool_metrics
+
+    def collect(self):
+        gauge = GaugeMetricFamily("db_pool_connections", "Database connection pool status", labels=["state"])
+        for state, value in self.get_pool_metrics().items():
+            gauge.add_metric([state], value)
+        yield gauge
+
+
+def on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start_time = time.perf_counter()
+
+
+def on_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = getattr(context, "query_start_time", None)
+    if start_time is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    db_query_duration.labels(operation).observe(time.perf_counter() - start_time)
+
+
+def instrument_database(database):
+    """Time the queries of the engine of the database module and report its pool status."""
+    sync_engine = database.engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", on_before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", on_before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", on_after_cursor_execute)
+    REGISTRY.register(PoolCollector(database.get_pool_metrics))
+
+
+def get_metrics_response():
+    """All the metrics of the service in Prometheus text format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
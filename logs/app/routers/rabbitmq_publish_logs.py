@@ -1,32 +1,15 @@
-import aio_pika
 import json
 from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from os import environ
+from routers import rabbitmq_connection
 
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
-
+    # The logs are published through the shared connection of rabbitmq_connection
     global exchange_logs_name
     exchange_logs_name = 'logs'
-    global exchange_logs
-    exchange_logs = await channel.declare_exchange(name=exchange_logs_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_logs_name)
 
 
 async def publish_log(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_logs.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
\ No newline at end of file
+    await rabbitmq_connection.publish(exchange_logs_name, message_body, routing_key)
\ No newline at end of file
@@ -7,13 +7,36 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from routers.router_utils import raise_and_log_error
-from consulService.consul_router import get_consul_service
-import json
-import requests
+from consulService.BLConsul import get_consul_service_async
+from collections import OrderedDict
+from os import environ
+import asyncio
+import httpx
+import random
+import time
 
 logger = logging.getLogger(__name__)
 
+# Public key PEM and parsed key of the signing key, and every published key by kid (JWKS),
+# swapped together by set_public_keys
 public_key = ""
+verification_key = None
+verification_keys = {}
+
+# Token cache: decoded payloads are kept until the token expires (at most TOKEN_CACHE_TTL seconds)
+TOKEN_CACHE_SIZE = int(environ.get("TOKEN_CACHE_SIZE", '1024'))
+TOKEN_CACHE_TTL = float(environ.get("TOKEN_CACHE_TTL", '300'))
+token_cache = OrderedDict()
+
+# Public key fetch: timeout per request, attempts and base backoff between them (seconds)
+PUBLIC_KEY_FETCH_TIMEOUT = float(environ.get("PUBLIC_KEY_FETCH_TIMEOUT", '2'))
+PUBLIC_KEY_FETCH_RETRIES = int(environ.get("PUBLIC_KEY_FETCH_RETRIES", '3'))
+PUBLIC_KEY_FETCH_BACKOFF = float(environ.get("PUBLIC_KEY_FETCH_BACKOFF", '0.2'))
+# Minimum seconds between the key fetches caused by tokens with an unknown kid
+PUBLIC_KEY_REFRESH_INTERVAL = float(environ.get("PUBLIC_KEY_REFRESH_INTERVAL", '10'))
+http_client = None
+public_key_fetch = None
+last_key_refresh = 0.0
 
 async def isTherePublicKey():
     if public_key == "":
@@ -21,18 +44,106 @@ async def isTherePublicKey():
     else:
         return True
 
-async def get_public_key():
-    global public_key
+def set_public_key(public_key_pem:str):
+    """Parse the PEM once and swap the key, dropping the tokens verified with the old one."""
+    global public_key, verification_key, verification_keys
+    new_verification_key = serialization.load_pem_public_key(public_key_pem.encode())
+    public_key, verification_key, verification_keys = public_key_pem, new_verification_key, {}
+    token_cache.clear()
+
+def set_public_keys(jwks:dict):
+    """Parse the JWKS of the client service once. Its first key is the one signing new tokens."""
+    global public_key, verification_key, verification_keys
+    new_verification_keys = {}
+    for jwk in jwks["keys"]:
+        new_verification_keys[jwk["kid"]] = jwt.PyJWK(jwk).key
+    new_verification_key = new_verification_keys[jwks["keys"][0]["kid"]]
+    new_public_key = new_verification_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.PKCS1
+    ).decode()
+    public_key, verification_key, verification_keys = new_public_key, new_verification_key, new_verification_keys
+    token_cache.clear()
+
+def get_token_kid(token:str):
     try:
-        ret = get_consul_service("_client._tcp")
-        response = requests.get(f"http://{ret['Address']}:{ret['Port']}/client/key")
-        if response.status_code == 200:
-            public_key = response.text.strip('"').replace("\\n", "\n")
-            return True
-        return False
-    except requests.RequestException as e:
-        return False
+        return jwt.get_unverified_header(token).get("kid")
+    except jwt.PyJWTError:
+        return None
+
+def get_verification_key(token:str):
+    """Key of the kid of the token; tokens without kid were signed by the signing key."""
+    return verification_keys.get(get_token_kid(token), verification_key)
+
+async def get_token_key(token:str):
+    """Verification key of the token, fetching the keys first if it is not known yet.
 
+    No key loaded yet, or a kid that is not in the keys (the client service rotated its key and
+    key_created has not arrived): the keys are fetched once, the fetch being shared by the
+    concurrent requests. Unknown kids refetch at most every PUBLIC_KEY_REFRESH_INTERVAL seconds.
+    """
+    global last_key_refresh
+    kid = get_token_kid(token)
+    unknown_kid = kid is not None and kid not in verification_keys and (
+        public_key_fetch is not None or time.monotonic() - last_key_refresh >= PUBLIC_KEY_REFRESH_INTERVAL
+    )
+    if verification_key is None or unknown_kid:
+        last_key_refresh = time.monotonic()
+        await get_public_key()
+    return get_verification_key(token)
+
+def get_http_client():
+    # A single client so the connections to the client service are reused
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(timeout=PUBLIC_KEY_FETCH_TIMEOUT)
+    return http_client
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+async def get_public_key(refresh=False):
+    """Fetch the public key. Concurrent callers share the same in-flight fetch.
+
+    With refresh=True a new fetch is started even if one is in flight (e.g. the key was rotated).
+    """
+    global public_key_fetch
+    if public_key_fetch is None or refresh:
+        public_key_fetch = asyncio.ensure_future(fetch_public_key())
+        public_key_fetch.add_done_callback(clear_public_key_fetch)
+    # Shield so a cancelled caller (e.g. a timed out health check) does not cancel the shared fetch
+    return await asyncio.shield(public_key_fetch)
+
+def clear_public_key_fetch(fetch):
+    global public_key_fetch
+    if public_key_fetch is fetch:
+        public_key_fetch = None
+
+async def fetch_public_key():
+    for attempt in range(PUBLIC_KEY_FETCH_RETRIES):
+        if attempt > 0:
+            # Exponential backoff with jitter so the replicas do not retry at the same time
+            await asyncio.sleep(PUBLIC_KEY_FETCH_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+        try:
+            ret = await get_consul_service_async("_client._tcp")
+            if ret['Address'] is None:
+                continue
+            base_url = f"http://{ret['Address']}:{ret['Port']}/client"
+            response = await get_http_client().get(f"{base_url}/jwks")
+            if response.status_code == 200:
+                set_public_keys(response.json())
+                return True
+            # Client versions without JWKS only publish the signing key
+            response = await get_http_client().get(f"{base_url}/key")
+            if response.status_code == 200:
+                set_public_key(response.text.strip('"').replace("\\n", "\n"))
+                return True
+        except (httpx.HTTPError, ValueError, KeyError, IndexError, jwt.PyJWTError) as e:
+            logger.warning(f"Error fetching the public key (attempt {attempt + 1}): {e}")
+    return False
 
 def generar_claves():
     private_key = rsa.generate_private_key(
@@ -64,12 +175,42 @@ def generar_claves():
     with open('public_key.pem', 'wb') as public_key_file:
         public_key_file.write(public_key_pem)
 
-def decode_token(token:str):
+def get_cached_payload(token:str):
+    entry = token_cache.get(token)
+    if entry is None:
+        return None
+    payload, expires_at = entry
+    if expires_at <= time.monotonic():
+        token_cache.pop(token, None)
+        return None
+    token_cache.move_to_end(token)
+    return payload
+
+def cache_payload(token:str, payload:dict):
+    # Nunca se guarda un token más allá de su fecha de expiración
     try:
-        payload = json.loads(json.dumps(jwt.decode(token, public_key, ['RS256'])))
+        exp_datetime = datetime.fromisoformat(payload["fecha_expiracion"])
+    except (KeyError, TypeError, ValueError):
+        return
+    ttl = min(TOKEN_CACHE_TTL, (exp_datetime - datetime.utcnow()).total_seconds())
+    if ttl <= 0:
+        return
+    token_cache[token] = (payload, time.monotonic() + ttl)
+    token_cache.move_to_end(token)
+    while len(token_cache) > TOKEN_CACHE_SIZE:
+        token_cache.popitem(last=False)
+
+async def decode_token(token:str):
+    payload = get_cached_payload(token)
+    if payload is not None:
         return payload
+    key = await get_token_key(token)
+    try:
+        payload = jwt.decode(token, key, ['RS256'])
     except Exception as exc:  # @ToDo: To broad exception
         raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error decoding the token: {exc}")
+    cache_payload(token, payload)
+    return payload
 
 def validar_fecha_expiracion(payload:dict):
     # Obtiene la fecha de expiración del token
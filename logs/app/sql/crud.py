@@ -2,9 +2,10 @@
 """Functions that interact with the database."""
 import logging
 from datetime import datetime
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from . import models
+from . import models, log_parser
 
 logger = logging.getLogger(__name__)
 
@@ -69,12 +70,56 @@ async def get_logs(db: AsyncSession, number_of_logs):
     return await get_list_statement_result(db, stmt)
 
 
+def get_routing_key_like(routing_key_pattern):
+    """LIKE pattern of a routing key pattern where * matches any characters (payment.*.error)."""
+    escaped = routing_key_pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%")
+
+
+async def get_log_page(db: AsyncSession, before_id=None, limit=100, exchange=None, routing_key=None,
+                       service=None, operation=None, level=None, since=None, until=None,
+                       id_order=None, id_client=None):
+    """Load a page of logs, newest first, with id_log below before_id (keyset pagination).
+
+    Every filter is optional. The indexes of the service and level filters (and of id_order,
+    id_client and routing_key, through the rowid) end in id_log, so a page is read in index order
+    and stops at limit rows instead of sorting every matching log.
+    """
+    stmt = select(models.Log.__table__).order_by(models.Log.id_log.desc()).limit(limit)
+    if before_id is not None:
+        stmt = stmt.where(models.Log.id_log < before_id)
+    if exchange is not None:
+        stmt = stmt.where(models.Log.exchange == exchange)
+    if routing_key is not None:
+        if "*" in routing_key:
+            stmt = stmt.where(models.Log.routing_key.like(get_routing_key_like(routing_key), escape="\\"))
+        else:
+            stmt = stmt.where(models.Log.routing_key == routing_key)
+    if service is not None:
+        stmt = stmt.where(models.Log.service == service)
+    if operation is not None:
+        stmt = stmt.where(models.Log.operation == operation)
+    if level is not None:
+        stmt = stmt.where(models.Log.level == level)
+    if since is not None:
+        stmt = stmt.where(models.Log.creation_date >= since)
+    if until is not None:
+        stmt = stmt.where(models.Log.creation_date < until)
+    if id_order is not None:
+        stmt = stmt.where(models.Log.id_order == id_order)
+    if id_client is not None:
+        stmt = stmt.where(models.Log.id_client == id_client)
+    result = await db.execute(stmt)
+    return [dict(row._mapping) for row in result]
+
+
 async def create_log(db: AsyncSession, log):
     """Persist a new order into the database."""
     db_log = models.Log(
         exchange=log.exchange,
         routing_key=log.routing_key,
         data=log.data,
+        **log_parser.parse_log(log.exchange, log.routing_key, log.data)
     )
     db.add(db_log)
     await db.commit()
@@ -82,3 +127,9 @@ async def create_log(db: AsyncSession, log):
     return db_log
 
 
+async def create_logs(db: AsyncSession, logs):
+    """Persist a list of logs (dicts, with their parsed fields) with a single executemany INSERT."""
+    if not logs:
+        return
+    await db.execute(insert(models.Log), logs)
+    await db.commit()
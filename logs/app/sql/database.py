@@ -1,20 +1,86 @@
 # -*- coding: utf-8 -*-
 """Database session configuration."""
 import os
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
 
 SQLALCHEMY_DATABASE_URL = os.getenv(
     'SQLALCHEMY_DATABASE_URL',
     "sqlite+aiosqlite:///./logs.db"
 )
 
-engine = create_async_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False
-)
+# Connection pool (for SQLite and for a server database such as PostgreSQL)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+# SQLite pragmas, executed on every new connection (empty value to skip one)
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    "synchronous": os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    "cache_size": os.getenv('SQLITE_CACHE_SIZE', '-64000'),
+    "mmap_size": os.getenv('SQLITE_MMAP_SIZE', '268435456'),
+    "busy_timeout": os.getenv('SQLITE_BUSY_TIMEOUT', '5000'),
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to a new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        if value:
+            cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+def create_database_engine(database_url=SQLALCHEMY_DATABASE_URL):
+    """Create the async engine with the pool settings (and the pragmas, for SQLite)."""
+    if not database_url.startswith("sqlite"):
+        return create_async_engine(
+            database_url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+            echo=False
+        )
+    if database_url.endswith("://") or ":memory:" in database_url:
+        # An in-memory database only lives in its connection, so it is shared by all sessions
+        pool_options = {"poolclass": StaticPool}
+    else:
+        pool_options = {
+            "poolclass": AsyncAdaptedQueuePool,
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT
+        }
+    sqlite_engine = create_async_engine(
+        database_url,
+        connect_args={"check_same_thread": False},
+        echo=False,
+        **pool_options
+    )
+    event.listen(sqlite_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return sqlite_engine
+
+
+def get_pool_metrics(database_engine=None):
+    """Return the connection pool status (size, checked in/out connections and overflow)."""
+    pool = (database_engine or engine).pool
+    metrics = {}
+    for name, method in (("size", "size"), ("checked_in", "checkedin"),
+                         ("checked_out", "checkedout"), ("overflow", "overflow")):
+        if hasattr(pool, method):
+            metrics[name] = getattr(pool, method)()
+    return metrics
+
+
+engine = create_database_engine()
 
 SessionLocal = sessionmaker(
     autocommit=False,
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Structured fields of a log, parsed from its routing key and payload at ingest."""
+import json
+
+LEVELS = ("debug", "info", "warning", "error", "critical")
+# Range of an SQLite INTEGER (signed 64 bits)
+MIN_INTEGER = -2 ** 63
+MAX_INTEGER = 2 ** 63 - 1
+
+
+def get_level_from_message(payload):
+    """Level of the "ERROR - ..." / "INFO - ..." messages the services publish."""
+    message = payload.get("message")
+    if isinstance(message, str):
+        prefix = message.split(" - ", 1)[0].strip().lower()
+        if prefix in LEVELS:
+            return prefix
+    return None
+
+
+def get_int(payload, key):
+    """Integer field of the payload, None if missing, not a number or out of the INTEGER range."""
+    value = payload.get(key)
+    if isinstance(value, bool):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        return None
+    return value
+
+
+def parse_log(exchange, routing_key, data):
+    """Return the service, operation, level, id_order and id_client of a log.
+
+    Routing keys follow service.function.level (client.main_router_get_token.error); the events,
+    commands and responses (payment.checked, order.delivered) have no level, it is taken from the
+    "LEVEL - text" message if the payload has one.
+    """
+    words = (routing_key or "").split(".")
+    service = words[0] or None
+    level = None
+    if len(words) >= 3 and words[-1].lower() in LEVELS:
+        operation = ".".join(words[1:-1])
+        level = words[-1].lower()
+    else:
+        operation = ".".join(words[1:]) or None
+    try:
+        payload = json.loads(data)
+    except (TypeError, ValueError):
+        payload = None
+    id_order = id_client = None
+    if isinstance(payload, dict):
+        if level is None:
+            level = get_level_from_message(payload)
+        id_order = get_int(payload, "id_order")
+        id_client = get_int(payload, "id_client")
+    return {
+        "service": service,
+        "operation": operation,
+        "level": level,
+        "id_order": id_order,
+        "id_client": id_client,
+    }
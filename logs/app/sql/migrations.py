@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Database migrations: create the tables, the new columns and the indexes of the hot queries."""
+import asyncio
+import logging
+from os import environ
+from sqlalchemy import inspect, text, select, update, bindparam
+from .database import Base, engine
+from . import models  # pylint: disable=unused-import
+from . import log_parser
+
+logger = logging.getLogger(__name__)
+
+# Hot queries checked with EXPLAIN QUERY PLAN: (name, query, index it must use)
+HOT_QUERIES = [
+    ("logs_by_routing_key", "SELECT * FROM log WHERE routing_key = 'a' ORDER BY id_log DESC LIMIT 10", "ix_log_routing_key"),
+    (
+        "service_errors_since",
+        "SELECT * FROM log WHERE service = 'payment' AND level = 'error' AND creation_date >= '2000-01-01'",
+        "ix_log_service_level_creation_date"
+    ),
+    ("logs_by_order", "SELECT * FROM log WHERE id_order = 1", "ix_log_id_order"),
+    (
+        "log_page_service_level",
+        "SELECT * FROM log WHERE service = 'payment' AND level = 'error' AND id_log < 1000 "
+        "AND creation_date >= '2000-01-01' ORDER BY id_log DESC LIMIT 100",
+        "ix_log_service_level_id_log"
+    ),
+    (
+        "log_page_level",
+        "SELECT * FROM log WHERE level = 'error' AND id_log < 1000 ORDER BY id_log DESC LIMIT 100",
+        "ix_log_level_id_log"
+    ),
+]
+
+# Logs stored before the structured columns existed are parsed in batches of this size
+LOG_BACKFILL_BATCH_SIZE = int(environ.get("LOG_BACKFILL_BATCH_SIZE", '5000'))
+
+
+def ensure_columns(connection):
+    """Add the nullable columns declared in the models that do not exist yet in the database."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable:
+                logger.warning("Can not add column %s.%s: it is not nullable", table.name, column.name)
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            logger.info("Added column %s.%s", table.name, column.name)
+
+
+def create_missing_indexes(connection):
+    """Create the indexes declared in the models that do not exist yet in the database."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique and has_duplicates(connection, index):
+                logger.warning("Can not create unique index %s: the table has duplicated values", index.name)
+                continue
+            index.create(connection)
+            logger.info("Created index %s", index.name)
+
+
+def has_duplicates(connection, index):
+    """Check if the columns of the index have duplicated values."""
+    columns = ", ".join(column.name for column in index.columns)
+    stmt = text(
+        f"SELECT {columns} FROM {index.table.name} GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 1"
+    )
+    return connection.execute(stmt).first() is not None
+
+
+def explain_hot_queries(connection):
+    """Check that the hot queries use their index. Returns {query name: uses index}."""
+    if connection.dialect.name != "sqlite":
+        return {}
+    results = {}
+    for name, query, index_name in HOT_QUERIES:
+        plan = connection.execute(text(f"EXPLAIN QUERY PLAN {query}")).fetchall()
+        plan_details = " | ".join(str(row[-1]) for row in plan)
+        results[name] = index_name in plan_details
+        if results[name]:
+            logger.info("Query %s uses index %s", name, index_name)
+        else:
+            logger.warning("Query %s does not use index %s: %s", name, index_name, plan_details)
+    return results
+
+
+def backfill_log_fields_batch(connection, after_id):
+    """Parse the structured fields of the next batch of unparsed logs. Returns the last id_log or None."""
+    log = models.Log.__table__
+    rows = connection.execute(
+        select(log.c.id_log, log.c.exchange, log.c.routing_key, log.c.data)
+        .where(log.c.id_log > after_id)
+        .where(log.c.service.is_(None))
+        .order_by(log.c.id_log)
+        .limit(LOG_BACKFILL_BATCH_SIZE)
+    ).fetchall()
+    if not rows:
+        return None
+    parsed_rows = [
+        dict(log_parser.parse_log(row.exchange, row.routing_key, row.data), log_id=row.id_log)
+        for row in rows
+    ]
+    # Logs without routing key keep service NULL; the id_log cursor moves past them anyway
+    connection.execute(
+        update(log).where(log.c.id_log == bindparam("log_id")).values(
+            service=bindparam("service"),
+            operation=bindparam("operation"),
+            level=bindparam("level"),
+            id_order=bindparam("id_order"),
+            id_client=bindparam("id_client"),
+        ),
+        parsed_rows
+    )
+    return rows[-1].id_log
+
+
+async def backfill_log_fields():
+    """Parse the logs stored before the structured columns, one short transaction per batch."""
+    after_id = 0
+    while True:
+        async with engine.begin() as conn:
+            last_id = await conn.run_sync(backfill_log_fields_batch, after_id)
+        if last_id is None:
+            break
+        after_id = last_id
+        # Let the log writer in between batches
+        await asyncio.sleep(0)
+    if after_id:
+        logger.info("Backfilled the structured fields of the logs up to id_log %i", after_id)
+
+
+def migrate(connection):
+    """Create the missing tables, columns and indexes and check the query plans."""
+    Base.metadata.create_all(connection)
+    # The data column is TEXT now; SQLite never enforced the old String(256) length, so only
+    # the new nullable columns need an ALTER TABLE
+    ensure_columns(connection)
+    create_missing_indexes(connection)
+    explain_hot_queries(connection)
+
+
+async def run_migrations():
+    async with engine.begin() as conn:
+        await conn.run_sync(migrate)
+
+
+async def run_migrations_and_backfill():
+    await run_migrations()
+    await backfill_log_fields()
+
+
+# Main #############################################################################################
+# Run the migrations from the app directory with: python -m sql.migrations
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_migrations_and_backfill())
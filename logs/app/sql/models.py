@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Database models definitions. Table representations as class."""
-from sqlalchemy import Column, DateTime, Integer, String, TEXT, ForeignKey, Float
+from sqlalchemy import Column, DateTime, Index, Integer, String, TEXT, ForeignKey, Float
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -41,5 +41,23 @@ class Log(BaseModel):
     __tablename__ = "log"
     id_log = Column(Integer, primary_key=True)
     exchange = Column(String(256), nullable=False)
-    routing_key = Column(String(256), nullable=False)
-    data = Column(String(256), nullable=False)
+    routing_key = Column(String(256), nullable=False, index=True)
+    # Full payload, without length limit
+    data = Column(TEXT, nullable=False)
+    # Parsed from the routing key (service.operation.level) and the payload at ingest (sql.log_parser)
+    service = Column(String(64), nullable=True)
+    operation = Column(String(256), nullable=True)
+    level = Column(String(16), nullable=True)
+    id_order = Column(Integer, nullable=True, index=True)
+    id_client = Column(Integer, nullable=True, index=True)
+
+    __table_args__ = (
+        # "All payment errors in the last hour": range scan on creation_date
+        Index("ix_log_service_level_creation_date", "service", "level", "creation_date"),
+        Index("ix_log_level_creation_date", "level", "creation_date"),
+        Index("ix_log_creation_date", "creation_date"),
+        # Keyset pages of GET /logs/query (newest first, id_log < cursor) read in index order
+        Index("ix_log_service_level_id_log", "service", "level", "id_log"),
+        Index("ix_log_service_id_log", "service", "id_log"),
+        Index("ix_log_level_id_log", "level", "id_log"),
+    )
@@ -29,4 +29,28 @@ class LogBase(BaseModel):
         description="Primary key/identifier of the log.",
         default=None
     )
+    service: Optional[str] = Field(
+        description="Service that published the message (first word of the routing key).",
+        default=None
+    )
+    operation: Optional[str] = Field(
+        description="Function or event of the routing key.",
+        default=None
+    )
+    level: Optional[str] = Field(
+        description="Level of the log (info, error...), if the message has one.",
+        default=None
+    )
+    id_order: Optional[int] = Field(
+        description="Order the message refers to, if any.",
+        default=None
+    )
+    id_client: Optional[int] = Field(
+        description="Client the message refers to, if any.",
+        default=None
+    )
+    creation_date: Optional[datetime] = Field(
+        description="When the log was stored.",
+        default=None
+    )
 
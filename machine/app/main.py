@@ -4,9 +4,9 @@ import logging
 import json
 import os
 from fastapi import FastAPI
-from routers import main_router, rabbitmq, security, rabbitmq_publish_logs
+from routers import main_router, rabbitmq, security, rabbitmq_publish_logs, rabbitmq_connection, machine_pool, metrics
 import asyncio
-from consulService.BLConsul import register_consul_service
+from consulService.BLConsul import register_consul_service, start_service_refresh, stop_service_refresh
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -41,6 +41,8 @@ app = FastAPI(
 )
 
 app.include_router(main_router.router)
+# Latency of every request, scraped from GET /machine/metrics
+app.middleware("http")(metrics.metrics_middleware)
 
 
 @app.on_event("startup")
@@ -52,7 +54,9 @@ async def startup_event():
         await rabbitmq_publish_logs.subscribe_channel()
         asyncio.create_task(rabbitmq.subscribe_key_created())
         await security.get_public_key()
-        register_consul_service()
+        await register_consul_service()
+        start_service_refresh()
+        machine_pool.start_machine_pool()
         asyncio.create_task(rabbitmq.subscribe())
         data = {
             "message": "INFO - Servicio Machine inicializado correctamente"
@@ -69,6 +73,16 @@ async def startup_event():
         await rabbitmq_publish_logs.publish_log(message_body, routing_key)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources when FastAPI server stops."""
+    await stop_service_refresh()
+    await machine_pool.stop_machine_pool()
+    await rabbitmq_publish_logs.close_log_publisher()
+    await rabbitmq_connection.close()
+    await security.close_http_client()
+
+
 # Main #############################################################################################
 # If application is run as script, execute uvicorn on port 8000
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import asyncio
+import collections
+import json
+import logging
+import time
+from os import environ
+from routers import rabbitmq_connection
+
+logger = logging.getLogger(__name__)
+
+# Machine pool: the consumer only queues the pieces (up to MACHINE_PREFETCH unacked messages) and
+# MACHINE_WORKSTATIONS workers produce them, taking the pieces of the same order in batches.
+MACHINE_WORKSTATIONS = int(environ.get("MACHINE_WORKSTATIONS", '4'))
+PIECE_PRODUCTION_TIME = float(environ.get("PIECE_PRODUCTION_TIME", '2'))
+MACHINE_BATCH_SIZE = int(environ.get("MACHINE_BATCH_SIZE", '10'))
+MACHINE_PREFETCH = int(environ.get("MACHINE_PREFETCH", str(MACHINE_WORKSTATIONS * MACHINE_BATCH_SIZE)))
+
+STATUS_IDLE = "Idle"
+STATUS_PRODUCING = "Producing"
+
+exchange_name = 'events'
+# id_order -> [(piece, message)], the order that waits longest first
+pending_orders = collections.OrderedDict()
+pending_pieces = 0
+work_available = asyncio.Condition()
+machines = []
+worker_tasks = []
+pool_start_time = None
+
+
+def create_machine(machine_id):
+    """State of a single workstation."""
+    return {
+        "id_machine": machine_id,
+        "status": STATUS_IDLE,
+        "id_order": None,
+        "pieces_produced": 0,
+        "busy_time": 0.0
+    }
+
+
+async def enqueue_piece(piece, message):
+    """Queue the piece; the message is acked when the piece is produced."""
+    global pending_pieces
+    async with work_available:
+        pending_orders.setdefault(piece['id_order'], []).append((piece, message))
+        pending_pieces += 1
+        work_available.notify()
+
+
+async def take_batch():
+    """Wait for work and take up to MACHINE_BATCH_SIZE pieces of the order that waits longest."""
+    global pending_pieces
+    async with work_available:
+        await work_available.wait_for(lambda: pending_orders)
+        id_order, pieces = next(iter(pending_orders.items()))
+        batch = pieces[:MACHINE_BATCH_SIZE]
+        del pieces[:MACHINE_BATCH_SIZE]
+        if pieces:
+            # The rest of the order goes to the back, so big orders do not block the small ones
+            pending_orders.move_to_end(id_order)
+        else:
+            del pending_orders[id_order]
+        pending_pieces -= len(batch)
+    return id_order, batch
+
+
+async def produce_batch(machine, id_order, batch):
+    """Produce the pieces, publish piece.produced for all of them and ack the messages."""
+    machine["status"] = STATUS_PRODUCING
+    machine["id_order"] = id_order
+    start_time = time.monotonic()
+    settled = 0
+    try:
+        await asyncio.sleep(PIECE_PRODUCTION_TIME * len(batch))
+        messages = [
+            (json.dumps({"id_piece": piece['id_piece'], "id_order": piece['id_order']}), "piece.produced")
+            for piece, _ in batch
+        ]
+        results = await rabbitmq_connection.publish_batch(exchange_name, messages)
+        for (_, message), result in zip(batch, results):
+            settled += 1
+            if result is None:
+                await message.ack()
+                machine["pieces_produced"] += 1
+            else:
+                logger.error("Could not publish piece.produced: %s", result)
+                await message.nack(requeue=True)
+    except Exception as exc: # pylint: disable=broad-except
+        # publish_batch failed before publishing (pool, exchange): requeue the pieces not yet settled
+        logger.error("Could not publish the pieces of order %s, requeueing them: %s", id_order, exc)
+        for _, message in batch[settled:]:
+            try:
+                await message.nack(requeue=True)
+            except Exception as nack_exc: # pylint: disable=broad-except
+                logger.error("Could not requeue piece: %s", nack_exc)
+    finally:
+        machine["busy_time"] += time.monotonic() - start_time
+        machine["status"] = STATUS_IDLE
+        machine["id_order"] = None
+
+
+async def machine_worker(machine):
+    """Take batches from the queue and produce them, one batch at a time."""
+    while True:
+        id_order, batch = await take_batch()
+        try:
+            await produce_batch(machine, id_order, batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc: # pylint: disable=broad-except
+            logger.error("Machine %i could not produce order %s: %s", machine["id_machine"], id_order, exc)
+
+
+def start_machine_pool():
+    """Create the workstations and start one worker for each of them."""
+    global pool_start_time
+    if worker_tasks:
+        return
+    pool_start_time = time.monotonic()
+    for machine_id in range(1, MACHINE_WORKSTATIONS + 1):
+        machine = create_machine(machine_id)
+        machines.append(machine)
+        worker_tasks.append(asyncio.create_task(machine_worker(machine)))
+
+
+async def stop_machine_pool():
+    """Stop the workers. The unacked pieces are redelivered by RabbitMQ."""
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+
+
+def get_pool_status():
+    """Pool utilization, queue depth and state and throughput of each machine."""
+    uptime = time.monotonic() - pool_start_time if pool_start_time is not None else 0
+    machines_status = []
+    for machine in machines:
+        machines_status.append({
+            "id_machine": machine["id_machine"],
+            "status": machine["status"],
+            "id_order": machine["id_order"],
+            "pieces_produced": machine["pieces_produced"],
+            # Pieces per minute since the pool started
+            "throughput": round(machine["pieces_produced"] * 60 / uptime, 2) if uptime else 0.0,
+            "utilization": round(machine["busy_time"] / uptime, 2) if uptime else 0.0
+        })
+    busy_machines = sum(1 for machine in machines if machine["status"] == STATUS_PRODUCING)
+    return {
+        "workstations": len(machines),
+        "busy_machines": busy_machines,
+        "utilization": round(busy_machines / len(machines), 2) if machines else 0.0,
+        "queue_depth": pending_pieces,
+        "orders_waiting": len(pending_orders),
+        "machines": machines_status
+    }
@@ -2,12 +2,12 @@
 """FastAPI router definitions."""
 import logging
 from typing import List
-from fastapi import APIRouter, Depends, status, Header
+from fastapi import APIRouter, Depends, status, Header, Response
 from routers.router_utils import raise_and_log_error
 from routers.crud import get_status_of_machine
 from typing import List, Optional
 from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
-from routers import security, rabbitmq, rabbitmq_publish_logs
+from routers import security, rabbitmq, rabbitmq_publish_logs, metrics
 import json
 
 logger = logging.getLogger(__name__)
@@ -19,6 +19,26 @@ class Message(BaseModel):
     detail: Optional[str] = Field(example="error or success message")
 
 
+class MachineState(BaseModel):
+    """State of a single workstation of the pool."""
+    id_machine: int = Field(example=1)
+    status: str = Field(example="Producing")
+    id_order: Optional[int] = Field(example=1)
+    pieces_produced: int = Field(example=10)
+    throughput: float = Field(description="Pieces per minute", example=30.0)
+    utilization: float = Field(description="Fraction of the time producing", example=0.5)
+
+
+class MachineStatus(BaseModel):
+    """Machine pool status schema definition."""
+    workstations: int = Field(example=4)
+    busy_machines: int = Field(example=2)
+    utilization: float = Field(example=0.5)
+    queue_depth: int = Field(description="Pieces waiting for a machine", example=0)
+    orders_waiting: int = Field(example=0)
+    machines: List[MachineState] = []
+
+
 @router.get(
     "/machine/health",
     summary="Health check endpoint",
@@ -33,12 +53,23 @@ async def health_check():
         raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable.")
 
 
+@router.get(
+    "/machine/metrics",
+    summary="Metrics in Prometheus text format",
+    response_class=Response,
+)
+async def get_metrics():
+    """Endpoint scraped by Prometheus: request latency, consumers, publishes and database."""
+    logger.debug("GET '/machine/metrics' endpoint called.")
+    return metrics.get_metrics_response()
+
+
 @router.get(
     "/machine/status", 
     summary="Retrieve machine status",
     responses={
         status.HTTP_200_OK: {
-            "model": Message, "description": "Requested machine status"
+            "model": MachineStatus, "description": "Requested machine pool status"
         },
         status.HTTP_404_NOT_FOUND: {
             "model": Message, "description": "Machine status not found"
@@ -54,7 +85,7 @@ async def get_machine_status(
 
     try:
 
-        payload = security.decode_token(token)
+        payload = await security.decode_token(token)
         # validar fecha expiración del token
         is_expirated = security.validar_fecha_expiracion(payload)
         if(is_expirated):
@@ -1,76 +1,62 @@
 import asyncio
-import aio_pika
 import json
-from routers.crud import set_status_of_machine
-from routers import security
+from routers import security, rabbitmq_topology, rabbitmq_connection, metrics, machine_pool
 from os import environ
 
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
+    # All the channels of the service share the connection of rabbitmq_connection
+    await rabbitmq_connection.get_connection()
     # Declare the exchange
     global exchange_name
     exchange_name = 'events'
-    global exchange
-    exchange = await channel.declare_exchange(name=exchange_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_name)
 
 
 async def on_message(message):
-    async with message.process():
-        piece = json.loads(message.body)
-        await set_status_of_machine("Machine Status: Producing")
-        await asyncio.sleep(2)
-        await set_status_of_machine("Machine Status: Idle")
-        data = {
-            "id_piece": piece['id_piece'],
-            "id_order": piece['id_order']
+    # The machine pool produces the piece and acks the message
+    try:
+        body = json.loads(message.body)
+        piece = {
+            "id_piece": body['id_piece'],
+            "id_order": body['id_order']
         }
-        message_body = json.dumps(data)
-        routing_key = "piece.produced"
-        await publish(message_body, routing_key)
+    except (ValueError, TypeError, KeyError):
+        await message.reject()
+        return
+    await machine_pool.enqueue_piece(piece, message)
 
 async def subscribe():
     # Create queue
     queue_name = "piece.needed"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "piece.needed"
-    await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # Dedicated channel for this consumer, the prefetch bounds the pieces queued in the pool
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(machine_pool.MACHINE_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_message(message)
+            async with metrics.track_message(queue_name):
+                await on_message(message)
 
 async def publish(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await rabbitmq_connection.publish(exchange_name, message_body, routing_key)
 
 async def subscribe_key_created():
     # Create a queue
     queue_name = "client.key_created_machine"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "client.key_created"
-    await queue.bind(exchange=exchange_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the queue of this replica and bind it to the exchange
+    queue = await rabbitmq_topology.declare_broadcast_queue(consumer_channel, queue_name, exchange_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_delivered_message_key_created(message)
+            async with metrics.track_message(queue_name):
+                await on_delivered_message_key_created(message)
 
 async def on_delivered_message_key_created(message):
     async with message.process():
-        await security.get_public_key()
+        await security.get_public_key(refresh=True)
@@ -1,32 +1,184 @@
-import aio_pika
+import asyncio
+import collections
 import json
+import logging
+import os
 # from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from os import environ
+from routers import rabbitmq_connection
+
+logger = logging.getLogger(__name__)
+
+# Background log publisher: handlers only enqueue, a task publishes the buffer in batches
+LOG_BUFFER_SIZE = int(environ.get("LOG_BUFFER_SIZE", '10000'))
+LOG_PUBLISH_BATCH_SIZE = int(environ.get("LOG_PUBLISH_BATCH_SIZE", '100'))
+LOG_BACKPRESSURE_TIMEOUT = float(environ.get("LOG_BACKPRESSURE_TIMEOUT", '0.05'))
+LOG_RETRY_INTERVAL = float(environ.get("LOG_RETRY_INTERVAL", '5'))
+# The app directory is shared by the replicas of the service: one spool file per replica
+SERVICE_ID = environ.get("SERVICE_ID", "machine1")
+LOG_SPOOL_FILE = environ.get("LOG_SPOOL_FILE", f"log_spool.{SERVICE_ID}.jsonl")
+# Spool being replayed, and the spool lines that could not be parsed
+LOG_REPLAY_FILE = LOG_SPOOL_FILE + ".replay"
+LOG_CORRUPT_FILE = LOG_SPOOL_FILE + ".corrupt"
+
+exchange_logs_name = None
+log_buffer = collections.deque()
+log_available = asyncio.Event()
+buffer_drained = asyncio.Event()
+publisher_task = None
+# The spool file is written from worker threads, one at a time
+spool_lock = asyncio.Lock()
 
-async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
 
+async def subscribe_channel():
+    # The logs are published through the shared connection of rabbitmq_connection
     global exchange_logs_name
     exchange_logs_name = 'logs'
-    global exchange_logs
-    exchange_logs = await channel.declare_exchange(name=exchange_logs_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_logs_name)
+
+    global publisher_task
+    if publisher_task is None:
+        publisher_task = asyncio.create_task(run_log_publisher())
 
 
 async def publish_log(message_body, routing_key):
-    # Publish the message to the exchange
-    await exchange_logs.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
\ No newline at end of file
+    """Queue the log to be published in the background.
+
+    Only waits (up to LOG_BACKPRESSURE_TIMEOUT) when the buffer is full; if it is still full the
+    oldest logs are spilled to disk to make room.
+    """
+    if len(log_buffer) >= LOG_BUFFER_SIZE:
+        buffer_drained.clear()
+        try:
+            await asyncio.wait_for(buffer_drained.wait(), LOG_BACKPRESSURE_TIMEOUT)
+        except asyncio.TimeoutError:
+            await spill_logs(take_logs(LOG_PUBLISH_BATCH_SIZE))
+    log_buffer.append((message_body, routing_key))
+    log_available.set()
+
+
+def take_logs(number_of_logs):
+    """Remove up to number_of_logs logs from the start of the buffer."""
+    logs = []
+    while log_buffer and len(logs) < number_of_logs:
+        logs.append(log_buffer.popleft())
+    if len(log_buffer) < LOG_BUFFER_SIZE:
+        buffer_drained.set()
+    return logs
+
+
+async def publish_batch(logs):
+    """Publish the logs waiting for all their confirms at once. Returns the logs that failed."""
+    results = await rabbitmq_connection.publish_batch(exchange_logs_name, logs)
+    return [log for log, result in zip(logs, results) if result is not None]
+
+
+def write_spool_file(logs):
+    with open(LOG_SPOOL_FILE, 'a') as spool_file:
+        spool_file.write("".join(
+            json.dumps({"body": message_body, "routing_key": routing_key}) + "\n"
+            for message_body, routing_key in logs
+        ))
+
+
+async def spill_logs(logs):
+    """Append logs that could not be published to the spool file (in a thread, off the event loop)."""
+    if not logs:
+        return
+    async with spool_lock:
+        await asyncio.to_thread(write_spool_file, logs)
+
+
+def read_spool_file():
+    """Move the spool file to the replay file and return its logs (None if there is nothing to replay).
+
+    A replay file left by an interrupted replay is read first, instead of being overwritten. Lines
+    that cannot be parsed (e.g. truncated by a crash) are moved to the corrupt file.
+    """
+    if not os.path.exists(LOG_REPLAY_FILE):
+        if not os.path.exists(LOG_SPOOL_FILE):
+            return None
+        os.replace(LOG_SPOOL_FILE, LOG_REPLAY_FILE)
+    logs = []
+    corrupt_lines = []
+    with open(LOG_REPLAY_FILE) as replay_file:
+        for line in replay_file:
+            if not line.strip():
+                continue
+            try:
+                log = json.loads(line)
+                logs.append((log["body"], log["routing_key"]))
+            except (ValueError, KeyError, TypeError):
+                corrupt_lines.append(line.rstrip("\n") + "\n")
+    if corrupt_lines:
+        logger.warning("Moving %i corrupt spilled logs to %s", len(corrupt_lines), LOG_CORRUPT_FILE)
+        with open(LOG_CORRUPT_FILE, 'a') as corrupt_file:
+            corrupt_file.writelines(corrupt_lines)
+    return logs
+
+
+def remove_replay_file():
+    try:
+        os.remove(LOG_REPLAY_FILE)
+    except FileNotFoundError:
+        pass
+
+
+async def replay_spilled_logs():
+    """Publish the logs of the spool file, spilling again the ones that fail."""
+    async with spool_lock:
+        logs = await asyncio.to_thread(read_spool_file)
+    if logs is None:
+        return
+    logger.info("Replaying %i spilled logs", len(logs))
+    for start in range(0, len(logs), LOG_PUBLISH_BATCH_SIZE):
+        batch = logs[start:start + LOG_PUBLISH_BATCH_SIZE]
+        try:
+            failed_logs = await publish_batch(batch)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Error replaying spilled logs: %s", exc)
+            failed_logs = batch
+        if failed_logs:
+            await spill_logs(failed_logs + logs[start + LOG_PUBLISH_BATCH_SIZE:])
+            break
+    # Removed once every log was published or spilled again; if the service stops before, the
+    # replay file is read again on the next replay
+    await asyncio.to_thread(remove_replay_file)
+
+
+async def run_log_publisher():
+    while True:
+        if not log_buffer:
+            log_available.clear()
+            await log_available.wait()
+        logs = take_logs(LOG_PUBLISH_BATCH_SIZE)
+        try:
+            failed_logs = await publish_batch(logs)
+        except Exception as exc:  # @ToDo: To broad exception
+            failed_logs = logs
+            logger.error("Error publishing logs: %s", exc)
+        if failed_logs:
+            # RabbitMQ is down: keep the logs on disk and wait before trying again
+            logger.warning("Could not publish %i logs, spilling them to disk", len(failed_logs))
+            await spill_logs(failed_logs)
+            await asyncio.sleep(LOG_RETRY_INTERVAL)
+            continue
+        # RabbitMQ is up: publish the logs spilled meanwhile. A replay error does not affect the
+        # batch that was just published
+        try:
+            await replay_spilled_logs()
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Error replaying spilled logs: %s", exc)
+
+
+async def close_log_publisher():
+    """Stop the publisher, publishing what is left in the buffer or spilling it to disk."""
+    if publisher_task is not None:
+        publisher_task.cancel()
+    logs = take_logs(len(log_buffer))
+    if logs and exchange_logs_name is not None:
+        try:
+            logs = await asyncio.wait_for(publish_batch(logs), LOG_RETRY_INTERVAL)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Error publishing logs on shutdown: %s", exc)
+    await spill_logs(logs)
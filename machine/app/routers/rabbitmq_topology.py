@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""RabbitMQ queue topology: shared durable work queues and per-replica broadcast queues."""
+from os import environ
+
+# Unacked messages each consumer may hold
+RABBITMQ_PREFETCH = int(environ.get("RABBITMQ_PREFETCH", '10'))
+# Exchange where rejected messages of the work queues are routed (to <queue_name>.dead)
+DEAD_LETTER_EXCHANGE = environ.get("RABBITMQ_DEAD_LETTER_EXCHANGE", "dead_letter")
+SERVICE_ID = environ.get("SERVICE_ID", "machine1")
+
+
+async def declare_work_queue(channel, queue_name, exchange, routing_key):
+    """Declare a durable queue shared by all the replicas of the service (competing consumers).
+
+    The queue survives restarts, so the messages published meanwhile are kept. Rejected messages are
+    dead-lettered to the <queue_name>.dead queue.
+    """
+    await channel.declare_exchange(name=DEAD_LETTER_EXCHANGE, type='topic', durable=True)
+    dead_letter_queue = await channel.declare_queue(name=f"{queue_name}.dead", durable=True)
+    await dead_letter_queue.bind(exchange=DEAD_LETTER_EXCHANGE, routing_key=queue_name)
+    queue = await channel.declare_queue(
+        name=queue_name,
+        durable=True,
+        arguments={
+            "x-dead-letter-exchange": DEAD_LETTER_EXCHANGE,
+            "x-dead-letter-routing-key": queue_name
+        }
+    )
+    await queue.bind(exchange=exchange, routing_key=routing_key)
+    return queue
+
+
+async def declare_broadcast_queue(channel, queue_name, exchange, routing_key):
+    """Declare an exclusive queue of this replica, for events every replica must receive."""
+    queue = await channel.declare_queue(name=f"{queue_name}_{SERVICE_ID}", exclusive=True)
+    await queue.bind(exchange=exchange, routing_key=routing_key)
+    return queue
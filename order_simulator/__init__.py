@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""Simulated Order service to load test payment, delivery and machine."""
+from order_simulator.simulator import OrderSimulator, SimulationConfig, run_simulation
+from order_simulator.stats import format_report
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Command line: python -m order_simulator --rate 20 --orders 500 --clients 1-50"""
+import argparse
+import asyncio
+import json
+import logging
+from os import environ
+from order_simulator.simulator import SimulationConfig, run_simulation, STAGE_PRODUCTION, STAGE_DELIVERING, STAGE_DELIVERED
+from order_simulator.stats import format_report
+
+
+def parse_clients(value):
+    """Client ids as "1,2,5" or "1-50"."""
+    clients = []
+    for part in value.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            clients.extend(range(int(first), int(last) + 1))
+        else:
+            clients.append(int(part))
+    return clients
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="order_simulator",
+        description="Drive simulated orders through payment, delivery and machine and report the latency of each stage."
+    )
+    parser.add_argument("--host", default=environ.get("RABBITMQ_IP", "localhost"), help="RabbitMQ host (RABBITMQ_IP)")
+    parser.add_argument("--port", type=int, default=5672)
+    parser.add_argument("--login", default="user")
+    parser.add_argument("--password", default="user")
+    parser.add_argument("--rate", type=float, default=10, help="Orders started per second")
+    parser.add_argument("--orders", type=int, default=100, help="Number of orders")
+    parser.add_argument("--clients", type=parse_clients, default=[1],
+                        help="Client ids, e.g. 1-50 (they must exist, with balance, in payment and delivery)")
+    parser.add_argument("--pieces", type=int, default=1, help="Pieces per order")
+    parser.add_argument("--price", type=float, default=1, help="Amount charged per order")
+    parser.add_argument("--first-order-id", type=int, default=None, help="First id_order (default: based on the time)")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for each reply")
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of a fixed interval")
+    parser.add_argument("--final-stage", choices=[STAGE_PRODUCTION, STAGE_DELIVERING, STAGE_DELIVERED],
+                        default=STAGE_DELIVERED, help="Last stage each order waits for")
+    parser.add_argument("--cancel-ratio", type=float, default=0,
+                        help="Fraction of the orders canceled (delivery.cancel) after the delivery check")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    config = SimulationConfig(
+        rate=args.rate,
+        orders=args.orders,
+        clients=args.clients,
+        pieces=args.pieces,
+        price=args.price,
+        first_order_id=args.first_order_id,
+        timeout=args.timeout,
+        poisson=args.poisson,
+        final_stage=args.final_stage,
+        cancel_ratio=args.cancel_ratio
+    )
+    report = asyncio.run(run_simulation(config, args.host, args.port, args.login, args.password))
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
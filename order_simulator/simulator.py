@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""Order saga simulator: plays the role of the Order service against the running services.
+
+Each simulated order goes through the same messages the Order service exchanges:
+
+    payment.check  -> payment.checked    (commands / responses)
+    delivery.check -> delivery.checked   (commands / responses)
+    delivery.cancel -> delivery.canceled (commands / responses, a cancel_ratio of the orders)
+    piece.needed   -> piece.produced     (events, one per piece)
+    order.produced -> order.delivering -> order.delivered   (events)
+
+The orders are started at a fixed rate (open loop, so a slow service shows up as latency, not as a
+lower offered load) and the time of every stage is recorded.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+import aio_pika
+from order_simulator import stats
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE_COMMANDS = "commands"
+EXCHANGE_RESPONSES = "responses"
+EXCHANGE_EVENTS = "events"
+
+# Stages, in saga order
+STAGE_PAYMENT = "payment"
+STAGE_DELIVERY_CHECK = "delivery_check"
+STAGE_DELIVERY_CANCEL = "delivery_cancel"
+STAGE_PRODUCTION = "production"
+STAGE_DELIVERING = "delivering"
+STAGE_DELIVERED = "delivered"
+STAGE_END_TO_END = "end_to_end"
+STAGES = [STAGE_PAYMENT, STAGE_DELIVERY_CHECK, STAGE_DELIVERY_CANCEL, STAGE_PRODUCTION, STAGE_DELIVERING, STAGE_DELIVERED, STAGE_END_TO_END]
+
+# Outcomes of an order
+OUTCOME_COMPLETED = "completed"
+OUTCOME_PAYMENT_REJECTED = "payment_rejected"
+OUTCOME_DELIVERY_REJECTED = "delivery_rejected"
+OUTCOME_CANCELED = "canceled"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_ERROR = "error"
+
+# Replies the simulator listens to: (exchange, routing key)
+REPLY_BINDINGS = [
+    (EXCHANGE_RESPONSES, "payment.checked"),
+    (EXCHANGE_RESPONSES, "delivery.checked"),
+    (EXCHANGE_RESPONSES, "delivery.canceled"),
+    (EXCHANGE_EVENTS, "piece.produced"),
+    (EXCHANGE_EVENTS, "order.delivering"),
+    (EXCHANGE_EVENTS, "order.delivered"),
+]
+
+
+class SimulationConfig:
+    """Parameters of a simulation run."""
+
+    def __init__(self, rate=10.0, orders=100, clients=(1,), pieces=1, price=1.0, first_order_id=None,
+                 timeout=60.0, poisson=False, final_stage=STAGE_DELIVERED, cancel_ratio=0.0):
+        self.rate = rate
+        self.orders = orders
+        self.clients = list(clients)
+        self.pieces = pieces
+        self.price = price
+        # The id_order must be new for payment and delivery: by default, based on the current time
+        self.first_order_id = first_order_id if first_order_id is not None else int(time.time() * 1000)
+        self.timeout = timeout
+        self.poisson = poisson
+        if final_stage not in (STAGE_PRODUCTION, STAGE_DELIVERING, STAGE_DELIVERED):
+            raise ValueError(f"Unknown final stage {final_stage}")
+        self.final_stage = final_stage
+        if not 0 <= cancel_ratio <= 1:
+            raise ValueError(f"The cancel ratio must be between 0 and 1, not {cancel_ratio}")
+        # Fraction of the orders canceled after delivery.checked (delivery.cancel)
+        self.cancel_ratio = cancel_ratio
+
+
+class OrderSimulator:
+    """Drive simulated orders through the saga and collect the latency of each stage."""
+
+    def __init__(self, connection, config: SimulationConfig):
+        self.connection = connection
+        self.config = config
+        self.channel = None
+        self.exchanges = {}
+        # (routing key, id_order) -> future resolved with the reply body
+        self.waiters = {}
+        # id_order -> [pieces still to be produced, future]
+        self.pending_pieces = {}
+        self.latencies = {stage: [] for stage in STAGES}
+        self.outcomes = {}
+        self.started = 0
+
+    async def setup(self):
+        """Declare the exchanges and an exclusive queue bound to every reply of the saga."""
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        for exchange_name in (EXCHANGE_COMMANDS, EXCHANGE_RESPONSES, EXCHANGE_EVENTS):
+            self.exchanges[exchange_name] = await self.channel.declare_exchange(
+                name=exchange_name, type='topic', durable=True
+            )
+        consumer_channel = await self.connection.channel()
+        await consumer_channel.set_qos(prefetch_count=1000)
+        # Exclusive queue: a copy of the replies, the queues of the services are not touched
+        queue = await consumer_channel.declare_queue(exclusive=True, auto_delete=True)
+        for exchange_name, routing_key in REPLY_BINDINGS:
+            await queue.bind(exchange=exchange_name, routing_key=routing_key)
+        await queue.consume(self.on_reply, no_ack=True)
+
+    async def on_reply(self, message):
+        try:
+            body = json.loads(message.body)
+            id_order = body['id_order']
+        except (ValueError, TypeError, KeyError):
+            return
+        if message.routing_key == "piece.produced":
+            pending = self.pending_pieces.get(id_order)
+            if pending is not None:
+                pending[0] -= 1
+                if pending[0] == 0 and not pending[1].done():
+                    pending[1].set_result(body)
+            return
+        waiter = self.waiters.get((message.routing_key, id_order))
+        if waiter is not None and not waiter.done():
+            waiter.set_result(body)
+
+    def expect(self, routing_key, id_order):
+        """Future of a reply, registered before the command is sent so the reply is never missed."""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[(routing_key, id_order)] = waiter
+        return waiter
+
+    async def wait(self, waiter, key):
+        try:
+            return await asyncio.wait_for(waiter, self.config.timeout)
+        finally:
+            self.waiters.pop(key, None)
+
+    async def publish(self, exchange_name, data, routing_key, message_id=None):
+        await self.exchanges[exchange_name].publish(
+            aio_pika.Message(
+                body=json.dumps(data).encode(),
+                content_type="text/plain",
+                message_id=message_id
+            ),
+            routing_key=routing_key
+        )
+
+    async def request(self, exchange_name, data, routing_key, reply_key, id_order):
+        """Publish a message and wait for its reply. Returns (reply body, seconds)."""
+        waiter = self.expect(reply_key, id_order)
+        start_time = time.perf_counter()
+        await self.publish(exchange_name, data, routing_key, message_id=f"{routing_key}-{id_order}")
+        reply = await self.wait(waiter, (reply_key, id_order))
+        return reply, time.perf_counter() - start_time
+
+    async def run_order(self, id_order, id_client):
+        """One order through the saga. Returns its outcome."""
+        start_time = time.perf_counter()
+        # Payment
+        payment = {"id_order": id_order, "id_client": id_client, "movement": -self.config.price}
+        reply, elapsed = await self.request(EXCHANGE_COMMANDS, payment, "payment.check", "payment.checked", id_order)
+        self.latencies[STAGE_PAYMENT].append(elapsed)
+        if not reply.get('status'):
+            return OUTCOME_PAYMENT_REJECTED
+        # Delivery address
+        delivery = {"id_order": id_order, "id_client": id_client}
+        reply, elapsed = await self.request(EXCHANGE_COMMANDS, delivery, "delivery.check", "delivery.checked", id_order)
+        self.latencies[STAGE_DELIVERY_CHECK].append(elapsed)
+        if not reply.get('status'):
+            # Compensate the payment, as the Order service does
+            await self.refund(id_order, id_client)
+            return OUTCOME_DELIVERY_REJECTED
+        if self.config.cancel_ratio and random.random() < self.config.cancel_ratio:
+            # Cancel the delivery and refund the payment, as the Order service does when an order is canceled
+            order = {"id_order": id_order}
+            _, elapsed = await self.request(EXCHANGE_COMMANDS, order, "delivery.cancel", "delivery.canceled", id_order)
+            self.latencies[STAGE_DELIVERY_CANCEL].append(elapsed)
+            await self.refund(id_order, id_client)
+            return OUTCOME_CANCELED
+        # Production: one piece.needed per piece, done when all of them are produced
+        produced = asyncio.get_running_loop().create_future()
+        self.pending_pieces[id_order] = [self.config.pieces, produced]
+        production_start = time.perf_counter()
+        try:
+            for piece_number in range(self.config.pieces):
+                id_piece = id_order * 1000 + piece_number
+                await self.publish(EXCHANGE_EVENTS, {"id_piece": id_piece, "id_order": id_order}, "piece.needed",
+                                   message_id=f"piece.needed-{id_piece}")
+            await asyncio.wait_for(produced, self.config.timeout)
+        finally:
+            del self.pending_pieces[id_order]
+        self.latencies[STAGE_PRODUCTION].append(time.perf_counter() - production_start)
+        if self.config.final_stage == STAGE_PRODUCTION:
+            self.latencies[STAGE_END_TO_END].append(time.perf_counter() - start_time)
+            return OUTCOME_COMPLETED
+        # Delivery
+        delivering = self.expect("order.delivering", id_order)
+        delivered = self.expect("order.delivered", id_order)
+        delivery_start = time.perf_counter()
+        await self.publish(EXCHANGE_EVENTS, {"id_order": id_order}, "order.produced",
+                           message_id=f"order.produced-{id_order}")
+        try:
+            await self.wait(delivering, ("order.delivering", id_order))
+            self.latencies[STAGE_DELIVERING].append(time.perf_counter() - delivery_start)
+            if self.config.final_stage == STAGE_DELIVERED:
+                await self.wait(delivered, ("order.delivered", id_order))
+                self.latencies[STAGE_DELIVERED].append(time.perf_counter() - delivery_start)
+        finally:
+            self.waiters.pop(("order.delivered", id_order), None)
+        self.latencies[STAGE_END_TO_END].append(time.perf_counter() - start_time)
+        return OUTCOME_COMPLETED
+
+    async def refund(self, id_order, id_client):
+        """Compensate the payment of the order."""
+        refund = {"id_order": id_order, "id_client": id_client, "movement": self.config.price}
+        await self.publish(EXCHANGE_COMMANDS, refund, "payment.check", message_id=f"payment.refund-{id_order}")
+
+    async def run_order_safe(self, id_order, id_client):
+        try:
+            outcome = await self.run_order(id_order, id_client)
+        except asyncio.TimeoutError:
+            outcome = OUTCOME_TIMEOUT
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Order %i failed: %s", id_order, exc)
+            outcome = OUTCOME_ERROR
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def get_interarrival_time(self):
+        if self.config.poisson:
+            return random.expovariate(self.config.rate)
+        return 1 / self.config.rate
+
+    async def run(self):
+        """Start config.orders orders at config.rate orders per second and wait for all of them."""
+        await self.setup()
+        tasks = []
+        start_time = time.perf_counter()
+        next_start = start_time
+        for order_number in range(self.config.orders):
+            # Sleep until the scheduled start, so the offered rate does not drift with the load
+            delay = next_start - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            id_order = self.config.first_order_id + order_number
+            id_client = self.config.clients[order_number % len(self.config.clients)]
+            tasks.append(asyncio.create_task(self.run_order_safe(id_order, id_client)))
+            self.started += 1
+            next_start += self.get_interarrival_time()
+        offered_time = time.perf_counter() - start_time
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start_time
+        await self.channel.close()
+        return stats.build_report(self.config, self.latencies, self.outcomes, offered_time, elapsed)
+
+
+async def run_simulation(config: SimulationConfig, host="localhost", port=5672, login="user", password="user"):
+    """Connect to RabbitMQ, run the simulation and return its report."""
+    connection = await aio_pika.connect_robust(
+        host=host,
+        port=port,
+        virtualhost='/',
+        login=login,
+        password=password
+    )
+    try:
+        return await OrderSimulator(connection, config).run()
+    finally:
+        await connection.close()
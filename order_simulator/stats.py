@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Latency percentiles and throughput of a simulation run."""
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+def percentile(sorted_values, p):
+    """Percentile p (0-100) of sorted values, interpolating between the closest ranks."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def summarize(values):
+    """Count, mean, percentiles and max of latencies in seconds."""
+    values = sorted(values)
+    summary = {"count": len(values)}
+    if not values:
+        return summary
+    summary["mean"] = sum(values) / len(values)
+    for p in PERCENTILES:
+        summary[f"p{p}"] = percentile(values, p)
+    summary["max"] = values[-1]
+    return summary
+
+
+def build_report(config, latencies, outcomes, offered_time, elapsed):
+    """Report of a run: offered and achieved rates, outcomes and the latency of each stage."""
+    completed = outcomes.get("completed", 0)
+    return {
+        "config": {
+            "rate": config.rate,
+            "orders": config.orders,
+            "pieces": config.pieces,
+            "clients": len(config.clients),
+            "poisson": config.poisson,
+            "final_stage": config.final_stage,
+            "cancel_ratio": config.cancel_ratio,
+        },
+        "offered_rate": config.orders / offered_time if offered_time > 0 else None,
+        "throughput": completed / elapsed if elapsed > 0 else None,
+        "elapsed": elapsed,
+        "outcomes": outcomes,
+        "stages": {stage: summarize(values) for stage, values in latencies.items()},
+    }
+
+
+def format_report(report):
+    """Report as a text table, latencies in milliseconds."""
+    lines = [
+        f"Orders: {report['config']['orders']}  offered rate: {report['offered_rate'] or 0:.1f}/s  "
+        f"throughput: {report['throughput'] or 0:.1f} completed/s  elapsed: {report['elapsed']:.1f}s",
+        "Outcomes: " + ", ".join(f"{outcome}={count}" for outcome, count in sorted(report['outcomes'].items())),
+        "",
+        f"{'stage':<16}{'count':>8}{'mean':>10}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES) + f"{'max':>10}",
+    ]
+    for stage, summary in report['stages'].items():
+        if not summary['count']:
+            continue
+        columns = ["mean"] + [f"p{p}" for p in PERCENTILES] + ["max"]
+        lines.append(
+            f"{stage:<16}{summary['count']:>8}" + "".join(f"{summary[column] * 1000:>10.1f}" for column in columns)
+        )
+    return "\n".join(lines)
@@ -1,7 +1,7 @@
 from os import environ
 from dotenv import load_dotenv
 import ifaddr
-import requests
+import httpx
 
 # Only needed for developing, on production Docker .env file is used
 load_dotenv()
@@ -30,26 +30,33 @@ class Config:
         if Config.__instance is not None:
             raise Exception("This class is a singleton!")
         else:
-            self.get_ip()
+            # The IP is resolved when the service is registered (get_ip), not at import time
             Config.__instance = self
 
-    def get_ip(self):
+    async def get_ip(self):
         # ip = Config.get_adapter_ip("eth0")  # this is the default interface in docker
+        ip = None
+        try:
+            async with httpx.AsyncClient(timeout=2) as client:
+                url_token = "http://169.254.169.254/latest/api/token"
+                headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
+                response = await client.put(url_token, headers=headers)
+                token = response.content.decode('utf-8')
 
-        url_token = "http://169.254.169.254/latest/api/token"
-        headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
-        response = requests.put(url_token, headers=headers)
-        token = response.content.decode('utf-8')
-
-        # Usa el token para obtener la IP pública
-        url_ip = "http://169.254.169.254/latest/meta-data/local-ipv4"
-        headers = {"X-aws-ec2-metadata-token": token}
-        respuesta = requests.get(url_ip, headers=headers)
-        ip = respuesta.content.decode('utf-8')
+                # Usa el token para obtener la IP pública
+                url_ip = "http://169.254.169.254/latest/meta-data/local-ipv4"
+                headers = {"X-aws-ec2-metadata-token": token}
+                respuesta = await client.get(url_ip, headers=headers)
+                if respuesta.status_code == 200:
+                    ip = respuesta.content.decode('utf-8')
+        except httpx.HTTPError:
+            # Not running on EC2
+            ip = Config.get_adapter_ip("eth0")
 
         if ip is None:
             ip = "127.0.0.1"
         self.IP = ip
+        return ip
 
     @staticmethod
     def get_adapter_ip(nice_name):
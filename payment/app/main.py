@@ -4,10 +4,10 @@ import logging
 import os
 from fastapi import FastAPI
 import json
-from routers import main_router, rabbitmq, security, rabbitmq_publish_logs
-from sql import models, database
+from routers import main_router, rabbitmq, security, rabbitmq_publish_logs, rabbitmq_connection, idempotency, metrics
+from sql import models, database, migrations, crud
 import asyncio
-from consulService.BLConsul import register_consul_service
+from consulService.BLConsul import register_consul_service, start_service_refresh, stop_service_refresh
 
 # Configure logging ################################################################################
 logger = logging.getLogger(__name__)
@@ -42,6 +42,9 @@ app = FastAPI(
 )
 
 app.include_router(main_router.router)
+# Latency of every request, scraped from GET /payment/metrics
+app.middleware("http")(metrics.metrics_middleware)
+metrics.instrument_database(database)
 
 
 @app.on_event("startup")
@@ -49,14 +52,19 @@ async def startup_event():
     try:
         """Configuration to be executed when FastAPI server starts."""
         logger.info("Creating database tables")
-        async with database.engine.begin() as conn:
-            await conn.run_sync(models.Base.metadata.create_all)
+        await migrations.run_migrations()
+        async with database.SessionLocal() as db:
+            if await crud.is_client_balance_empty(db):
+                logger.info("Populating client balances from payments")
+                await crud.reconcile_client_balances(db)
         await rabbitmq.subscribe_channel()
         await rabbitmq_publish_logs.subscribe_channel()
         asyncio.create_task(rabbitmq.subscribe_key_created())
         await security.get_public_key()
-        register_consul_service()
+        await register_consul_service()
+        start_service_refresh()
         asyncio.create_task(rabbitmq.subscribe_payment_check())
+        idempotency.start_purge_task()
         data2 = {
             "message": "INFO - Servicio Payment inicializado correctamente"
         }
@@ -73,6 +81,16 @@ async def startup_event():
         await rabbitmq_publish_logs.publish_log(message_body, routing_key) 
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release resources when FastAPI server stops."""
+    await stop_service_refresh()
+    await idempotency.stop_purge_task()
+    await rabbitmq_publish_logs.close_log_publisher()
+    await rabbitmq_connection.close()
+    await security.close_http_client()
+
+
 # Main #############################################################################################
 # If application is run as script, execute uvicorn on port 8000
 if __name__ == "__main__":
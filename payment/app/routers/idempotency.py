@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from os import environ
+from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
+from sql import crud
+
+logger = logging.getLogger(__name__)
+
+# Idempotent commands: the response of every processed command is stored (processed_message table)
+# in the same transaction as its changes, so a redelivered command is answered with the original
+# response. The most recent ones are also kept in memory to skip the database lookup.
+IDEMPOTENCY_CACHE_SIZE = int(environ.get("IDEMPOTENCY_CACHE_SIZE", '10000'))
+IDEMPOTENCY_TTL = float(environ.get("IDEMPOTENCY_TTL", str(24 * 3600)))
+IDEMPOTENCY_PURGE_INTERVAL = float(environ.get("IDEMPOTENCY_PURGE_INTERVAL", '3600'))
+
+processed_cache = OrderedDict()
+purge_task = None
+
+
+# Prefix of the keys hashed from the content of messages without message id
+CONTENT_KEY_PREFIX = "sha256:"
+
+
+def get_message_key(message):
+    """The message id if the publisher set one, else a hash of the routing key and the body."""
+    if message.message_id:
+        return str(message.message_id)[:64]
+    digest = hashlib.sha256(message.routing_key.encode() + b"\n" + message.body).hexdigest()
+    return (CONTENT_KEY_PREFIX + digest)[:64]
+
+
+def should_store_response(message_key, succeeded):
+    """Rejections are only stored under message ids.
+
+    A content hash can not tell a redelivery from a new command with the same body (e.g. a check
+    retried after a deposit), which must not get the old rejection.
+    """
+    return succeeded or not message_key.startswith(CONTENT_KEY_PREFIX)
+
+
+def remember_response(message_key, response):
+    processed_cache[message_key] = response
+    processed_cache.move_to_end(message_key)
+    while len(processed_cache) > IDEMPOTENCY_CACHE_SIZE:
+        processed_cache.popitem(last=False)
+
+
+async def get_processed_responses(db, message_keys):
+    """Stored responses of the already processed keys: {message key: response}."""
+    responses = {}
+    missing_keys = []
+    for message_key in message_keys:
+        if message_key in processed_cache:
+            processed_cache.move_to_end(message_key)
+            responses[message_key] = processed_cache[message_key]
+        else:
+            missing_keys.append(message_key)
+    if missing_keys:
+        stored_responses = await crud.get_processed_messages(db, missing_keys)
+        for message_key, response in stored_responses.items():
+            remember_response(message_key, response)
+        responses.update(stored_responses)
+    return responses
+
+
+async def get_processed_response(db, message_key):
+    """Stored response of the key, or None if it was not processed."""
+    responses = await get_processed_responses(db, [message_key])
+    return responses.get(message_key)
+
+
+async def purge_processed_messages():
+    """Delete the processed messages older than IDEMPOTENCY_TTL."""
+    db = SessionLocal()
+    try:
+        purged = await crud.purge_processed_messages(db, datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL))
+    finally:
+        await db.close()
+    if purged:
+        logger.info("Purged %i processed messages", purged)
+    return purged
+
+
+async def run_purge_loop():
+    while True:
+        try:
+            await purge_processed_messages()
+        except Exception as exc: # pylint: disable=broad-except
+            logger.error("Error purging the processed messages: %s", exc)
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL)
+
+
+def start_purge_task():
+    global purge_task
+    if purge_task is None:
+        purge_task = asyncio.create_task(run_purge_loop())
+
+
+async def stop_purge_task():
+    global purge_task
+    if purge_task is not None:
+        purge_task.cancel()
+        try:
+            await purge_task
+        except asyncio.CancelledError:
+            pass
+        purge_task = None
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 """FastAPI router definitions."""
+import csv
+import io
+import json
 import logging
+from datetime import datetime
 from typing import List
-from fastapi import APIRouter, Depends, status, Header, Query
+from fastapi import APIRouter, Depends, status, Header, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from dependencies import get_db
+from sql.database import SessionLocal
 from sql import crud, schemas
-from routers import security, rabbitmq_publish_logs
+from routers import security, rabbitmq_publish_logs, metrics
 from routers.router_utils import raise_and_log_error
 
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Rows fetched from the database cursor per chunk of the export
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ["id_payment", "id_client", "id_order", "movement", "creation_date"]
+
 
 @router.get(
     "/payment/health",
@@ -28,6 +38,17 @@ async def health_check():
         raise_and_log_error(logger, status.HTTP_503_SERVICE_UNAVAILABLE, "Service Unavailable.")
 
 
+@router.get(
+    "/payment/metrics",
+    summary="Metrics in Prometheus text format",
+    response_class=Response,
+)
+async def get_metrics():
+    """Endpoint scraped by Prometheus: request latency, consumers, publishes and database."""
+    logger.debug("GET '/payment/metrics' endpoint called.")
+    return metrics.get_metrics_response()
+
+
 @router.post(
     "/payment/deposit",
     response_model=schemas.Payment,
@@ -38,23 +59,12 @@ async def health_check():
 async def create_payment(
         payment_schema: schemas.PaymentBase,
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        principal: dict = Depends(security.get_principal)
 ):
     """Create single deposit endpoint."""
     logger.debug("POST '/payment/deposit' endpoint called.")
     try:
-        payload = security.decode_token(token)
-        # validar fecha expiración del token
-        is_expirated = security.validar_fecha_expiracion(payload)
-        if(is_expirated):
-
-            message="ERROR : The token is expired, please log in again"
-            routing_key = "payment.mainrouter_payment_deposit.error"
-            await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-            raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-
-        payment_schema.id_client = payload["id_client"]
+        payment_schema.id_client = principal["id_client"]
         db_payment = await crud.create_deposit(db, payment_schema)
         return db_payment
     except Exception as exc:  # @ToDo: To broad exception
@@ -66,6 +76,30 @@ async def create_payment(
         raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error creating deposit: {exc}")
 
 
+@router.post(
+    "/payment/balance/reconcile",
+    response_model=schemas.Message,
+    summary="Rebuild client balances from the payment table",
+    tags=["Payment"]
+)
+async def reconcile_balances(
+        db: AsyncSession = Depends(get_db),
+        principal: dict = Depends(security.get_principal)
+):
+    """Rebuild the materialized client balances (admin only, see security.ROUTE_POLICIES)."""
+    logger.debug("POST '/payment/balance/reconcile' endpoint called.")
+    try:
+        number_of_clients = await crud.reconcile_client_balances(db)
+        return {"detail": f"Reconciled balance of {number_of_clients} clients."}
+    except Exception as exc:  # @ToDo: To broad exception
+
+        message=f"ERROR : Error reconciling balances: {exc}"
+        routing_key = "payment.mainrouter_balance_reconcile.error"
+        await rabbitmq_publish_logs.send_message_log(message, routing_key)
+
+        raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error reconciling balances: {exc}")
+
+
 # @router.get(
 #     "/payment",
 #     response_model=List[schemas.Payment],
@@ -111,6 +145,62 @@ async def create_payment(
     
 
 
+async def generate_payments_export(export_format, since, until, client_id):
+    """Yield the payments as NDJSON or CSV lines, one database chunk at a time."""
+    db = SessionLocal()
+    try:
+        if export_format == "csv":
+            yield ",".join(EXPORT_COLUMNS) + "\n"
+        async for rows in crud.stream_payments(db, since, until, client_id, EXPORT_CHUNK_SIZE):
+            if export_format == "csv":
+                output = io.StringIO()
+                writer = csv.writer(output, lineterminator="\n")
+                for row in rows:
+                    writer.writerow([row.id_payment, row.id_client, row.id_order, row.movement, row.creation_date])
+                yield output.getvalue()
+            else:
+                yield "".join(
+                    json.dumps({
+                        "id_payment": row.id_payment,
+                        "id_client": row.id_client,
+                        "id_order": row.id_order,
+                        "movement": row.movement,
+                        "creation_date": row.creation_date.isoformat() if row.creation_date else None
+                    }) + "\n"
+                    for row in rows
+                )
+    finally:
+        await db.close()
+
+
+@router.get(
+    "/payment/export",
+    summary="Export the payment ledger",
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/x-ndjson": {}, "text/csv": {}},
+            "description": "Payments as NDJSON or CSV."
+        }
+    },
+    tags=['Payment']
+)
+async def export_payments(
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$", description="ndjson or csv"),
+        since: datetime = Query(None, description="Only payments created at or after this date"),
+        until: datetime = Query(None, description="Only payments created before this date"),
+        client_id: int = Query(None, description="Client ID"),
+        principal: dict = Depends(security.get_principal)
+):
+    """Stream the payment ledger (admin only) without loading it in memory."""
+    logger.debug("GET '/payment/export' endpoint called.")
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        generate_payments_export(export_format, since, until, client_id),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=payments.{export_format}"}
+    )
+
+
 @router.get(
     "/payment",
     summary="Retrieve single payment by id",
@@ -129,32 +219,14 @@ async def get_single_payment(
         payment_id: int = Query(None, description="Client ID"),
         client_id: int = Query(None, description="Client ID"),
         db: AsyncSession = Depends(get_db),
-        token: str = Header(..., description="JWT Token in the Header")
+        principal: dict = Depends(security.get_principal)
 ):
     """Retrieve single payment by id"""
     logger.debug("GET '/payment' endpoint called.", payment_id)
 
     if payment_id is None and client_id is None:
+        await security.require_admin(principal)
         try:
-            payload = security.decode_token(token)
-            # validar fecha expiración del token
-            is_expirated = security.validar_fecha_expiracion(payload)
-            if(is_expirated):
-
-                message="ERROR : The token is expired, please log in again"
-                routing_key = "payment.mainrouter_list.error"
-                await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-            else:
-                es_admin = security.validar_es_admin(payload)
-                if(es_admin==False):
-
-                    message="ERROR : You don't have permissions"
-                    routing_key = "payment.mainrouter_list.error"
-                    await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                    raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
             payment_list = await crud.get_payments_list(db)
             return payment_list
         except Exception as exc:  # @ToDo: To broad exception
@@ -167,74 +239,35 @@ async def get_single_payment(
 
     if payment_id is not None and client_id is None:
         try:
-            payload = security.decode_token(token)
-            # validar fecha expiración del token
-            is_expirated = security.validar_fecha_expiracion(payload)
-            if(is_expirated):
-
-                message="ERROR: The token is expired, please log in again"
-                routing_key = "payment.mainrouter_payment_id.error"
-                await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-            else:
-                es_admin = security.validar_es_admin(payload)
-                client_id = payload["id_client"]
-                payment = await crud.get_payment(db, payment_id)
-                if(es_admin==False and payment.id_client!=client_id):
-
-                    message=f"ERROR: You don't have permissions"
-                    routing_key = "payment.mainrouter_payment_id.error"
-                    await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                    raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
             payment = await crud.get_payment(db, payment_id)
-            if not payment:
-
-                message=f"ERROR: Payment {payment_id} not found"
-                routing_key = "payment.mainrouter_payment_id.error"
-                await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Payment {payment_id} not found")
-            return payment
         except Exception as exc:  # @ToDo: To broad exception
             message=f"ERROR : Error getting payment by Id: {exc}"
             routing_key = "payment.mainrouter_payment_id.error"
             await rabbitmq_publish_logs.send_message_log(message, routing_key)
 
             raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error getting payment by Id: {exc}")
-    if payment_id is None and client_id is not None:
-        try:
-            payload = security.decode_token(token)
-            # validar fecha expiración del token
-            is_expirated = security.validar_fecha_expiracion(payload)
-            if(is_expirated):
+        if not payment:
 
-                message="ERROR : The token is expired, please log in again"
-                routing_key = "payment.mainrouter_payment_client_id.error"
-                await rabbitmq_publish_logs.send_message_log(message, routing_key)
-
-                raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"The token is expired, please log in again")
-            else:
-                es_admin = security.validar_es_admin(payload)
-                client_id_token = payload["id_client"]
-                if(es_admin==False and client_id!=client_id_token):
-
-                    message=f"ERROR: You don't have permissions"
-                    routing_key = "payment.mainrouter_payment_client_id.error"
-                    await rabbitmq_publish_logs.send_message_log(message, routing_key)
+            message=f"ERROR: Payment {payment_id} not found"
+            routing_key = "payment.mainrouter_payment_id.error"
+            await rabbitmq_publish_logs.send_message_log(message, routing_key)
 
-                    raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"You don't have permissions")
+            raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Payment {payment_id} not found")
+        await security.require_owner_or_admin(principal, payment.id_client)
+        return payment
+    if payment_id is None and client_id is not None:
+        await security.require_owner_or_admin(principal, client_id)
+        try:
             payments = await crud.get_clients_payments(db, client_id)
-            if not payments:
-                raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Client {client_id}'s payments not found")
-            return payments
         except Exception as exc:
             message=f"ERROR : Error getting payments by client: {exc}"
             routing_key = "payment.mainrouter_payment_client_id.error"
             await rabbitmq_publish_logs.send_message_log(message, routing_key)
 
             raise_and_log_error(logger, status.HTTP_409_CONFLICT, f"Error Error getting payments by client: {exc}")
+        if not payments:
+            raise_and_log_error(logger, status.HTTP_404_NOT_FOUND, f"Client {client_id}'s payments not found")
+        return payments
 
 
 # @router.get(
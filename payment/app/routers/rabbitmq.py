@@ -1,114 +1,216 @@
-import aio_pika
+import asyncio
+import logging
 import json
 from sql.database import SessionLocal # pylint: disable=import-outside-toplevel
 from sql import crud
-from routers import security
+from routers import security, rabbitmq_topology, rabbitmq_connection, metrics, idempotency
 from os import environ
 
+logger = logging.getLogger(__name__)
+
+# payment.check consumer tuning
+PAYMENT_CHECK_PREFETCH = int(environ.get("PAYMENT_CHECK_PREFETCH", '20'))
+PAYMENT_CHECK_WORKERS = int(environ.get("PAYMENT_CHECK_WORKERS", '4'))
+PAYMENT_CHECK_BATCH_SIZE = int(environ.get("PAYMENT_CHECK_BATCH_SIZE", '1'))
+
 
 async def subscribe_channel():
-    # Define your RabbitMQ server connection parameters directly as keyword arguments
-    connection = await aio_pika.connect_robust(
-        host=environ.get("RABBITMQ_IP"),
-        port=5672,
-        virtualhost='/',
-        login='user',
-        password='user'
-    )
-    # Create a channel
-    global channel
-    channel = await connection.channel()
+    # All the channels of the service share the connection of rabbitmq_connection
+    await rabbitmq_connection.get_connection()
     # Declare the exchange
     global exchange_events_name
     exchange_events_name = 'events'
-    global exchange_events
-    exchange_events = await channel.declare_exchange(name=exchange_events_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_events_name)
     
     global exchange_commands_name
     exchange_commands_name = 'commands'
-    global exchange_commands
-    exchange_commands = await channel.declare_exchange(name=exchange_commands_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_commands_name)
     
     global exchange_responses_name
     exchange_responses_name = 'responses'
-    global exchange_responses
-    exchange_responses = await channel.declare_exchange(name=exchange_responses_name, type='topic', durable=True)
+    await rabbitmq_connection.declare_exchange(exchange_responses_name)
 
 
 async def on_message_payment_check(message):
     async with message.process():
         payment = json.loads(message.body)
-        db = SessionLocal()
+        await handle_payment_check(payment, idempotency.get_message_key(message))
+
+
+async def handle_payment_check(payment, message_key):
+    db = SessionLocal()
+    try:
+        # A redelivered check is answered with the original response, without charging again
+        message_body = await idempotency.get_processed_response(db, message_key)
+        if message_body is None:
+            try:
+                await crud.create_payment(db, payment, commit=False)
+                # Crear evento con payment de ID order correcto
+                payment_status = True
+            except Exception as exc:  # @ToDo: To broad exception
+                # Crear evento con payment de ID order incorrecto
+                await db.rollback()
+                payment_status = False
+            message_body = get_payment_checked_body(payment, payment_status)
+            store_response = idempotency.should_store_response(message_key, payment_status)
+            if store_response:
+                crud.add_processed_message(db, message_key, message_body)
+            try:
+                await db.commit()
+            except Exception as exc:  # @ToDo: To broad exception
+                # Processed concurrently (e.g. redelivered to another worker): use its response
+                await db.rollback()
+                message_body = await idempotency.get_processed_response(db, message_key)
+                if message_body is None:
+                    raise
+                store_response = True
+            if store_response:
+                idempotency.remember_response(message_key, message_body)
+    finally:
+        await db.close()
+    await publish_response(message_body, "payment.checked")
+
+
+def get_payment_checked_body(payment, payment_status):
+    data = {
+        "id_order": payment['id_order'],
+        "status": payment_status
+    }
+    return json.dumps(data)
+
+
+async def handle_payment_check_batch(batch):
+    """Create the payments of several messages in one transaction, then ack and respond.
+
+    Messages already processed (redeliveries) are answered with their stored response.
+    """
+    db = SessionLocal()
+    message_keys = [idempotency.get_message_key(message) for message, _ in batch]
+    new_keys = []
+    try:
+        message_bodies = await idempotency.get_processed_responses(db, message_keys)
+        for (message, payment), message_key in zip(batch, message_keys):
+            # The same command can also be twice in the batch
+            if message_key in message_bodies:
+                continue
+            try:
+                await crud.create_payment(db, payment, commit=False)
+                payment_status = True
+            except Exception as exc:  # @ToDo: To broad exception
+                payment_status = False
+            message_bodies[message_key] = get_payment_checked_body(payment, payment_status)
+            if idempotency.should_store_response(message_key, payment_status):
+                crud.add_processed_message(db, message_key, message_bodies[message_key])
+                new_keys.append(message_key)
+        await db.commit()
+    except Exception as exc:  # @ToDo: To broad exception
+        # The batch transaction failed: retry every message on its own transaction.
+        logger.error("Error committing payment batch, retrying one by one: %s", exc)
+        await db.rollback()
+        await db.close()
+        for (message, payment), message_key in zip(batch, message_keys):
+            try:
+                async with message.process():
+                    await handle_payment_check(payment, message_key)
+            except Exception as exc:  # @ToDo: To broad exception
+                # Rejected by process(); the rest of the batch is still handled
+                logger.error("Error handling payment check: %s", exc)
+        return
+    await db.close()
+    for message_key in new_keys:
+        idempotency.remember_response(message_key, message_bodies[message_key])
+    # Every message is settled even if a publish fails: a requeued message is answered again with
+    # its stored response, without charging twice
+    for (message, payment), message_key in zip(batch, message_keys):
+        published = False
         try:
-            db_payment = await crud.create_payment(db, payment)
-            # Crear evento con payment de ID order correcto
-            payment_status = True
+            await publish_response(message_bodies[message_key], "payment.checked")
+            published = True
         except Exception as exc:  # @ToDo: To broad exception
-            # Crear evento con payment de ID order incorrecto
-            payment_status = False
-        await db.close()
-        data = {
-            "id_order": payment['id_order'],
-            "status": payment_status
-        }
-        message_body = json.dumps(data)
-        routing_key = "payment.checked"
-        await publish_response(message_body, routing_key)
+            logger.error("Error publishing payment.checked, requeueing the check: %s", exc)
+        finally:
+            try:
+                if published:
+                    await message.ack()
+                else:
+                    await message.nack(requeue=True)
+            except Exception as exc:  # @ToDo: To broad exception
+                logger.error("Error settling payment check: %s", exc)
+
+
+async def payment_check_worker(worker_queue):
+    """Handle the messages of one worker queue in order, in batches of PAYMENT_CHECK_BATCH_SIZE."""
+    while True:
+        batch = [await worker_queue.get()]
+        while len(batch) < PAYMENT_CHECK_BATCH_SIZE and not worker_queue.empty():
+            batch.append(worker_queue.get_nowait())
+        try:
+            async with metrics.track_message("payment.check", len(batch)):
+                if len(batch) == 1:
+                    message, payment = batch[0]
+                    async with message.process():
+                        await handle_payment_check(payment, idempotency.get_message_key(message))
+                else:
+                    await handle_payment_check_batch(batch)
+        except Exception as exc:  # @ToDo: To broad exception
+            logger.error("Error handling payment check: %s", exc)
 
 
 async def subscribe_payment_check():
     # Create queue
     queue_name = "payment.check"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "payment.check"
-    await queue.bind(exchange=exchange_commands_name, routing_key=routing_key)
+    # Dedicated channel so the prefetch only applies to this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(PAYMENT_CHECK_PREFETCH)
+    # Declare the shared queue and bind it to the exchange
+    queue = await rabbitmq_topology.declare_work_queue(consumer_channel, queue_name, exchange_commands_name, routing_key)
+    # Messages of the same client always go to the same worker, so they are handled in order
+    worker_queues = [asyncio.Queue() for _ in range(PAYMENT_CHECK_WORKERS)]
+    workers = [asyncio.create_task(payment_check_worker(worker_queue)) for worker_queue in worker_queues]
     # Set up a message consumer
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            await on_message_payment_check(message)
+    try:
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                try:
+                    payment = json.loads(message.body)
+                    worker_index = hash(str(payment['id_client'])) % PAYMENT_CHECK_WORKERS
+                except (ValueError, KeyError, TypeError) as exc:
+                    logger.error("Discarding malformed payment check: %s", exc)
+                    await message.reject()
+                    continue
+                await worker_queues[worker_index].put((message, payment))
+    finally:
+        for worker in workers:
+            worker.cancel()
 
 
 async def publish_event(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_events.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await rabbitmq_connection.publish(exchange_events_name, message_body, routing_key)
 
 
 async def publish_response(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_responses.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
+    await rabbitmq_connection.publish(exchange_responses_name, message_body, routing_key)
 
 async def subscribe_key_created():
     # Create a queue
     queue_name = "client.key_created_payment"
-    queue = await channel.declare_queue(name=queue_name, exclusive=True)
-    # Bind the queue to the exchange
     routing_key = "client.key_created"
-    await queue.bind(exchange=exchange_events_name, routing_key=routing_key)
+    # Dedicated channel for this consumer
+    consumer_channel = await rabbitmq_connection.get_consumer_channel(rabbitmq_topology.RABBITMQ_PREFETCH)
+    # Declare the queue of this replica and bind it to the exchange
+    queue = await rabbitmq_topology.declare_broadcast_queue(consumer_channel, queue_name, exchange_events_name, routing_key)
     # Set up a message consumer
     async with queue.iterator() as queue_iter:
         async for message in queue_iter:
-            await on_delivered_message_key_created(message)
+            async with metrics.track_message(queue_name):
+                await on_delivered_message_key_created(message)
 
 async def on_delivered_message_key_created(message):
     async with message.process():
-        await security.get_public_key()
+        await security.get_public_key(refresh=True)
 
 async def publish_key(message_body, routing_key):
     # Publish the message to the exchange
-    await exchange_events.publish(
-        aio_pika.Message(
-            body=message_body.encode(),
-            content_type="text/plain"
-        ),
-        routing_key=routing_key)
\ No newline at end of file
+    await rabbitmq_connection.publish(exchange_events_name, message_body, routing_key)
\ No newline at end of file
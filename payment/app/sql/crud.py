@@ -2,6 +2,7 @@
 """Functions that interact with the database."""
 import logging
 from datetime import datetime
+from sqlalchemy import delete, func, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from . import models
@@ -58,6 +59,26 @@ async def get_payments_list(db: AsyncSession):
     return payments
 
 
+async def stream_payments(db: AsyncSession, since=None, until=None, client_id=None, chunk_size=1000):
+    """Yield the payments in chunks of rows using a server-side cursor, ordered by id."""
+    stmt = select(
+        models.Payment.id_payment,
+        models.Payment.id_client,
+        models.Payment.id_order,
+        models.Payment.movement,
+        models.Payment.creation_date
+    ).order_by(models.Payment.id_payment)
+    if since is not None:
+        stmt = stmt.where(models.Payment.creation_date >= since)
+    if until is not None:
+        stmt = stmt.where(models.Payment.creation_date < until)
+    if client_id is not None:
+        stmt = stmt.where(models.Payment.id_client == client_id)
+    result = await db.stream(stmt)
+    async for rows in result.partitions(chunk_size):
+        yield rows
+
+
 async def get_payment(db: AsyncSession, payment_id):
     """Load a payment from the database."""
     return await get_element_by_id(db, models.Payment, payment_id)
@@ -70,23 +91,22 @@ async def get_clients_payments(db: AsyncSession, client_id):
     return payments
 
 
-async def create_payment(db: AsyncSession, payment):
+async def create_payment(db: AsyncSession, payment, commit=True):
     """Persist a new payment into the database."""
     """Check if the client has enough balance for the payment, else return False"""
+    """With commit=False the payment is only flushed, so several payments can share a transaction"""
     payment_movement_float = float(payment['movement'])
-    if payment_movement_float < 0:
-        clients_payments_list = await get_clients_payments(db, payment['id_client'])
-        client_balance = 0
-        for client_payment in clients_payments_list:
-            client_balance += client_payment.movement
-        if (payment_movement_float + client_balance) < 0:
-            raise Exception("Insufficient balance.")
+    if not await apply_balance_movement(db, payment['id_client'], payment_movement_float):
+        raise Exception("Insufficient balance.")
     db_payment = models.Payment(
         id_client=payment['id_client'],
         id_order=payment['id_order'],
         movement=payment_movement_float
     )
     db.add(db_payment)
+    if not commit:
+        await db.flush()
+        return db_payment
     await db.commit()
     await db.refresh(db_payment)
     return db_payment
@@ -97,6 +117,7 @@ async def create_deposit(db: AsyncSession, payment):
     payment_movement_float = float(payment.movement)
     if payment_movement_float <= 0:
         raise Exception("Can not make negative deposit.")
+    await apply_balance_movement(db, payment.id_client, payment_movement_float)
     db_payment = models.Payment(
         id_client=payment.id_client,
         movement=payment_movement_float,
@@ -105,4 +126,86 @@ async def create_deposit(db: AsyncSession, payment):
     db.add(db_payment)
     await db.commit()
     await db.refresh(db_payment)
-    return db_payment
\ No newline at end of file
+    return db_payment
+
+
+# Balance functions ##################################################################################
+async def get_client_balance(db: AsyncSession, client_id):
+    """Load the materialized balance of a client (0 if the client has no movements)."""
+    db_balance = await get_element_by_id(db, models.ClientBalance, client_id)
+    if db_balance is None:
+        return 0
+    return db_balance.balance
+
+
+async def apply_balance_movement(db: AsyncSession, client_id, movement):
+    """Add the movement to the client's balance inside the current transaction.
+
+    The update is conditional so the balance never goes negative; returns False (and changes
+    nothing) when the client does not have enough balance for the movement.
+    """
+    stmt = (
+        update(models.ClientBalance)
+        .where(models.ClientBalance.id_client == client_id)
+        .where(models.ClientBalance.balance + movement >= 0)
+        .values(balance=models.ClientBalance.balance + movement)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(stmt)
+    if result.rowcount:
+        return True
+    if movement < 0:
+        return False
+    db_balance = await get_element_by_id(db, models.ClientBalance, client_id)
+    if db_balance is not None:
+        # Row exists but the condition failed: only possible with a negative movement.
+        return False
+    db.add(models.ClientBalance(id_client=client_id, balance=movement))
+    # Flush so later movements of the same transaction update this row instead of inserting it again.
+    await db.flush()
+    return True
+
+
+async def reconcile_client_balances(db: AsyncSession):
+    """Rebuild the client_balance table from the payment table. Returns the number of clients."""
+    stmt = select(
+        models.Payment.id_client,
+        func.sum(models.Payment.movement)
+    ).group_by(models.Payment.id_client)
+    result = await db.execute(stmt)
+    balances = result.all()
+    await db.execute(delete(models.ClientBalance))
+    for client_id, balance in balances:
+        db.add(models.ClientBalance(id_client=client_id, balance=balance))
+    await db.commit()
+    logger.info("Reconciled balance of %i clients", len(balances))
+    return len(balances)
+
+
+async def is_client_balance_empty(db: AsyncSession):
+    """Check whether the client_balance table has not been populated yet."""
+    stmt = select(models.ClientBalance.id_client).limit(1)
+    return await get_element_statement_result(db, stmt) is None
+
+
+# Processed message functions #######################################################################
+async def get_processed_messages(db: AsyncSession, message_keys):
+    """Load the stored responses of the given keys: {message key: response}."""
+    stmt = select(models.ProcessedMessage.message_key, models.ProcessedMessage.response).where(
+        models.ProcessedMessage.message_key.in_(message_keys)
+    )
+    result = await db.execute(stmt)
+    return {row.message_key: row.response for row in result}
+
+
+def add_processed_message(db: AsyncSession, message_key, response):
+    """Store the response of a command, committed together with the changes of the command."""
+    db.add(models.ProcessedMessage(message_key=message_key, response=response))
+
+
+async def purge_processed_messages(db: AsyncSession, before):
+    """Delete the processed messages stored before the given date."""
+    stmt = delete(models.ProcessedMessage).where(models.ProcessedMessage.creation_date < before)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
@@ -42,6 +42,22 @@ class Payment(BaseModel):
 
     __tablename__ = "payment"
     id_payment = Column(Integer, primary_key=True)
-    id_client = Column(Integer, nullable=False)
+    id_client = Column(Integer, nullable=False, index=True)
     id_order = Column(Integer, nullable=True)
     movement = Column(Float, nullable=False)
+
+
+class ClientBalance(BaseModel):
+    """Materialized balance per client, kept in sync with the payment table."""
+    __tablename__ = "client_balance"
+    id_client = Column(Integer, primary_key=True)
+    balance = Column(Float, nullable=False, default=0)
+
+
+class ProcessedMessage(BaseModel):
+    """Commands already processed and their response, to answer redeliveries (routers/idempotency.py)."""
+    __tablename__ = "processed_message"
+    message_key = Column(String(64), primary_key=True)
+    response = Column(TEXT, nullable=False)
+    # Purged after IDEMPOTENCY_TTL
+    creation_date = Column(DateTime(timezone=True), server_default=func.now(), index=True)